@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import sys
+import logging
+
+from katc import archive
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log.addHandler(console)
+
+# Reads an archiver.py directory directly, printing results as they are found:
+#
+#   archive_query.py -a DIR aircraft --from 2024-05-01T12:00 --to 2024-05-01T13:00
+#   archive_query.py -a DIR frames 4CA7B4 --from 2024-05-01
+#   archive_query.py -a DIR callsigns 4CA7B4
+
+def parse_time(text):
+    # ISO 8601, local time unless it says otherwise, or seconds since the epoch
+    try:
+        return float(text)
+    except ValueError:
+        ...
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a time: {text}")
+
+def iso(timestamp_ns):
+    return datetime.datetime.fromtimestamp(timestamp_ns / 1e9, datetime.timezone.utc).isoformat(timespec = "milliseconds")
+
+def aircraft(store):
+    seen = store.aircraft(args.start, args.end)
+    for icao, (first_ns, last_ns) in sorted(seen.items(), key = lambda item: item[1][0]):
+        print(f"{icao} {iso(first_ns)} {iso(last_ns)}")
+    log.info(f"{len(seen)} aircraft")
+
+def frames(store):
+    for record in store.frames(args.start, args.end, args.icao):
+        typecode = "-" if record.typecode is None else record.typecode
+        print(f"{iso(record.timestamp_ns)} {'%06X' % record.icao} {typecode} {record.frame.hex().upper()}")
+
+def callsigns(store):
+    for timestamp_ns, callsign in store.callsigns(args.icao, args.start, args.end):
+        print(f"{iso(timestamp_ns)} {callsign}")
+
+if __name__ == "__main__":
+    global args
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--archive", required=True, help="archiver.py's directory")
+    parser.add_argument("--from", type=parse_time, dest="start", help="ISO time or seconds since the epoch")
+    parser.add_argument("--to", type=parse_time, dest="end", help="ISO time or seconds since the epoch")
+    queries = parser.add_subparsers(dest="query", required=True)
+    queries.add_parser("aircraft", help="what flew over").set_defaults(run=aircraft)
+    for name, run, description in (("frames", frames, "every frame from an aircraft"),
+                                   ("callsigns", callsigns, "an airframe's callsign history")):
+        query = queries.add_parser(name, help=description)
+        query.add_argument("icao", type=lambda text: text.upper())
+        query.set_defaults(run=run)
+    args = parser.parse_args()
+
+    try:
+        args.run(archive.Archive(args.archive))
+    except BrokenPipeError:
+        # piped into head and the like
+        sys.stderr.close()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import daemon
+import logging
+import logging.handlers
+
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import archive, consumer, metrics, registrations, rpc, shedding, transport, wire
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+
+# Keeps every ADS-B frame in a katc.archive directory and answers questions about the past over RPC:
+#
+#   archive-aircraft   {"from": t, "to": t}                     -> {icao: [first seen, last seen]}
+#   archive-frames     {"icao": ..., "from": t, "to": t}        -> [[timestamp, typecode, frame], ...]
+#   archive-callsigns  {"icao": ..., "from": t, "to": t}        -> [[timestamp, callsign], ...]
+#
+# with times in seconds since the epoch. Frames still waiting to be written (up to --flush-interval) aren't
+# in the answers; archive_query.py asks the same questions of the files directly.
+#
+# A frame is acked only once the block holding it is on disk, so a crash loses nothing the queue let go of.
+
+writer = None
+# the latest delivery whose frame is in the writer, and the latest one acked
+delivered = None
+acked = None
+flushing = None
+
+ARCHIVED = metrics.counter("archived_frames")
+UNARCHIVABLE = metrics.counter("unarchivable_frames")
+BLOCKS = metrics.counter("archive_blocks")
+
+async def main():
+    global writer
+    global flushing
+
+    writer = archive.ArchiveWriter(args.archive, args.partition, args.block_records)
+    flushing = asyncio.Lock()
+
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+    rpc_channel = await rabbit.channel()
+
+    adsb_xch = await registrations.Exchanges.ADSB(channel)
+    queue = await channel.declare_queue("archiver", durable=True,
+                                        arguments=shedding.queue_arguments("archiver"))
+    await queue.bind(adsb_xch, "#")
+
+    rpc_xch = await registrations.Exchanges.RPC(rpc_channel)
+    rpc_queue = await rpc_channel.declare_queue("archive")
+    rpc_server = rpc.RpcServer(rpc_xch, {"archive-aircraft": archive_aircraft,
+                                         "archive-frames": archive_frames,
+                                         "archive-callsigns": archive_callsigns})
+    for method_name in rpc_server.handlers:
+        await rpc_queue.bind(rpc_xch, method_name)
+
+    log.info(f"Archiving to {args.archive}")
+
+    try:
+        await asyncio.gather(consume(queue),
+                             consumer.consume(rpc_queue, rpc_server.on_request, no_ack = True),
+                             flush_periodically(),
+                             metrics.export(args, channel, "archiver"))
+    except asyncio.exceptions.CancelledError:
+        ...
+    finally:
+        await flush(everything = True)
+        await rabbit.close()
+
+async def consume(queue):
+    # not consumer.consume, which acks each message as soon as it's handled
+    global delivered
+
+    await queue.channel.set_qos(prefetch_count = args.prefetch)
+    waiting = 0
+    async with queue.iterator() as q:
+        async for message in q:
+            try:
+                full = archive_frame(message)
+            except Exception as x:
+                UNARCHIVABLE.inc()
+                log.error(f"Failed to archive a frame: {x}")
+                full = False
+
+            delivered = message
+            waiting += 1
+            # the broker stops delivering at --prefetch unacked, so don't wait for a full block past that
+            if full or waiting >= args.prefetch:
+                await flush()
+                waiting = 0
+
+def archive_frame(message):
+    # True once a block's worth is waiting
+    if message.content_type == wire.BINARY_CONTENT_TYPE:
+        # the envelope already has everything; no need to make hex of the frame only to undo it
+        version, _, typecode, icao, timestamp_ns = wire.ENVELOPE.unpack_from(message.body)
+        if version != wire.VERSION or icao == wire.NO_ICAO:
+            UNARCHIVABLE.inc()
+            return False
+        raw = message.body[wire.ENVELOPE.size:]
+    else:
+        frame = wire.decode(message)
+        if frame.icao is None:
+            UNARCHIVABLE.inc()
+            return False
+        typecode, icao, raw = frame.typecode, int(frame.icao, 16), bytes.fromhex(frame.body)
+        timestamp_ns = wire.timestamp_ns(message)
+
+    ARCHIVED.inc()
+    return writer.append(timestamp_ns, icao, typecode, raw)
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(args.flush_interval)
+        await flush()
+
+async def flush(everything = False):
+    global acked
+
+    async with flushing:
+        # everything delivered so far is in what's taken, so it can all be acked once that's written
+        last, taken = delivered, writer.take(everything)
+        if len(taken) > 0:
+            BLOCKS.inc(await asyncio.to_thread(writer.write, taken))
+
+        if last is not None and last is not acked:
+            try:
+                await last.channel.basic_ack(delivery_tag = last.delivery_tag, multiple = True)
+                acked = last
+            except Exception as x:
+                log.error(f"Failed to ack archived frames up to {last.delivery_tag}: {x}")
+
+async def archive_aircraft(request):
+    request = json.loads(request)
+    seen = await asyncio.to_thread(lambda: archive.Archive(args.archive).aircraft(request.get("from"),
+                                                                                   request.get("to")))
+    return json.dumps({icao: [first_ns / 1e9, last_ns / 1e9] for icao, (first_ns, last_ns) in seen.items()})
+
+async def archive_frames(request):
+    request = json.loads(request)
+    limit = min(request.get("limit", args.max_frames), args.max_frames)
+    frames = archive.Archive(args.archive).frames(request.get("from"), request.get("to"), request["icao"])
+    records = await asyncio.to_thread(lambda: list(itertools.islice(frames, limit)))
+    return json.dumps([[record.timestamp_ns / 1e9, record.typecode, record.frame.hex().upper()]
+                       for record in records])
+
+async def archive_callsigns(request):
+    request = json.loads(request)
+    callsigns = archive.Archive(args.archive).callsigns(request["icao"], request.get("from"), request.get("to"))
+    history = await asyncio.to_thread(lambda: list(callsigns))
+    return json.dumps([[timestamp_ns / 1e9, callsign] for timestamp_ns, callsign in history])
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
+    parser.add_argument("-r", "--rabbit", required=True)
+    parser.add_argument("-a", "--archive", required=True, help="directory for segment files")
+    parser.add_argument("--partition", type=int, default=3600, help="seconds per segment file")
+    parser.add_argument("--block-records", type=int, default=4096, help="frames per compressed block")
+    parser.add_argument("--flush-interval", type=float, default=5, help="seconds")
+    parser.add_argument("--prefetch", type=int, default=10000,
+                        help="unacked frames; above --block-records, or blocks come out smaller")
+    parser.add_argument("--max-frames", type=int, default=10000, help="most frames one archive-frames reply holds")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
+
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: archiver.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import time
+
+from katc import decode, sharding
+
+# A handful of real frames covering identification, position, velocity and surveillance replies
+CORPUS = [b"8D4840D6202CC371C32CE0576098",
+          b"8D40621D58C382D690C8AC2863A7",
+          b"8D40621D58C386435CC412692AD6",
+          b"8D485020994409940838175B284F",
+          b"8DA05F219B06B6AF189400CBC33F",
+          b"5D484FDEA248F5",
+          b"A0001838CA3E51F0A8000047A36A",
+          b"28001A1BD4C3C4"]
+
+def decode_shard(frames):
+    start = time.process_time()
+    decode.decode_frames(frames)
+    return time.process_time() - start
+
+def run(frames, workers):
+    shards = [[] for _ in range(workers)]
+    for frame in frames:
+        shards[sharding.shard_for(frame, workers)].append(frame)
+
+    with multiprocessing.Pool(workers) as pool:
+        start = time.perf_counter()
+        pool.map(decode_shard, shards)
+        return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--messages", type=int, default=200000)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # vary the address so the frames actually spread across shards
+    frames = [CORPUS[i % len(CORPUS)][:2] + b"%06X" % (i % 4096) + CORPUS[i % len(CORPUS)][8:]
+              for i in range(args.messages)]
+
+    workers = 1
+    while workers <= args.workers:
+        elapsed = run(frames, workers)
+        print(f"{workers} workers: {int(len(frames) / elapsed)} msg/s")
+        workers *= 2
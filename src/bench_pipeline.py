@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from katc import batching, capture, consumer, events, inprocess, positions, registrations, timers, tracing, tracklog, wire
+
+import flight_state
+import mode_s_router
+import trace_dispatcher
+import trace_engine
+
+# Replays a capture through the real message handlers of each service, wired together with the in-memory
+# broker, and reports throughput, latency and CPU per message for every stage. trace_dispatcher and
+# trace_engine only run their per-message paths; the Redis side of both is left out.
+
+class Stage:
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        self.cpu = 0.0
+        self.finished = None
+        self.consumer = None
+
+    async def handle(self, message):
+        start = time.thread_time()
+        try:
+            await self.handler(message)
+        finally:
+            self.cpu += time.thread_time() - start
+            self.finished = time.perf_counter()
+
+def column(seconds, unit):
+    # text wire messages carry no send time, so there may be no lag to show
+    if seconds is None:
+        return f"{'-':>10}"
+    return f"{seconds * (1e6 if unit == 'us' else 1e3):>8.1f}{unit}"
+
+async def trace_everything(message):
+    # trace_engine only sees aircraft someone asked for; here every aircraft gets a session
+    icao = wire.decode(message).icao
+    if icao not in trace_engine.sessions:
+        trace_engine.sessions[icao] = tracing.TraceSession(icao, time.time())
+    await trace_engine.on_message(message)
+
+async def nothing(*args):
+    ...
+
+async def main():
+    broker = inprocess.Broker()
+    connection = await broker.connect()
+    channel = await connection.channel()
+
+    mode_s = await channel.declare_exchange("mode_s", type = aio_pika.ExchangeType.FANOUT)
+    mode_s_router.mode_s_exchange = await channel.declare_exchange("mode_s_by_downlink",
+                                                                   aio_pika.ExchangeType.TOPIC,
+                                                                   durable = True)
+    mode_s_router.adsb_exchange = adsb = await registrations.Exchanges.ADSB(channel)
+    mode_s_router.binary_wire = args.wire == "binary"
+
+    flight_state.args = argparse.Namespace(receiver = positions.DEFAULT_RECEIVER)
+    flight_state.state_xch = await registrations.Exchanges.FlightStateChanges(channel)
+    flight_state.writer = tracklog.TrackWriter(os.devnull)
+    flight_state.expiry = timers.ExpiryScheduler(nothing)
+
+    trace_engine.events_xch = await registrations.Exchanges.TraceEvents(channel)
+    trace_engine.delta = events.DeltaFilter()
+    trace_engine.expiry = timers.ExpiryScheduler(nothing)
+
+    stages = [(Stage("mode_s_router", mode_s_router.route), mode_s, "raw"),
+              (Stage("trace_dispatcher", trace_dispatcher.on_adsb_message), adsb, "#"),
+              (Stage("trace_engine", trace_everything), adsb, "#"),
+              (Stage("flight_state", flight_state.on_adsb), adsb, "#")]
+
+    tasks = []
+    for stage, exchange, routing_key in stages:
+        queue = await channel.declare_queue(stage.name)
+        await queue.bind(exchange, routing_key)
+        stage.consumer = consumer.Consumer(queue, stage.handle, no_ack = True)
+        tasks.append(asyncio.create_task(stage.consumer.run()))
+
+    records = list(capture.read_capture(args.input)) * args.loops
+    batcher = batching.Batcher(mode_s, args.batch_size, args.batch_window / 1000, args.max_in_flight)
+
+    start = time.perf_counter()
+    process_start = time.process_time()
+    await capture.replay(records, batcher.add, args.speed)
+    await batcher.close()
+
+    # wait for every stage to drain
+    while any(len(stage.consumer.queue) > 0 or stage.consumer.in_flight > 0 for stage, _, _ in stages):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    process_cpu = time.process_time() - process_start
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions = True)
+
+    print(f"{len(records)} frames in {elapsed:.2f}s ({int(len(records) / elapsed)} frames/s), "
+          f"{process_cpu / len(records) * 1e6:.1f} us CPU per frame overall")
+    print(f"{'stage':<18}{'messages':>10}{'msg/s':>10}{'lat p50':>10}{'lat p99':>10}"
+          f"{'lag p50':>10}{'lag p99':>10}{'cpu/msg':>10}")
+    for stage, _, _ in stages:
+        c = stage.consumer
+        busy = (stage.finished or start) - start
+        print(f"{stage.name:<18}{c.handled:>10}{int(c.handled / busy) if busy > 0 else 0:>10}"
+              f"{column(c.latency.percentile(50), 'us')}{column(c.latency.percentile(99), 'us')}"
+              f"{column(c.lag.percentile(50), 'ms')}{column(c.lag.percentile(99), 'ms')}"
+              f"{stage.cpu / max(c.handled, 1) * 1e6:>8.1f}us")
+
+    await connection.close()
+
+if __name__ == "__main__":
+    global args
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, help="capture file from capture.py")
+    parser.add_argument("-s", "--speed", type=float, default=0, help="multiple of real time; 0 for no pacing")
+    parser.add_argument("-n", "--loops", type=int, default=1)
+    parser.add_argument("-b", "--batch-size", type=int, default=50)
+    parser.add_argument("-w", "--batch-window", type=int, default=50, help="milliseconds")
+    parser.add_argument("-m", "--max-in-flight", type=int, default=64)
+    parser.add_argument("--wire", choices=["text", "binary"], default="binary")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("mode_s_router").setLevel(logging.WARNING)
+    asyncio.run(main())
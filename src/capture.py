@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import signal
+import time
+import logging
+
+from katc import batching, capture, transport, utils
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log.addHandler(console)
+
+async def main():
+    with capture.CaptureWriter(args.output) as writer:
+        task = asyncio.create_task(tap_rabbit(writer) if args.rabbit is not None else tap_dump1090(writer))
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        if args.duration is not None:
+            loop.call_later(args.duration, task.cancel)
+
+        try:
+            await task
+        except asyncio.exceptions.CancelledError:
+            ...
+        log.info(f"Captured {writer.count} frames to {args.output}")
+
+async def tap_rabbit(writer):
+    rabbit = await transport.connect(args.rabbit)
+    try:
+        channel = await rabbit.channel()
+        queue = await channel.declare_queue(utils.random_string_with_prefix("capture_"),
+                                            durable = False,
+                                            exclusive = True)
+        await queue.bind("mode_s", "raw")
+        log.info(f"Capturing mode_s to {args.output}")
+
+        async with queue.iterator(no_ack = True) as q:
+            async for message in q:
+                received = time.time_ns()
+                for frame in batching.unpack(message):
+                    writer.write(frame, received)
+    finally:
+        await rabbit.close()
+
+async def tap_dump1090(writer):
+    reader, _ = await asyncio.open_connection(args.target_ip, 30002)
+    log.info(f"Capturing {args.target_ip}:30002 to {args.output}")
+
+    async for line in reader:
+        line = line.rstrip()[1:-1]
+        if len(line) > 0:
+            writer.write(line)
+
+if __name__ == "__main__":
+    global args
+
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-r", "--rabbit", help="tap the mode_s exchange")
+    source.add_argument("-t", "--target-ip", help="read dump1090's port 30002 directly")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--duration", type=float, help="seconds to capture for")
+    args = parser.parse_args()
+
+    asyncio.run(main())
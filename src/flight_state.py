@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import json
+import math
+import time
+import sys
+import daemon
+import logging
+import logging.handlers
+import pyModeS as pms
+
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import consumer, metrics, positions, registrations, shedding, timers, tracklog, transport, wire
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+
+# seconds of silence before an aircraft is reported lost, and the vertical rate (ft/min) that counts as
+# climbing or descending
+LOST_AFTER = 60
+LEVEL_RATE = 300
+
+flights = dict()
+expiry = None
+writer = None
+state_xch = None
+
+CHANGES = metrics.counter("flight_state_changes")
+
+class FlightState:
+    __slots__ = ("icao", "callsign", "positions", "position", "altitude", "speed", "heading", "trend",
+                 "last_seen")
+
+    def __init__(self, icao, receiver):
+        self.icao = icao
+        self.callsign = None
+        self.positions = positions.PositionSolver(receiver)
+        self.position = None
+        self.altitude = math.nan
+        self.speed = math.nan
+        self.heading = math.nan
+        self.trend = None
+        self.last_seen = None
+
+    def as_dict(self):
+        return {"icao": self.icao,
+                "callsign": self.callsign,
+                "position": self.position,
+                "altitude": None if math.isnan(self.altitude) else self.altitude,
+                "speed": None if math.isnan(self.speed) else self.speed,
+                "heading": None if math.isnan(self.heading) else self.heading,
+                "trend": self.trend,
+                "last_seen": self.last_seen}
+
+async def main():
+    global expiry
+    global writer
+    global state_xch
+
+    expiry = timers.ExpiryScheduler(on_lost)
+    writer = tracklog.TrackWriter(args.track_log)
+
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+
+    state_xch = await registrations.Exchanges.FlightStateChanges(channel)
+    adsb_xch = await registrations.Exchanges.ADSB(channel)
+    queue = await channel.declare_queue("flight_state_v2", durable=True,
+                                        arguments=shedding.queue_arguments("flight_state"))
+    await queue.bind(adsb_xch, "#")
+    await shedding.retire_queue(rabbit, "flight_state")
+
+    log.info(f"Writing tracks to {args.track_log}")
+
+    try:
+        await asyncio.gather(consumer.consume(queue, on_adsb, prefetch = args.prefetch,
+                                              shedder = shedding.Shedder("flight_state"),
+                                              stage = "flight_state"),
+                             expiry.run(),
+                             flush_periodically(),
+                             metrics.export(args, channel, "flight_state"))
+    except asyncio.exceptions.CancelledError:
+        ...
+    finally:
+        writer.flush()
+        await rabbit.close()
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(args.flush_interval)
+        writer.flush()
+
+async def publish_change(flight, event):
+    CHANGES.inc()
+    await state_xch.publish(aio_pika.Message(json.dumps(flight.as_dict()).encode(),
+                                             content_type = "application/json",
+                                             headers = {"icao": flight.icao, "event": event}),
+                            f"icao.{flight.icao}.{event}")
+
+async def on_adsb(message):
+    frame = wire.decode(message)
+    icao = frame.icao
+    tc = frame.typecode
+    body = frame.body
+    if tc is None:
+        return
+
+    now = time.time() if frame.timestamp_ns is None else frame.timestamp_ns / 1e9
+    flight = flights.get(icao)
+    if flight is None:
+        flights[icao] = flight = FlightState(icao, args.receiver)
+        await publish_change(flight, "appeared")
+
+    flight.last_seen = now
+    # the scheduler runs on this clock, not the receiver's, which replays and backlogs put in the past
+    expiry.schedule(icao, time.time() + LOST_AFTER)
+
+    if 1 <= tc <= 4:
+        if flight.callsign is None:
+            flight.callsign = pms.adsb.callsign(body).rstrip("_ ")
+            await publish_change(flight, "identified")
+        return
+    elif 9 <= tc <= 18 or 20 <= tc <= 22:
+        flight.position = flight.positions.update(body, now)
+        altitude = pms.adsb.altitude(body)
+        flight.altitude = math.nan if altitude is None else altitude
+        if flight.position is None:
+            return
+    elif tc == 19:
+        velocity = pms.adsb.velocity(body)
+        if velocity is None:
+            return
+
+        speed, heading, vertical_rate, _ = velocity
+        flight.speed = math.nan if speed is None else speed
+        flight.heading = math.nan if heading is None else heading
+        if vertical_rate is not None:
+            trend = "climbing" if vertical_rate > LEVEL_RATE else "descending" if vertical_rate < -LEVEL_RATE else "level"
+            if trend != flight.trend:
+                flight.trend = trend
+                await publish_change(flight, trend)
+    else:
+        return
+
+    lat, lon = flight.position if flight.position is not None else (math.nan, math.nan)
+    if writer.append(now, icao, lat, lon, flight.altitude, flight.speed, flight.heading):
+        writer.flush()
+
+async def on_lost(icao):
+    flight = flights.pop(icao)
+    await publish_change(flight, "lost")
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
+    parser.add_argument("-r", "--rabbit", required=True)
+    parser.add_argument("-t", "--track-log", required=True)
+    parser.add_argument("-l", "--receiver", type=positions.parse_location, default=positions.DEFAULT_RECEIVER,
+                        help="receiver location as LAT,LON")
+    parser.add_argument("--prefetch", type=int, default=1000)
+    parser.add_argument("--flush-interval", type=float, default=5, help="seconds")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
+
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: flight_state.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,298 @@
+import calendar
+import glob
+import numpy as np
+import os
+import pyModeS as pms
+import struct
+import time
+import zlib
+
+from collections import namedtuple
+
+# Recorded ADS-B, one segment file per time partition (an hour by default) named for the UTC time it
+# starts at. A segment is a run of blocks:
+#
+#   header   magic, version, record count, ICAO count, first/last timestamp (ns), compressed size
+#   ICAOs    every aircraft in the block, sorted, as little-endian u4
+#   records  zlib-compressed (timestamp ns, ICAO, typecode, length, frame) in time order
+#
+# so the aircraft in a block and its time span can be read without inflating anything. A retired segment
+# gets an index file next to it with the same information gathered up: a sparse time index of
+# (offset, first, last) per block, and (ICAO, block) pairs sorted by ICAO. Readers memory-map both and
+# inflate only the blocks a query needs, one at a time.
+
+MAGIC = b"KSEG"
+INDEX_MAGIC = b"KIDX"
+VERSION = 1
+BLOCK_HEADER = struct.Struct("<4sHHIIQQI")
+RECORD = struct.Struct("<QIBB")
+INDEX_HEADER = struct.Struct("<4sHHII")
+BLOCKS = np.dtype([("offset", "<u8"), ("first_ns", "<u8"), ("last_ns", "<u8"), ("records", "<u4"),
+                   ("pad", "<u4")])
+ICAOS = np.dtype([("icao", "<u4"), ("block", "<u4")])
+SEGMENT_SUFFIX = ".kseg"
+INDEX_SUFFIX = ".kidx"
+
+Record = namedtuple("Record", ["timestamp_ns", "icao", "typecode", "frame"])
+
+def segment_name(start):
+    return "adsb-" + time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(start)) + SEGMENT_SUFFIX
+
+def segment_start(path):
+    stamp = os.path.basename(path)[len("adsb-"):-len(SEGMENT_SUFFIX)]
+    return calendar.timegm(time.strptime(stamp, "%Y%m%dT%H%M%SZ"))
+
+class Partition:
+    __slots__ = ("start", "path", "records", "blocks", "icaos")
+
+    def __init__(self, start, path):
+        self.start = start
+        self.path = path
+        # frames waiting to be written
+        self.records = []
+        # what the index will hold; None until first written, since the file may already have blocks
+        self.blocks = None
+        self.icaos = None
+
+class ArchiveWriter:
+    # Keeps a buffer and a block list per partition, so frames that straddle a partition boundary out of
+    # order (several receivers, MLAT) don't cut blocks short. A partition is retired, and its index written,
+    # once frames `retire_after` seconds past its end have come in.
+    #
+    # flush() is take() then write(). A service can run write() off its event loop while it goes on
+    # appending, provided only one write() runs at a time.
+    def __init__(self, directory, partition = 3600, block_records = 4096, level = 6, retire_after = 60):
+        self.directory = directory
+        self.partition = partition
+        self.block_records = block_records
+        self.level = level
+        self.retire_after = retire_after
+        self.partitions = dict()
+        self.newest = None
+        os.makedirs(directory, exist_ok = True)
+
+    def __len__(self):
+        return sum(len(partition.records) for partition in self.partitions.values())
+
+    def append(self, timestamp_ns, icao, typecode, frame):
+        # returns True once a block's worth is waiting for flush()
+        seconds = timestamp_ns // 1_000_000_000
+        start = seconds // self.partition * self.partition
+        partition = self.partitions.get(start)
+        if partition is None:
+            # a retired partition comes back for very late frames; its index is written again when it retires
+            partition = self.partitions[start] = Partition(start, os.path.join(self.directory, segment_name(start)))
+        if self.newest is None or seconds > self.newest:
+            self.newest = seconds
+
+        partition.records.append((timestamp_ns, icao, 0xFF if typecode is None else typecode, frame))
+        return len(partition.records) >= self.block_records
+
+    def take(self, everything = False):
+        # [(partition, records, retiring)] for write(): every waiting frame, and which partitions are done
+        taken = []
+        for start, partition in list(self.partitions.items()):
+            retiring = everything or (self.newest is not None and
+                                      start + self.partition + self.retire_after <= self.newest)
+            if len(partition.records) > 0 or retiring:
+                taken.append((partition, partition.records, retiring))
+                partition.records = []
+            if retiring:
+                del self.partitions[start]
+        return taken
+
+    def write(self, taken):
+        # returns the number of blocks written
+        written = 0
+        for partition, records, retiring in taken:
+            records.sort()
+            for first in range(0, len(records), self.block_records):
+                self.write_block(partition, records[first:first + self.block_records])
+                written += 1
+            if retiring and partition.blocks is not None and len(partition.blocks) > 0:
+                write_index(partition.path + INDEX_SUFFIX, partition.blocks, partition.icaos)
+        return written
+
+    def write_block(self, partition, records):
+        if partition.blocks is None:
+            if os.path.exists(partition.path):
+                partition.blocks, partition.icaos = read_headers(partition.path)
+            else:
+                partition.blocks, partition.icaos = [], []
+
+        icaos = np.unique(np.array([record[1] for record in records], dtype = "<u4"))
+        payload = zlib.compress(b"".join(RECORD.pack(timestamp_ns, icao, typecode, len(frame)) + frame
+                                         for timestamp_ns, icao, typecode, frame in records), self.level)
+        header = BLOCK_HEADER.pack(MAGIC, VERSION, 0, len(records), len(icaos), records[0][0], records[-1][0],
+                                   len(payload))
+        with open(partition.path, "ab") as f:
+            offset = f.tell()
+            f.write(header)
+            f.write(icaos.tobytes())
+            f.write(payload)
+
+        partition.icaos.extend((int(icao), len(partition.blocks)) for icao in icaos)
+        partition.blocks.append((offset, records[0][0], records[-1][0], len(records), 0))
+
+    def flush(self):
+        return self.write(self.take())
+
+    def close(self):
+        return self.write(self.take(everything = True))
+
+def write_index(path, blocks, icaos):
+    blocks = np.array(blocks, dtype = BLOCKS)
+    icaos = np.array(icaos, dtype = ICAOS)
+    icaos = icaos[np.lexsort((icaos["block"], icaos["icao"]))]
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION, 0, len(blocks), len(icaos)))
+        f.write(blocks.tobytes())
+        f.write(icaos.tobytes())
+    os.replace(temporary, path)
+
+def read_headers(path):
+    # (blocks, (ICAO, block) pairs) by walking the block headers; a block cut short ends the segment
+    data = np.memmap(path, dtype = np.uint8, mode = "r") if os.path.getsize(path) > 0 else np.zeros(0, np.uint8)
+    blocks = []
+    icaos = []
+    offset = 0
+    while offset + BLOCK_HEADER.size <= len(data):
+        magic, version, _, records, count, first_ns, last_ns, size = BLOCK_HEADER.unpack_from(data, offset)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: bad block header at {offset}")
+        end = offset + BLOCK_HEADER.size + count * 4 + size
+        if end > len(data):
+            break
+        start = offset + BLOCK_HEADER.size
+        icaos.extend((int(icao), len(blocks)) for icao in data[start:start + count * 4].view("<u4"))
+        blocks.append((offset, first_ns, last_ns, records, 0))
+        offset = end
+    return blocks, icaos
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype = np.uint8, mode = "r") if os.path.getsize(path) > 0 else np.zeros(0, np.uint8)
+
+        index_path = path + INDEX_SUFFIX
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+            index = np.memmap(index_path, dtype = np.uint8, mode = "r")
+            magic, version, _, block_count, icao_count = INDEX_HEADER.unpack_from(index, 0)
+            if magic != INDEX_MAGIC or version != VERSION:
+                raise ValueError(f"{index_path}: not a version {VERSION} archive index")
+            position = INDEX_HEADER.size
+            self.blocks = index[position:position + block_count * BLOCKS.itemsize].view(BLOCKS)
+            position += block_count * BLOCKS.itemsize
+            self.icaos = index[position:position + icao_count * ICAOS.itemsize].view(ICAOS)
+        else:
+            # still being written, or written before it was cut short
+            blocks, icaos = read_headers(path)
+            self.blocks = np.array(blocks, dtype = BLOCKS)
+            icaos = np.array(icaos, dtype = ICAOS)
+            self.icaos = icaos[np.lexsort((icaos["block"], icaos["icao"]))]
+
+    def block_range(self, start_ns = None, end_ns = None):
+        # indexes of the blocks that may hold records in [start_ns, end_ns]
+        keep = np.ones(len(self.blocks), dtype = bool)
+        if start_ns is not None:
+            keep &= self.blocks["last_ns"] >= start_ns
+        if end_ns is not None:
+            keep &= self.blocks["first_ns"] <= end_ns
+        return np.flatnonzero(keep)
+
+    def blocks_for(self, icao):
+        first = np.searchsorted(self.icaos["icao"], icao, side = "left")
+        last = np.searchsorted(self.icaos["icao"], icao, side = "right")
+        return self.icaos["block"][first:last]
+
+    def block_icaos(self, block):
+        offset = int(self.blocks["offset"][block])
+        count = BLOCK_HEADER.unpack_from(self.data, offset)[4]
+        start = offset + BLOCK_HEADER.size
+        return self.data[start:start + count * 4].view("<u4")
+
+    def records(self, block):
+        offset = int(self.blocks["offset"][block])
+        _, _, _, records, count, _, _, size = BLOCK_HEADER.unpack_from(self.data, offset)
+        start = offset + BLOCK_HEADER.size + count * 4
+        payload = zlib.decompress(self.data[start:start + size])
+
+        position = 0
+        for _ in range(records):
+            timestamp_ns, icao, typecode, length = RECORD.unpack_from(payload, position)
+            position += RECORD.size
+            yield Record(timestamp_ns, icao, None if typecode == 0xFF else typecode,
+                         payload[position:position + length])
+            position += length
+
+class Archive:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self, start = None, end = None):
+        # segments that may overlap [start, end] (seconds), oldest first
+        paths = sorted(glob.glob(os.path.join(self.directory, "adsb-*" + SEGMENT_SUFFIX)))
+        starts = [segment_start(path) for path in paths]
+        for i, path in enumerate(paths):
+            # a segment ends no later than the next one starts
+            if end is not None and starts[i] > end:
+                break
+            if start is not None and i + 1 < len(paths) and starts[i + 1] <= start:
+                continue
+            yield Segment(path)
+
+    def frames(self, start = None, end = None, icao = None):
+        # Records in [start, end] (seconds), for one aircraft or all of them, a block at a time
+        start_ns = None if start is None else int(start * 1e9)
+        end_ns = None if end is None else int(end * 1e9)
+        wanted = None if icao is None else int(icao, 16)
+        for segment in self.segments(start, end):
+            blocks = segment.block_range(start_ns, end_ns)
+            if wanted is not None:
+                blocks = np.intersect1d(blocks, segment.blocks_for(wanted))
+            for block in blocks:
+                for record in segment.records(block):
+                    if wanted is not None and record.icao != wanted:
+                        continue
+                    if (start_ns is not None and record.timestamp_ns < start_ns) or \
+                       (end_ns is not None and record.timestamp_ns > end_ns):
+                        continue
+                    yield record
+
+    def aircraft(self, start = None, end = None):
+        # {ICAO: (first seen ns, last seen ns)} for [start, end], the times to within a block. Blocks
+        # entirely inside the range are answered from their ICAO lists; only the ones at its edges are inflated.
+        start_ns = None if start is None else int(start * 1e9)
+        end_ns = None if end is None else int(end * 1e9)
+        seen = dict()
+
+        def saw(icao, first_ns, last_ns):
+            current = seen.get(icao)
+            seen[icao] = (first_ns, last_ns) if current is None else (min(current[0], first_ns),
+                                                                    max(current[1], last_ns))
+
+        for segment in self.segments(start, end):
+            for block in segment.block_range(start_ns, end_ns):
+                first_ns, last_ns = int(segment.blocks["first_ns"][block]), int(segment.blocks["last_ns"][block])
+                if (start_ns is None or first_ns >= start_ns) and (end_ns is None or last_ns <= end_ns):
+                    for icao in segment.block_icaos(block):
+                        saw(int(icao), first_ns, last_ns)
+                    continue
+                for record in segment.records(block):
+                    if (start_ns is None or record.timestamp_ns >= start_ns) and \
+                       (end_ns is None or record.timestamp_ns <= end_ns):
+                        saw(record.icao, record.timestamp_ns, record.timestamp_ns)
+
+        return {"%06X" % icao: times for icao, times in seen.items()}
+
+    def callsigns(self, icao, start = None, end = None):
+        # (timestamp ns, callsign) every time the aircraft's identification changed
+        last = None
+        for record in self.frames(start, end, icao):
+            if record.typecode is None or not 1 <= record.typecode <= 4:
+                continue
+            callsign = pms.adsb.callsign(record.frame.hex().upper()).rstrip("_ ")
+            if callsign != last:
+                last = callsign
+                yield record.timestamp_ns, callsign
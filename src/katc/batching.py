@@ -0,0 +1,132 @@
+import aio_pika
+import asyncio
+import logging
+import struct
+import time
+
+from katc import metrics, wire
+
+log = logging.getLogger(__name__)
+
+# Header naming how a mode_s message body is framed. Messages without it carry a single frame.
+BATCH_HEADER = "batch"
+NEWLINE_FORMAT = "newline"
+# raw frames from a Beast feed, each behind a BEAST_RECORD: receive time, 12 MHz MLAT counter, signal
+# level and frame length
+BEAST_FORMAT = "beast"
+BEAST_RECORD = struct.Struct("<QQBB")
+# the receiver every frame in the message came from, when there's more than one
+SOURCE_HEADER = "source"
+
+def beast_record(timestamp_ns, mlat, signal, raw):
+    return BEAST_RECORD.pack(timestamp_ns, mlat, signal, len(raw)) + raw
+
+def pack(frames, timestamp_ns = None, batch_format = NEWLINE_FORMAT, source = None):
+    if timestamp_ns is None:
+        timestamp_ns = time.time_ns()
+    timestamp = timestamp_ns / 1e9
+    headers = {wire.TIMESTAMP_HEADER: timestamp_ns}
+    if source is not None:
+        headers[SOURCE_HEADER] = source
+
+    if batch_format == BEAST_FORMAT:
+        return aio_pika.Message(body = b"".join(frames),
+                                timestamp = timestamp,
+                                headers = headers | {BATCH_HEADER: BEAST_FORMAT})
+    elif len(frames) == 1:
+        return aio_pika.Message(body = frames[0], timestamp = timestamp, headers = headers)
+
+    return aio_pika.Message(body = b"\n".join(frames),
+                            timestamp = timestamp,
+                            headers = headers | {BATCH_HEADER: NEWLINE_FORMAT})
+
+def unpack(message):
+    headers = message.headers or {}
+    batch_format = headers.get(BATCH_HEADER)
+    if batch_format is None:
+        return [message.body]
+    elif batch_format == NEWLINE_FORMAT:
+        return message.body.split(b"\n")
+    elif batch_format == BEAST_FORMAT:
+        return [raw.hex().upper().encode() for _, _, _, raw in beast_records(message)]
+
+    raise ValueError(f"Unknown batch format {batch_format}")
+
+def beast_records(message):
+    # (timestamp_ns, mlat, signal, raw) per frame of a Beast batch
+    body = message.body
+    records = []
+    offset = 0
+    while offset < len(body):
+        timestamp_ns, mlat, signal, length = BEAST_RECORD.unpack_from(body, offset)
+        offset += BEAST_RECORD.size
+        records.append((timestamp_ns, mlat, signal, body[offset:offset + length]))
+        offset += length
+    return records
+
+def receive_details(message):
+    # per-frame (receive time, MLAT counter, signal level), for batches that have them
+    if (message.headers or {}).get(BATCH_HEADER) != BEAST_FORMAT:
+        return None
+    return [(timestamp_ns, mlat, signal) for timestamp_ns, mlat, signal, _ in beast_records(message)]
+
+class Batcher:
+    def __init__(self, exchange, size, window, max_in_flight, batch_format = NEWLINE_FORMAT, source = None):
+        self.exchange = exchange
+        self.batch_format = batch_format
+        self.source = source
+        self.size = size
+        self.window = window
+        self.frames = []
+        self.first_frame_ns = None
+        self.flusher = None
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.publishes = set()
+        self.published = metrics.counter("batches_published", exchange = exchange.name)
+        self.publish_time = metrics.histogram("publish_seconds", exchange = exchange.name)
+
+    async def add(self, frame):
+        if len(self.frames) == 0:
+            self.first_frame_ns = time.time_ns()
+        self.frames.append(frame)
+
+        if len(self.frames) >= self.size:
+            await self.flush()
+        elif self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+
+        if len(self.frames) == 0:
+            return
+
+        message = pack(self.frames, self.first_frame_ns, self.batch_format, self.source)
+        self.frames = []
+
+        # a slow broker stalls the reader here instead of queueing publishes without bound
+        await self.in_flight.acquire()
+        publish = asyncio.create_task(self.exchange.publish(message, routing_key = 'raw'))
+        self.publishes.add(publish)
+        started = time.perf_counter()
+        publish.add_done_callback(lambda publish: self.on_published(publish, started))
+
+    def on_published(self, publish, started):
+        self.publishes.discard(publish)
+        self.in_flight.release()
+        if not publish.cancelled() and publish.exception() is not None:
+            log.error(f"Failed to publish batch: {publish.exception()}")
+        else:
+            self.published.inc()
+            self.publish_time.record(time.perf_counter() - started)
+
+    async def close(self):
+        await self.flush()
+        await asyncio.gather(*self.publishes, return_exceptions = True)
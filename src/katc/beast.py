@@ -0,0 +1,149 @@
+import asyncio
+import socket
+import time
+
+# dump1090's Beast output (port 30005). Each frame is
+#
+#   0x1A, type, 6-byte big-endian 12 MHz MLAT counter, 1-byte signal level, payload
+#
+# with any 0x1A inside the frame sent twice. Frames are parsed straight out of one reusable receive buffer;
+# a frame without escapes is handed out as a memoryview into it, so nothing is copied until the caller
+# builds its message.
+
+ESCAPE = 0x1A
+PAYLOAD_LENGTHS = {0x31: 2,     # Mode A/C
+                   0x32: 7,     # Mode S short
+                   0x33: 14}    # Mode S long
+MLAT_HZ = 12_000_000
+BUFFER_SIZE = 1 << 16
+MIN_READ = 4096
+
+class MlatClock:
+    # Maps the receiver's free-running MLAT counter onto wall-clock time. The anchor is the frame that
+    # reached us with the least delay seen so far, so later estimates are as close to the actual receive
+    # time as the network allows; it moves whenever the two clocks drift more than max_drift apart.
+    def __init__(self, max_drift = 0.25):
+        self.max_drift_ns = int(max_drift * 1e9)
+        self.anchor_mlat = None
+        self.anchor_ns = None
+
+    def to_ns(self, mlat, now_ns):
+        if mlat == 0:
+            # synthesized frames, e.g. from a receiver without a counter
+            return now_ns
+
+        if self.anchor_mlat is not None:
+            estimate = self.anchor_ns + (mlat - self.anchor_mlat) * 1_000_000_000 // MLAT_HZ
+            if 0 <= now_ns - estimate <= self.max_drift_ns:
+                return estimate
+
+        self.anchor_mlat = mlat
+        self.anchor_ns = now_ns
+        return now_ns
+
+class BeastParser:
+    def __init__(self, size = BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.resyncs = 0
+
+    def free(self):
+        # where the next read should land. What's left unparsed is at most a partial frame, so moving it
+        # back to the front is cheap.
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < MIN_READ:
+            remaining = bytes(self.view[self.start:self.end])
+            self.buffer[:len(remaining)] = remaining
+            self.start, self.end = 0, len(remaining)
+        return self.view[self.end:]
+
+    def filled(self, count):
+        self.end += count
+
+    def frames(self):
+        # yields (type, mlat, signal, payload) for every complete frame in the buffer. The payload may be a
+        # view into the buffer, so it is only good until the next read.
+        buffer = self.buffer
+        view = self.view
+        while True:
+            i = buffer.find(ESCAPE, self.start, self.end)
+            if i < 0:
+                self.start = self.end
+                return
+            if i + 2 > self.end:
+                self.start = i
+                return
+
+            kind = buffer[i + 1]
+            length = PAYLOAD_LENGTHS.get(kind)
+            if length is None:
+                # an escaped 0x1A, a status frame or garbage; look for the next frame start
+                self.start = i + 2 if kind == ESCAPE else i + 1
+                self.resyncs += kind != ESCAPE
+                continue
+
+            frame_end = i + 9 + length
+            if frame_end > self.end:
+                self.start = i
+                return
+
+            if buffer.find(ESCAPE, i + 2, frame_end) < 0:
+                body = view[i + 2:frame_end]
+                self.start = frame_end
+            else:
+                body, next_start = self.unescape(i + 2, 7 + length)
+                if body is None:
+                    self.start = i
+                    return
+                self.start = next_start
+                if body is False:
+                    self.resyncs += 1
+                    continue
+
+            yield kind, int.from_bytes(body[0:6], "big"), body[6], body[7:]
+
+    def unescape(self, start, count):
+        # (bytes, end) for a frame with doubled 0x1As in it; (None, _) if it isn't all here yet, and
+        # (False, where the next frame starts) if a new frame began in the middle of it
+        buffer = self.buffer
+        body = bytearray()
+        i = start
+        while len(body) < count:
+            if i >= self.end:
+                return None, start
+            if buffer[i] == ESCAPE:
+                if i + 1 >= self.end:
+                    return None, start
+                if buffer[i + 1] != ESCAPE:
+                    return False, i
+                i += 1
+            body.append(buffer[i])
+            i += 1
+        return body, i
+
+async def read_frames(host, port, on_frame, clock = None):
+    # calls on_frame(timestamp_ns, mlat, signal, payload) for every Mode S frame until the connection closes
+    clock = MlatClock() if clock is None else clock
+    loop = asyncio.get_running_loop()
+    parser = BeastParser()
+
+    family, type, proto, _, address = (await loop.getaddrinfo(host, port, type = socket.SOCK_STREAM))[0]
+    sock = socket.socket(family, type, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+        while True:
+            count = await loop.sock_recv_into(sock, parser.free())
+            if count == 0:
+                return
+            parser.filled(count)
+
+            now_ns = time.time_ns()
+            for kind, mlat, signal, payload in parser.frames():
+                if kind != 0x31:
+                    await on_frame(clock.to_ns(mlat, now_ns), mlat, signal, payload)
+    finally:
+        sock.close()
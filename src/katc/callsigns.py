@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# An empty callsign means "asked, and nobody knows yet"; it's cached too, just not for as long.
+UNKNOWN = ""
+
+class CallsignCache:
+    def __init__(self, max_size = 10000, ttl = 6 * 3600, negative_ttl = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, icao):
+        # the callsign, UNKNOWN if a recent lookup came up empty, or None if we have to ask
+        entry = self.entries.get(icao)
+        if entry is None:
+            return None
+
+        callsign, expires = entry
+        if expires <= time.monotonic():
+            del self.entries[icao]
+            return None
+
+        self.entries.move_to_end(icao)
+        return callsign
+
+    def put(self, icao, callsign):
+        if callsign == UNKNOWN:
+            entry = self.entries.get(icao)
+            if entry is not None and entry[0] != UNKNOWN and entry[1] > time.monotonic():
+                # an empty answer doesn't mean a callsign we already know is wrong
+                return
+        ttl = self.negative_ttl if callsign == UNKNOWN else self.ttl
+        self.entries[icao] = (callsign, time.monotonic() + ttl)
+        self.entries.move_to_end(icao)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+class BulkResolver:
+    # Collects lookups for a short window and resolves them with one fetch(icaos) -> {icao: callsign} call.
+    # Concurrent lookups of the same ICAO share a single future.
+    def __init__(self, cache, fetch, window = 0.02, max_batch = 200):
+        self.cache = cache
+        self.fetch = fetch
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = dict()
+        self.queued = []
+        self.flusher = None
+        self.flushes = set()
+
+    def resolve(self, icao):
+        future = self.pending.get(icao)
+        if future is not None:
+            return future
+
+        self.pending[icao] = future = asyncio.get_running_loop().create_future()
+        self.queued.append(icao)
+        if len(self.queued) >= self.max_batch:
+            flush = asyncio.create_task(self.flush())
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+        elif self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_later())
+        return future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flusher = None
+        await self.flush()
+
+    async def flush(self):
+        icaos, self.queued = self.queued, []
+        if len(icaos) == 0:
+            return
+
+        try:
+            callsigns = await self.fetch(icaos)
+        except Exception as x:
+            # leave the cache alone so the next message asks again
+            log.warning(f"Failed to resolve {len(icaos)} callsigns: {x}")
+            callsigns = dict()
+
+        for icao in icaos:
+            callsign = callsigns.get(icao)
+            if callsign is not None:
+                self.cache.put(icao, callsign)
+            self.pending.pop(icao).set_result(callsign)
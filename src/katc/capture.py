@@ -0,0 +1,74 @@
+import asyncio
+import struct
+import time
+
+# Capture files are a header followed by one record per frame: the nanosecond wall-clock time it was
+# received, its length, then the frame exactly as it came off the feed (hex, without dump1090's * and ;).
+
+MAGIC = b"KCAP"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")
+RECORD = struct.Struct("<QH")
+
+# at full speed, frames handed over between chances for consumers on the same loop to run
+YIELD_EVERY = 256
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0))
+        self.count = 0
+
+    def write(self, frame, timestamp_ns = None):
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        self.file.write(RECORD.pack(timestamp_ns, len(frame)))
+        self.file.write(frame)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_capture(path):
+    # yields (timestamp_ns, frame) as it reads them; a record cut short by an interrupted capture ends the file
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path}: not a version {VERSION} capture")
+        magic, version, _ = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a version {VERSION} capture")
+
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp_ns, length = RECORD.unpack(record)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp_ns, frame
+
+async def replay(records, add, speed = 1):
+    # calls add(frame) for each record, spaced like the capture but `speed` times faster; 0 means no pacing
+    start = None
+    for count, (timestamp_ns, frame) in enumerate(records):
+        if speed > 0:
+            if start is None:
+                start = (timestamp_ns, time.perf_counter())
+            delay = start[1] + (timestamp_ns - start[0]) / 1e9 / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % YIELD_EVERY == 0:
+            await asyncio.sleep(0)
+
+        await add(frame)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+
+from collections import deque
+
+from katc import metrics, wire
+
+log = logging.getLogger(__name__)
+
+def by_icao(message):
+    return wire.decode(message).icao
+
+def sent_at(message):
+    sent = wire.sent_ns(message)
+    return None if sent is None else sent / 1e9
+
+class Consumer:
+    # Runs on_message for up to `concurrency` messages at once. Messages with the same key (by_icao, say)
+    # always go to the same lane, so each aircraft is still handled in order. Acks are deferred and sent
+    # with multiple=True once `ack_batch` contiguous deliveries are done or `ack_interval` passes, which
+    # means an acking consumer should have its channel to itself. A shedding.Shedder lets it skip messages
+    # once it falls behind; skipped messages are acked like handled ones. Metrics are labelled with `stage`,
+    # which defaults to the queue's name; consumers of randomly named queues should give a stable one.
+    def __init__(self, queue, on_message, no_ack = False, prefetch = 100, concurrency = 1, key = None,
+                 ack_batch = 50, ack_interval = 0.05, shedder = None, stage = None):
+        self.queue = queue
+        self.stage = queue.name if stage is None else stage
+        self.on_message = on_message
+        self.no_ack = no_ack
+        self.prefetch = prefetch
+        self.key = key
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval
+        self.shedder = shedder
+        # messages taken off the queue but not yet handled, by the shedder's coalescing key
+        self.waiting = dict()
+        self.lanes = [asyncio.Queue() for _ in range(concurrency)]
+        self.unacked = deque()
+        self.done = set()
+        self.rejected = set()
+        self.ackable = None
+        self.ackable_count = 0
+        self.flushes = set()
+
+        self.in_flight = 0
+        self.handled = 0
+        self.failed = 0
+        self.shed = 0
+        self.lag = metrics.histogram("consume_lag_seconds", stage = self.stage)
+        self.latency = metrics.histogram("handle_seconds", stage = self.stage)
+        self.failures = metrics.counter("handler_failures", stage = self.stage)
+
+    def stats(self):
+        return {"stage": self.stage,
+                "queue": self.queue.name,
+                "in_flight": self.in_flight,
+                "handled": self.handled,
+                "failed": self.failed,
+                "shed": self.shed,
+                "lag_p50": self.lag.percentile(50),
+                "lag_p99": self.lag.percentile(99),
+                "latency_p99": self.latency.percentile(99)}
+
+    async def run(self):
+        if not self.no_ack:
+            await self.queue.channel.set_qos(prefetch_count = self.prefetch)
+        tasks = [asyncio.create_task(self.receive())]
+        tasks += [asyncio.create_task(self.work(lane)) for lane in self.lanes]
+        if not self.no_ack:
+            tasks.append(asyncio.create_task(self.ack_periodically()))
+
+        try:
+            # the queue running dry ends the consumer, and so does a lane dying, rather than leaving its messages
+            # to pile up
+            done, _ = await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            await asyncio.gather(*self.flushes, return_exceptions = True)
+            await self.flush_acks()
+
+    async def receive(self):
+        async with self.queue.iterator(no_ack = self.no_ack) as q:
+            async for message in q:
+                self.in_flight += 1
+                if not self.no_ack:
+                    self.unacked.append(message)
+                if self.shedder is not None:
+                    shed_key = self.shedder.key(message)
+                    if shed_key is not None:
+                        self.waiting[shed_key] = self.waiting.get(shed_key, 0) + 1
+
+                if len(self.lanes) == 1:
+                    lane = self.lanes[0]
+                else:
+                    lane = self.lanes[hash(self.key(message)) % len(self.lanes)]
+                await lane.put(message)
+
+    async def work(self, lane):
+        while True:
+            message = await lane.get()
+            started = time.time()
+            sent = sent_at(message)
+            if sent is not None:
+                self.lag.record(started - sent)
+
+            if self.shedder is not None and not self.admit(message, started, sent):
+                self.shed += 1
+                self.in_flight -= 1
+                if not self.no_ack:
+                    self.complete(message)
+                continue
+
+            rejected = False
+            try:
+                await self.on_message(message)
+                self.handled += 1
+            except Exception as x:
+                self.failed += 1
+                self.failures.inc()
+                log.error(f"Failed to handle message from {self.queue.name}: {x}")
+                if not self.no_ack:
+                    try:
+                        await message.reject()
+                        rejected = True
+                    except Exception as x:
+                        # still unsettled, so the next multiple ack covers it
+                        log.error(f"Failed to reject message from {self.queue.name}: {x}")
+
+            self.latency.record(time.time() - started)
+            self.in_flight -= 1
+            if not self.no_ack:
+                self.complete(message, rejected)
+
+    def admit(self, message, started, sent):
+        # superseded if a newer message with the same key is already waiting behind this one
+        shed_key = self.shedder.key(message)
+        superseded = False
+        if shed_key is not None:
+            waiting = self.waiting.pop(shed_key) - 1
+            if waiting > 0:
+                self.waiting[shed_key] = waiting
+                superseded = True
+
+        if sent is not None:
+            self.shedder.update(started - sent)
+        return self.shedder.admit(message, superseded)
+
+    def complete(self, message, rejected = False):
+        # only the oldest deliveries can be covered by a multiple ack, so wait for any stragglers. A rejected
+        # delivery is already settled and can't be the tag a multiple ack names, since the broker would
+        # close the channel over it; one named after it covers the rest around it just fine.
+        self.done.add(message.delivery_tag)
+        if rejected:
+            self.rejected.add(message.delivery_tag)
+        while len(self.unacked) > 0 and self.unacked[0].delivery_tag in self.done:
+            delivered = self.unacked.popleft()
+            self.done.discard(delivered.delivery_tag)
+            if delivered.delivery_tag in self.rejected:
+                self.rejected.discard(delivered.delivery_tag)
+                continue
+            self.ackable = delivered
+            self.ackable_count += 1
+
+        if self.ackable_count >= self.ack_batch:
+            flush = asyncio.ensure_future(self.flush_acks())
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+
+    async def ack_periodically(self):
+        while True:
+            await asyncio.sleep(self.ack_interval)
+            await self.flush_acks()
+
+    async def flush_acks(self):
+        if self.ackable is None:
+            return
+
+        message, self.ackable, self.ackable_count = self.ackable, None, 0
+        try:
+            # straight to the channel: one ack for every delivery up to this one
+            await message.channel.basic_ack(delivery_tag = message.delivery_tag, multiple = True)
+        except Exception as x:
+            log.error(f"Failed to ack {self.queue.name} up to {message.delivery_tag}: {x}")
+
+async def consume(queue, on_message, **kwargs):
+    await Consumer(queue, on_message, **kwargs).run()
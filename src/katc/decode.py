@@ -0,0 +1,189 @@
+import math
+import numpy as np
+
+# Batch decoding of raw Mode S hex frames. Every field is computed column-wise over the whole batch;
+# missing values are -1 for integer fields and NaN for float fields, matching pyModeS' None.
+
+CRC_GENERATOR = 0xFFF409
+ICAO_FROM_PARITY = (0, 4, 5, 16, 20, 21)
+CALLSIGN_CHARS = np.frombuffer(b"#ABCDEFGHIJKLMNOPQRSTUVWXYZ#####_###############0123456789######", dtype=np.uint8)
+
+def _nibble_table():
+    table = np.full(256, 0xFF, dtype=np.uint8)
+    for i, c in enumerate(b"0123456789ABCDEF"):
+        table[c] = i
+    for i, c in enumerate(b"abcdef"):
+        table[c] = 10 + i
+    return table
+
+def _crc_table():
+    table = np.zeros(256, dtype=np.uint32)
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc = (crc << 1) ^ CRC_GENERATOR if crc & 0x800000 else crc << 1
+        table[byte] = crc & 0xFFFFFF
+    return table
+
+NIBBLES = _nibble_table()
+CRC_TABLE = _crc_table()
+
+# NumPy's SIMD arctan2 can differ from libm in the last ulp, and tracks have to match pyModeS exactly
+atan2 = np.frompyfunc(math.atan2, 2, 1)
+
+class DecodedBatch:
+    __slots__ = ("frames", "lengths", "data", "valid", "df", "crc", "icao", "tc", "oe",
+                 "lat_cpr", "lon_cpr", "altitude", "callsign_chars",
+                 "speed", "heading", "vertical_rate")
+
+    def __len__(self):
+        return len(self.frames)
+
+    def raw_at(self, i):
+        return self.data[i, :self.lengths[i] // 2].tobytes()
+
+    def icao_at(self, i):
+        return None if self.icao[i] < 0 else "%06X" % self.icao[i]
+
+    def typecode_at(self, i):
+        return None if self.tc[i] < 0 else int(self.tc[i])
+
+    def altitude_at(self, i):
+        alt = self.altitude[i]
+        if np.isnan(alt):
+            return None
+        return float(alt) if 20 <= self.tc[i] <= 22 else int(alt)
+
+    def callsign_at(self, i):
+        return self.callsign_chars[i].tobytes().decode().replace("#", "")
+
+    def velocity_at(self, i):
+        speed = None if np.isnan(self.speed[i]) else int(self.speed[i])
+        heading = None if np.isnan(self.heading[i]) else float(self.heading[i])
+        vertical_rate = None if np.isnan(self.vertical_rate[i]) else int(self.vertical_rate[i])
+        return speed, heading, vertical_rate
+
+def _bits(me, start, end):
+    return ((me >> np.uint64(56 - end)) & np.uint64((1 << (end - start)) - 1)).astype(np.int64)
+
+def _gray_to_int(gray):
+    num = gray.copy()
+    for shift in (8, 4, 2, 1):
+        num ^= num >> shift
+    return num
+
+def _crc(data, columns):
+    crc = np.zeros(len(data), dtype=np.uint32)
+    for column in range(columns):
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC_TABLE[((crc >> 16) ^ data[:, column]) & 0xFF]
+    return crc
+
+def _airborne_altitude(me, tc):
+    altbin = _bits(me, 8, 20)
+    q = (altbin >> 4) & 1
+
+    # 25 ft steps: the 12-bit field minus the Q bit
+    alt25 = (((altbin >> 5) << 4) | (altbin & 0xF)) * 25 - 1000
+
+    # 100 ft steps: Gillham gray code, laid out as C1 A1 C2 A2 C4 A4 B1 Q B2 D2 B4 D4
+    bit = lambda n: (altbin >> (11 - n)) & 1
+    c1, a1, c2, a2, c4, a4, b1, b2, d2, b4, d4 = (bit(n) for n in (0, 1, 2, 3, 4, 5, 6, 8, 9, 10, 11))
+    n500 = _gray_to_int((d2 << 7) | (d4 << 6) | (a1 << 5) | (a2 << 4) | (a4 << 3) | (b1 << 2) | (b2 << 1) | b4)
+    n100 = _gray_to_int((c1 << 2) | (c2 << 1) | c4)
+    gray_valid = (n100 != 0) & (n100 != 5) & (n100 != 6)
+    n100 = np.where(n100 == 7, 5, n100)
+    n100 = np.where(n500 % 2 == 1, 6 - n100, n100)
+    alt100 = n500 * 500 + n100 * 100 - 1300
+
+    altitude = np.where(q == 1, alt25, alt100).astype(np.float64)
+    altitude[(altbin == 0) | ((q == 0) & ~gray_valid)] = np.nan
+
+    gnss = (tc >= 20) & (tc <= 22)
+    altitude[gnss] = altbin[gnss] * 3.28084
+
+    altitude[(tc >= 5) & (tc <= 8)] = 0
+    altitude[(tc < 5) | (tc == 19) | (tc > 22)] = np.nan
+    return altitude
+
+def _airborne_velocity(me, tc):
+    subtype = _bits(me, 5, 8)
+    ew_raw = _bits(me, 14, 24)
+    ns_raw = _bits(me, 25, 35)
+    ew_sign = np.where(_bits(me, 13, 14) == 1, -1, 1)
+    ns_sign = np.where(_bits(me, 24, 25) == 1, -1, 1)
+    supersonic = np.where((subtype == 2) | (subtype == 4), 4, 1)
+
+    # subtypes 1/2: ground speed and track from the east-west and north-south components
+    v_we = ew_sign * (ew_raw - 1) * supersonic
+    v_sn = ns_sign * (ns_raw - 1) * supersonic
+    ground = (subtype == 1) | (subtype == 2)
+    ground_speed = np.floor(np.sqrt(v_sn * v_sn + v_we * v_we))
+    track = np.zeros(len(me))
+    moving = ground & (tc == 19)
+    track[moving] = np.degrees(atan2(v_we[moving], v_sn[moving]).astype(np.float64))
+    track = np.where(track >= 0, track, track + 360)
+
+    # subtypes 3/4: airspeed and magnetic heading
+    heading = np.where(_bits(me, 13, 14) == 1, ew_raw / 1024 * 360.0, np.nan)
+    airspeed = (ns_raw - 1) * supersonic
+
+    speed = np.where(ground, ground_speed, airspeed).astype(np.float64)
+    heading = np.where(ground, track, heading)
+
+    vr = _bits(me, 37, 46)
+    vertical_rate = np.where(_bits(me, 36, 37) == 1, -1, 1) * (vr - 1) * 64.0
+    vertical_rate[vr == 0] = np.nan
+
+    missing = (tc != 19) | (ew_raw == 0) | (ns_raw == 0)
+    speed[missing] = np.nan
+    heading[missing] = np.nan
+    vertical_rate[missing] = np.nan
+    return speed, heading, vertical_rate
+
+def decode_frames(frames):
+    batch = DecodedBatch()
+    batch.frames = frames
+
+    batch.lengths = lengths = np.fromiter(map(len, frames), dtype=np.int64, count=len(frames))
+    chars = np.array(frames, dtype="S28").view(np.uint8).reshape(len(frames), 28)
+    nibbles = NIBBLES[chars]
+    in_frame = np.arange(28) < lengths[:, None]
+    batch.valid = (((lengths == 14) | (lengths == 28))
+                   & ~((nibbles == 0xFF) & in_frame).any(axis=1))
+
+    nibbles[nibbles == 0xFF] = 0
+    batch.data = data = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+    long = lengths == 28
+
+    batch.df = np.minimum(data[:, 0] >> 3, 24).astype(np.int64)
+
+    # remainder of the data bytes under the Mode S generator, XORed with the parity field
+    short_crc = _crc(data, 4) ^ ((data[:, 4].astype(np.uint32) << 16) | (data[:, 5].astype(np.uint32) << 8) | data[:, 6])
+    long_crc = _crc(data, 11) ^ ((data[:, 11].astype(np.uint32) << 16) | (data[:, 12].astype(np.uint32) << 8) | data[:, 13])
+    batch.crc = np.where(long, long_crc, short_crc).astype(np.int64)
+
+    address = (data[:, 1].astype(np.int64) << 16) | (data[:, 2].astype(np.int64) << 8) | data[:, 3]
+    batch.icao = np.where(np.isin(batch.df, (11, 17, 18)), address,
+                          np.where(np.isin(batch.df, ICAO_FROM_PARITY), batch.crc, -1))
+
+    adsb = (batch.df == 17) | (batch.df == 18)
+    batch.tc = np.where(adsb, data[:, 4].astype(np.int64) >> 3, -1)
+
+    me = np.zeros(len(frames), dtype=np.uint64)
+    for column in range(4, 11):
+        me = (me << np.uint64(8)) | data[:, column].astype(np.uint64)
+
+    batch.oe = _bits(me, 21, 22)
+    batch.lat_cpr = _bits(me, 22, 39)
+    batch.lon_cpr = _bits(me, 39, 56)
+    batch.altitude = _airborne_altitude(me, batch.tc)
+
+    callsign_codes = np.stack([_bits(me, start, start + 6) for start in range(8, 56, 6)], axis=1)
+    batch.callsign_chars = CALLSIGN_CHARS[callsign_codes]
+
+    batch.speed, batch.heading, batch.vertical_rate = _airborne_velocity(me, batch.tc)
+
+    invalid = ~batch.valid
+    batch.icao[invalid] = -1
+    batch.tc[invalid] = -1
+    return batch
@@ -0,0 +1,29 @@
+import time
+
+class Deduplicator:
+    # Remembers frames for between one and two windows, in two sets: the current time bucket and the one
+    # before it. Moving to a new bucket drops the older set whole instead of expiring frames one by one.
+    def __init__(self, window = 0.5):
+        self.window = window
+        self.bucket = None
+        self.current = set()
+        self.previous = set()
+        self.duplicates = 0
+
+    def seen(self, frame, now = None):
+        # True if the same frame already came in within the window; otherwise remembers it
+        bucket = int((time.monotonic() if now is None else now) / self.window)
+        if bucket != self.bucket:
+            if self.bucket is not None and bucket == self.bucket + 1:
+                self.previous = self.current
+            else:
+                self.previous = set()
+            self.current = set()
+            self.bucket = bucket
+
+        if frame in self.current or frame in self.previous:
+            self.duplicates += 1
+            return True
+
+        self.current.add(frame)
+        return False
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+
+from katc import decode, metrics, transport
+
+log = logging.getLogger(__name__)
+
+# Cheap checks that throw a frame away at ingest rather than after a trip through the broker:
+#
+#   malformed     not hex, or not the length its DF calls for
+#   crc           DF 11/17/18 whose parity doesn't check out
+#   unknown_icao  address/parity replies whose CRC-derived address hasn't sent a good DF 11/17/18 lately,
+#                 which is how dump1090 itself tells a real reply from noise; only with known_only, since
+#                 it also drops aircraft that only ever answer Mode S surveillance
+#   downlink      a DF nothing downstream listens to
+#
+# Frames are checked one at a time, since ingest batches are often a single frame and a NumPy batch
+# costs more than that to set up.
+
+CRC_TABLE = [int(crc) for crc in decode.CRC_TABLE]
+LONG_DOWNLINKS = (16, 17, 18, 19, 20, 21, 22, 24)
+REASONS = ("malformed", "crc", "unknown_icao", "downlink")
+# the router's catch-all queue, which keeps nothing
+DROP_QUEUE = "mode_s_by_downlink_default"
+
+def remainder(raw):
+    crc = 0
+    for byte in raw[:-3]:
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC_TABLE[((crc >> 16) ^ byte) & 0xFF]
+    return crc ^ ((raw[-3] << 16) | (raw[-2] << 8) | raw[-1])
+
+class FrameFilter:
+    def __init__(self, downlinks = None, known_only = False, icao_ttl = 60):
+        # downlinks None lets every DF through; a DownlinkWatcher may replace it as bindings change
+        self.downlinks = downlinks
+        self.known_only = known_only
+        self.icao_ttl = icao_ttl
+        self.known = dict()
+        self.last_sweep = time.monotonic()
+        self.dropped = {reason: metrics.counter("frames_dropped", reason = reason) for reason in REASONS}
+
+    def keep_hex(self, frame):
+        try:
+            raw = bytes.fromhex(frame.decode())
+        except ValueError:
+            self.dropped["malformed"].inc()
+            return False
+        return self.keep(raw)
+
+    def keep(self, raw):
+        reason = self.check(raw, time.monotonic())
+        if reason is None:
+            return True
+        self.dropped[reason].inc()
+        return False
+
+    def check(self, raw, now):
+        if now - self.last_sweep > self.icao_ttl:
+            self.known = {icao: seen for icao, seen in self.known.items() if now - seen <= self.icao_ttl}
+            self.last_sweep = now
+
+        if len(raw) != 7 and len(raw) != 14:
+            return "malformed"
+        df = min(raw[0] >> 3, 24)
+        if (len(raw) == 14) != (df in LONG_DOWNLINKS):
+            return "malformed"
+
+        crc = remainder(raw)
+        if df == 17 or df == 18 or df == 11:
+            # DF 11 parity is overlaid with the interrogator's code in the low 7 bits
+            if (crc if df != 11 else crc & ~0x7F) != 0:
+                return "crc"
+            self.known[(raw[1] << 16) | (raw[2] << 8) | raw[3]] = now
+        elif df in decode.ICAO_FROM_PARITY and self.known_only:
+            seen = self.known.get(crc)
+            if seen is None or now - seen > self.icao_ttl:
+                return "unknown_icao"
+
+        if self.downlinks is not None and df not in self.downlinks:
+            return "downlink"
+        return None
+
+def parse_downlinks(text):
+    return frozenset(int(df) for df in text.split(","))
+
+def wanted_downlinks(routing_keys):
+    # DF 17/18 always feed the adsb exchange; anything else only matters if someone binds it by number.
+    # A wildcard binding could match any DF, so that means all of them.
+    wanted = {17, 18}
+    for routing_key in routing_keys:
+        if not routing_key.isdigit():
+            return None
+        wanted.add(int(routing_key))
+    return frozenset(wanted)
+
+class DownlinkWatcher:
+    # Keeps `downlinks` in step with what is actually bound to mode_s_by_downlink
+    def __init__(self, url, management_url = None, interval = 30):
+        self.url = url
+        self.management_url = management_url
+        self.interval = interval
+        self.downlinks = None
+        self.listeners = []
+
+    async def run(self):
+        while True:
+            try:
+                bindings = await transport.bindings(self.url, "mode_s_by_downlink", self.management_url)
+                downlinks = wanted_downlinks(key for queue, key in bindings if queue != DROP_QUEUE)
+                if downlinks != self.downlinks:
+                    log.info(f"Publishing downlink formats {'all' if downlinks is None else sorted(downlinks)}")
+                    self.downlinks = downlinks
+                    for listener in self.listeners:
+                        listener.downlinks = downlinks
+            except Exception as x:
+                log.warning(f"Can't read mode_s_by_downlink bindings, keeping the last set: {x}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,295 @@
+import aio_pika
+import asyncio
+import itertools
+import logging
+
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# An in-memory stand-in for the parts of the aio_pika API the services use: exchanges (topic, direct and
+# fanout), queues with bindings, iterators and ack/reject. A published message is handed to every matching
+# queue as-is; nothing is serialized or copied.
+
+# routing keys remembered per exchange before the cache is thrown away and rebuilt
+ROUTE_CACHE_SIZE = 10000
+
+def topic_matches(pattern, words):
+    if len(pattern) == 0:
+        return len(words) == 0
+
+    head = pattern[0]
+    if head == "#":
+        return any(topic_matches(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    return len(words) > 0 and (head == "*" or head == words[0]) and topic_matches(pattern[1:], words[1:])
+
+class Broker:
+    def __init__(self):
+        self.exchanges = dict()
+        self.queues = dict()
+        self.queue_names = itertools.count()
+        self.default_exchange = Exchange(self, "", aio_pika.ExchangeType.DIRECT)
+
+    async def connect(self):
+        return Connection(self)
+
+class Connection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+
+    async def channel(self, *args, **kwargs):
+        channel = Channel(self.broker)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+class Channel:
+    def __init__(self, broker):
+        self.broker = broker
+        self.default_exchange = broker.default_exchange
+        self.exclusive = []
+        self.delivery_tags = itertools.count(1)
+
+    async def set_qos(self, prefetch_count = 0, **kwargs):
+        # deliveries are already in memory, so there is nothing to throttle
+        ...
+
+    async def declare_exchange(self, name, type = aio_pika.ExchangeType.DIRECT, **kwargs):
+        exchange = self.broker.exchanges.get(name)
+        if exchange is None:
+            exchange = self.broker.exchanges[name] = Exchange(self.broker, name, aio_pika.ExchangeType(type))
+        elif exchange.type != aio_pika.ExchangeType(type):
+            raise ValueError(f"Exchange {name} already declared as {exchange.type.value}")
+        return exchange
+
+    async def get_exchange(self, name, ensure = True):
+        try:
+            return self.broker.exchanges[name]
+        except KeyError:
+            raise KeyError(f"No exchange named {name}")
+
+    async def declare_queue(self, name = "", exclusive = False, arguments = None, **kwargs):
+        if name == "" or name is None:
+            name = f"amq.gen-{next(self.broker.queue_names)}"
+
+        queue = self.broker.queues.get(name)
+        if queue is None:
+            queue = self.broker.queues[name] = Queue(self, name, arguments or {})
+            if exclusive:
+                self.exclusive.append(queue)
+        return queue
+
+    async def queue_delete(self, name, if_unused = False, **kwargs):
+        queue = self.broker.queues.get(name)
+        if queue is not None:
+            await queue.delete()
+
+    async def basic_ack(self, delivery_tag = None, multiple = False):
+        ...
+
+    async def close(self):
+        for queue in self.exclusive:
+            await queue.delete()
+        self.exclusive = []
+
+class Exchange:
+    def __init__(self, broker, name, type):
+        self.broker = broker
+        self.name = name
+        self.type = type
+        self.bindings = []
+        self.routes = dict()
+
+    def bind_queue(self, queue, routing_key):
+        binding = (queue, routing_key, tuple(routing_key.split(".")))
+        if binding not in self.bindings:
+            self.bindings.append(binding)
+            self.routes.clear()
+
+    def unbind_queue(self, queue, routing_key = None):
+        self.bindings = [binding for binding in self.bindings
+                         if binding[0] is not queue or (routing_key is not None and binding[1] != routing_key)]
+        self.routes.clear()
+
+    def route(self, routing_key):
+        if self.name == "":
+            queue = self.broker.queues.get(routing_key)
+            return [] if queue is None else [queue]
+
+        queues = self.routes.get(routing_key)
+        if queues is not None:
+            return queues
+
+        if self.type == aio_pika.ExchangeType.FANOUT:
+            matched = (binding[0] for binding in self.bindings)
+        elif self.type == aio_pika.ExchangeType.DIRECT:
+            matched = (binding[0] for binding in self.bindings if binding[1] == routing_key)
+        elif self.type == aio_pika.ExchangeType.TOPIC:
+            words = routing_key.split(".")
+            matched = (binding[0] for binding in self.bindings if topic_matches(binding[2], words))
+        else:
+            raise ValueError(f"Unsupported exchange type {self.type.value}")
+
+        # a queue bound more than once still gets one copy
+        queues = list(dict.fromkeys(matched))
+        if len(self.routes) >= ROUTE_CACHE_SIZE:
+            self.routes.clear()
+        self.routes[routing_key] = queues
+        return queues
+
+    async def publish(self, message, routing_key, **kwargs):
+        for queue in self.route(routing_key):
+            queue.put(Delivery(message, queue, self.name, routing_key))
+
+class Queue:
+    def __init__(self, channel, name, arguments):
+        self.channel = channel
+        self.name = name
+        self.arguments = arguments
+        self.max_length = arguments.get("x-max-length")
+        self.reject_publish = arguments.get("x-overflow") in ("reject-publish", "reject-publish-dlx")
+        # one deque per priority level, lowest first, as a queue declared with x-max-priority has
+        self.levels = [deque() for _ in range(arguments.get("x-max-priority", 0) + 1)]
+        self.length = 0
+        self.waiters = deque()
+        self.bound = []
+        self.dropped = 0
+
+    def __len__(self):
+        return self.length
+
+    async def bind(self, exchange, routing_key = None, **kwargs):
+        if isinstance(exchange, str):
+            exchange = await self.channel.get_exchange(exchange)
+        routing_key = self.name if routing_key is None else routing_key
+        exchange.bind_queue(self, routing_key)
+        self.bound.append((exchange, routing_key))
+
+    async def unbind(self, exchange, routing_key = None, **kwargs):
+        if isinstance(exchange, str):
+            exchange = await self.channel.get_exchange(exchange)
+        routing_key = self.name if routing_key is None else routing_key
+        exchange.unbind_queue(self, routing_key)
+        self.bound = [b for b in self.bound if b != (exchange, routing_key)]
+
+    async def delete(self, **kwargs):
+        for exchange, routing_key in self.bound:
+            exchange.unbind_queue(self)
+        self.bound = []
+        self.channel.broker.queues.pop(self.name, None)
+
+    def put(self, delivery):
+        if self.max_length is not None and self.length >= self.max_length:
+            self.dropped += 1
+            if self.reject_publish:
+                return
+            # RabbitMQ drops the oldest message of the lowest priority first
+            next(level for level in self.levels if len(level) > 0).popleft()
+            self.length -= 1
+
+        delivery.delivery_tag = next(self.channel.delivery_tags)
+        while len(self.waiters) > 0:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(delivery)
+                return
+
+        if len(self.levels) == 1:
+            self.levels[0].append(delivery)
+        else:
+            self.levels[min(delivery.priority or 0, len(self.levels) - 1)].append(delivery)
+        self.length += 1
+
+    async def get(self):
+        if self.length > 0:
+            self.length -= 1
+            if len(self.levels) == 1:
+                return self.levels[0].popleft()
+            return next(level for level in reversed(self.levels) if len(level) > 0).popleft()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        return await waiter
+
+    def iterator(self, no_ack = False, **kwargs):
+        return QueueIterator(self)
+
+class QueueIterator:
+    def __init__(self, queue):
+        self.queue = queue
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        ...
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+class Delivery:
+    # One queue's copy of a published message. Everything but the delivery details is read through to the
+    # message that was published.
+    __slots__ = ("message", "queue", "exchange", "routing_key", "delivery_tag", "processed")
+
+    def __init__(self, message, queue, exchange, routing_key):
+        self.message = message
+        self.queue = queue
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.delivery_tag = None
+        self.processed = False
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    @property
+    def channel(self):
+        return self.queue.channel
+
+    @property
+    def redelivered(self):
+        return False
+
+    async def ack(self, multiple = False):
+        self.processed = True
+
+    async def reject(self, requeue = False):
+        self.processed = True
+        if requeue:
+            self.queue.put(Delivery(self.message, self.queue, self.exchange, self.routing_key))
+
+    async def nack(self, multiple = False, requeue = True):
+        await self.reject(requeue)
+
+    def process(self, requeue = False, **kwargs):
+        return Processing(self, requeue)
+
+class Processing:
+    def __init__(self, delivery, requeue):
+        self.delivery = delivery
+        self.requeue = requeue
+
+    async def __aenter__(self):
+        return self.delivery
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.delivery.processed:
+            return
+        if exc_type is None:
+            await self.delivery.ack()
+        else:
+            await self.delivery.reject(self.requeue)
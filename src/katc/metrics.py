@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import time
+
+import aio_pika
+
+from katc import registrations
+
+log = logging.getLogger(__name__)
+
+# Process-wide counters, gauges and latency histograms. Look a metric up once and keep it, since recording
+# into it is then a single attribute update (Counter, Gauge) or a few integer ops (Histogram):
+#
+#   DECODED = metrics.counter("frames_decoded")
+#   DECODE_TIME = metrics.histogram("decode_seconds")
+#
+# serve() exposes everything in the Prometheus text format, and publish_periodically() sends the same
+# numbers as JSON to the metrics exchange for anything not scraped.
+
+QUANTILES = (50, 90, 99, 99.9)
+
+counters = dict()
+gauges = dict()
+histograms = dict()
+
+def key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def counter(name, **labels):
+    k = key(name, labels)
+    if k not in counters:
+        counters[k] = Counter()
+    return counters[k]
+
+def gauge(name, **labels):
+    k = key(name, labels)
+    if k not in gauges:
+        gauges[k] = Gauge()
+    return gauges[k]
+
+def histogram(name, **labels):
+    k = key(name, labels)
+    if k not in histograms:
+        histograms[k] = Histogram()
+    return histograms[k]
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+class Histogram:
+    # Log-linear buckets over microseconds: 8 sub-buckets per power of two, so any value is within 12.5%
+    # of its bucket's bounds. Recording is a couple of integer ops and a list increment.
+    def __init__(self):
+        self.counts = [0] * 512
+        self.count = 0
+        self.total = 0
+
+    @staticmethod
+    def bucket(us):
+        if us < 16:
+            return us
+        shift = us.bit_length() - 4
+        return shift * 8 + (us >> shift)
+
+    @staticmethod
+    def lower_bound(bucket):
+        if bucket < 16:
+            return bucket
+        shift = bucket // 8 - 1
+        return (bucket % 8 + 8) << shift
+
+    def record(self, seconds):
+        # bucket() inlined, since this runs for every message
+        us = int(seconds * 1_000_000)
+        if us < 16:
+            bucket = us if us > 0 else 0
+        else:
+            shift = us.bit_length() - 4
+            bucket = shift * 8 + (us >> shift)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += us
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, in seconds
+        if self.count == 0:
+            return None
+
+        target = self.count * p / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count > 0:
+                return (self.lower_bound(bucket + 1) - 1) / 1_000_000
+        return None
+
+    def mean(self):
+        return None if self.count == 0 else self.total / self.count / 1_000_000
+
+def format_labels(labels, extra = ()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+def render():
+    lines = []
+    for (name, labels), c in sorted(counters.items()):
+        lines.append(f"katc_{name}_total{format_labels(labels)} {c.value}")
+    for (name, labels), g in sorted(gauges.items()):
+        lines.append(f"katc_{name}{format_labels(labels)} {g.value}")
+    for (name, labels), h in sorted(histograms.items()):
+        # HDR buckets don't map onto Prometheus histogram buckets, so these go out as summaries
+        for q in QUANTILES:
+            value = h.percentile(q)
+            if value is not None:
+                lines.append(f"katc_{name}{format_labels(labels, [('quantile', f'{q / 100:g}')])} {value}")
+        lines.append(f"katc_{name}_sum{format_labels(labels)} {h.total / 1_000_000}")
+        lines.append(f"katc_{name}_count{format_labels(labels)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+def snapshot():
+    return {"counters": [{"name": name, "labels": dict(labels), "value": c.value}
+                         for (name, labels), c in counters.items()],
+            "gauges": [{"name": name, "labels": dict(labels), "value": g.value}
+                       for (name, labels), g in gauges.items()],
+            "histograms": [{"name": name, "labels": dict(labels), "count": h.count, "mean": h.mean()}
+                           | {f"p{q}": h.percentile(q) for q in QUANTILES}
+                           for (name, labels), h in histograms.items()]}
+
+async def serve(port, host = "0.0.0.0"):
+    # just enough HTTP for a Prometheus scrape; every path gets the metrics
+    async def on_connection(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %d\r\n"
+                         b"Connection: close\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            ...
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(on_connection, host, port)
+    log.info(f"Serving metrics on port {port}")
+    async with server:
+        await server.serve_forever()
+
+async def publish_periodically(exchange, service, interval = 10):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await exchange.publish(aio_pika.Message(json.dumps(snapshot()).encode(),
+                                                    content_type = "application/json",
+                                                    timestamp = time.time(),
+                                                    headers = {"service": service}),
+                                   service)
+        except Exception as x:
+            log.error(f"Failed to publish metrics: {x}")
+
+async def export(args, channel, service):
+    # what a service's --metrics-port and --metrics-interval ask for
+    exporters = []
+    if args.metrics_port is not None:
+        exporters.append(serve(args.metrics_port))
+    if args.metrics_interval is not None:
+        exporters.append(publish_periodically(await registrations.Exchanges.Metrics(channel),
+                                              service,
+                                              args.metrics_interval))
+    await asyncio.gather(*exporters)
+
+def add_arguments(parser):
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    parser.add_argument("--metrics-interval", type=float, help="seconds between stats on the metrics exchange")
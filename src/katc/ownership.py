@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import os
+import socket
+
+from katc import metrics, utils
+
+log = logging.getLogger(__name__)
+
+# Which trace worker owns which aircraft, kept in Redis:
+#
+#   trace_workers            sorted set of worker id -> when its heartbeat runs out (ms, Redis clock)
+#   trace_worker_capacity    hash of worker id -> how many aircraft it can trace
+#   trace_worker_waiting     hash of worker id -> requests it has taken but not started yet
+#   trace_owned_{worker}     set of the aircraft a worker holds
+#   trace_requests_{worker}  requests assigned to a worker
+#   trace_{icao}             the owning worker's id, as a lease renewed by every heartbeat
+#
+# The dispatcher hands each request to the live worker with the least work for its capacity, so adding a
+# worker adds its capacity. A heartbeat renews all of a worker's leases in one round trip and reaps any
+# worker whose heartbeat ran out: its leases are deleted (the dispatcher then asks for those aircraft
+# again) and its queued requests go to the remaining workers. Until that happens, another worker may take
+# over a dead worker's lease directly.
+#
+# Workers also read the shared trace_requests list, which gets requests whenever no worker is alive.
+
+SHARED_QUEUE = "trace_requests"
+
+# helpers the scripts below start with
+LEAST_LOADED = """
+local function now_ms()
+    local time = redis.call("TIME")
+    return tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+end
+
+local function least_loaded(now)
+    local best, best_load
+    for _, worker in ipairs(redis.call("ZRANGEBYSCORE", "trace_workers", "(" .. now, "+inf")) do
+        local capacity = tonumber(redis.call("HGET", "trace_worker_capacity", worker)) or 1
+        local load = (redis.call("SCARD", "trace_owned_" .. worker)
+                      + redis.call("LLEN", "trace_requests_" .. worker)
+                      + (tonumber(redis.call("HGET", "trace_worker_waiting", worker)) or 0)) / capacity
+        if best == nil or load < best_load then
+            best, best_load = worker, load
+        end
+    end
+    return best
+end
+
+local function assign(icao, now)
+    local worker = least_loaded(now)
+    redis.call("LPUSH", worker and "trace_requests_" .. worker or "trace_requests", icao)
+end
+"""
+
+# ARGV: request time, seconds before an unstarted request may be made again, ICAOs
+REQUEST_TRACES = LEAST_LOADED + """
+local now = now_ms()
+local requested = {}
+for i = 3, #ARGV do
+    local icao = ARGV[i]
+    if redis.call("EXISTS", "trace_requested_" .. icao, "trace_" .. icao) == 0 then
+        redis.call("SET", "trace_requested_" .. icao, ARGV[1], "EX", ARGV[2])
+        assign(icao, now)
+        table.insert(requested, icao)
+    end
+end
+return requested
+"""
+
+# ARGV: worker, heartbeat timeout ms, lease ms, capacity, waiting. Returns {reaped workers, lost ICAOs},
+# with lost ICAOs false if this worker had itself been reaped and lost everything.
+HEARTBEAT = LEAST_LOADED + """
+local worker, timeout, lease = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+local now = now_ms()
+
+local known = redis.call("ZSCORE", "trace_workers", worker)
+redis.call("ZADD", "trace_workers", now + timeout, worker)
+redis.call("HSET", "trace_worker_capacity", worker, ARGV[4])
+redis.call("HSET", "trace_worker_waiting", worker, ARGV[5])
+
+local reaped = redis.call("ZRANGEBYSCORE", "trace_workers", "-inf", now)
+for _, dead in ipairs(reaped) do
+    redis.call("ZREM", "trace_workers", dead)
+    for _, icao in ipairs(redis.call("SMEMBERS", "trace_owned_" .. dead)) do
+        if redis.call("GET", "trace_" .. icao) == dead then
+            redis.call("DEL", "trace_" .. icao)
+        end
+    end
+    redis.call("DEL", "trace_owned_" .. dead)
+    local queued = redis.call("LRANGE", "trace_requests_" .. dead, 0, -1)
+    redis.call("DEL", "trace_requests_" .. dead)
+    redis.call("HDEL", "trace_worker_capacity", dead)
+    redis.call("HDEL", "trace_worker_waiting", dead)
+    for i = #queued, 1, -1 do
+        assign(queued[i], now)
+    end
+end
+
+if not known then
+    return {reaped, false}
+end
+
+local lost = {}
+for _, icao in ipairs(redis.call("SMEMBERS", "trace_owned_" .. worker)) do
+    if redis.call("GET", "trace_" .. icao) == worker then
+        redis.call("PEXPIRE", "trace_" .. icao, lease)
+    else
+        redis.call("SREM", "trace_owned_" .. worker, icao)
+        table.insert(lost, icao)
+    end
+end
+return {reaped, lost}
+"""
+
+# KEYS: trace_{icao}. ARGV: worker, lease ms, ICAO. Takes over the lease if its owner is a dead worker; a
+# lease held by anything that isn't a worker is left alone until it expires. The aircraft stays in the old
+# owner's set, so that worker finds out it lost it if it turns out to be alive after all.
+ACQUIRE = LEAST_LOADED + """
+local worker, lease, icao = ARGV[1], ARGV[2], ARGV[3]
+redis.call("DEL", "trace_requested_" .. icao)
+local owner = redis.call("GET", KEYS[1])
+if owner and owner ~= worker then
+    local expires = redis.call("ZSCORE", "trace_workers", owner)
+    if not expires or tonumber(expires) > now_ms() then
+        return 0
+    end
+end
+redis.call("SET", KEYS[1], worker, "PX", lease)
+redis.call("SADD", "trace_owned_" .. worker, icao)
+return 1
+"""
+
+# KEYS: trace_{icao}. ARGV: worker, ICAO
+RELEASE = """
+redis.call("SREM", "trace_owned_" .. ARGV[1], ARGV[2])
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# ARGV: worker. Gives up everything and hands queued requests to the other workers.
+LEAVE = LEAST_LOADED + """
+local worker = ARGV[1]
+redis.call("ZREM", "trace_workers", worker)
+redis.call("HDEL", "trace_worker_capacity", worker)
+redis.call("HDEL", "trace_worker_waiting", worker)
+for _, icao in ipairs(redis.call("SMEMBERS", "trace_owned_" .. worker)) do
+    if redis.call("GET", "trace_" .. icao) == worker then
+        redis.call("DEL", "trace_" .. icao)
+    end
+end
+redis.call("DEL", "trace_owned_" .. worker)
+local queued = redis.call("LRANGE", "trace_requests_" .. worker, 0, -1)
+redis.call("DEL", "trace_requests_" .. worker)
+local now = now_ms()
+for i = #queued, 1, -1 do
+    assign(queued[i], now)
+end
+return #queued
+"""
+
+def worker_id():
+    return utils.random_string_with_prefix(f"{socket.gethostname()}:{os.getpid()}:", 6)
+
+class Worker:
+    # One trace worker's side of it. Await heartbeat() once to register before taking any requests, then
+    # call run() alongside the worker's own tasks; on_lost(icao) is called for every aircraft another worker
+    # took over.
+    def __init__(self, redis, capacity, on_lost = None, heartbeat = 2, timeout = 6, lease = 30, waiting = None):
+        self.redis = redis
+        self.id = worker_id()
+        self.capacity = capacity
+        self.on_lost = on_lost
+        self.heartbeat_interval = heartbeat
+        self.timeout_ms = int(timeout * 1000)
+        self.lease_ms = int(lease * 1000)
+        # how many taken requests are still waiting to start, for workers that keep a backlog
+        self.waiting = waiting or (lambda: 0)
+        self.queue = f"trace_requests_{self.id}"
+        self.owned = set()
+        self.registered = False
+        self.heartbeat_script = redis.register_script(HEARTBEAT)
+        self.acquire_script = redis.register_script(ACQUIRE)
+        self.release_script = redis.register_script(RELEASE)
+        self.leave_script = redis.register_script(LEAVE)
+        self.lost = metrics.counter("trace_leases_lost")
+        self.reaped = metrics.counter("trace_workers_reaped")
+
+    async def heartbeat(self):
+        reaped, lost = await self.heartbeat_script(args = [self.id, self.timeout_ms, self.lease_ms,
+                                                           self.capacity, self.waiting()])
+        if len(reaped) > 0:
+            self.reaped.inc(len(reaped))
+            log.warning(f"Reaped dead trace workers {', '.join(worker.decode() for worker in reaped)}")
+
+        if lost is None and not self.registered:
+            # this heartbeat registered the worker, so there is nothing it could have lost
+            lost = []
+        elif lost is None:
+            # taken for dead and reaped
+            lost = list(self.owned)
+            if len(lost) > 0:
+                log.warning(f"{self.id} was taken for dead, giving up its {len(lost)} aircraft")
+        else:
+            lost = [icao.decode() for icao in lost]
+        self.registered = True
+
+        for icao in lost:
+            self.owned.discard(icao)
+            self.lost.inc()
+            if self.on_lost is not None:
+                await self.on_lost(icao)
+
+    async def run(self):
+        log.info(f"Trace worker {self.id} tracing up to {self.capacity} aircraft")
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as x:
+                # leases outlive a few missed heartbeats
+                log.error(f"Heartbeat failed: {x}")
+
+    async def next_request(self):
+        # ICAO of the next aircraft to trace, waiting as long as it takes
+        return (await self.redis.brpop([self.queue, SHARED_QUEUE]))[1].decode()
+
+    async def more_requests(self, count):
+        # up to `count` more already assigned to this worker, without waiting
+        return [icao.decode() for icao in await self.redis.rpop(self.queue, count) or []]
+
+    async def acquire(self, icao):
+        if not await self.acquire_script(keys = [f"trace_{icao}"], args = [self.id, self.lease_ms, icao]):
+            return False
+        self.owned.add(icao)
+        return True
+
+    async def release(self, icao):
+        self.owned.discard(icao)
+        await self.release_script(keys = [f"trace_{icao}"], args = [self.id, icao])
+
+    async def leave(self):
+        handed_over = await self.leave_script(args = [self.id])
+        log.info(f"{self.id} left, handing {handed_over} queued requests to other workers")
+        self.owned.clear()
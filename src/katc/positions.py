@@ -0,0 +1,74 @@
+import math
+import pyModeS as pms
+
+DEFAULT_RECEIVER = (41.4072, -81.8573)
+
+# a global decode needs an even/odd pair at most this many seconds apart
+PAIR_WINDOW = 10
+# fixes farther than this from the receiver, or implying a faster ground speed, are thrown out
+MAX_RANGE_NM = 300
+MAX_SPEED_KT = 1000
+EARTH_RADIUS_NM = 3440.065
+
+def distance_nm(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_NM * math.asin(math.sqrt(h))
+
+def parse_location(text):
+    lat, lon = text.split(",")
+    return (float(lat), float(lon))
+
+class PositionSolver:
+    # Per-aircraft CPR state. Once an even/odd pair gives a global fix, every later position frame is
+    # decoded locally against the previous fix, which is one message's worth of work instead of two.
+    __slots__ = ("receiver", "frames", "times", "position", "position_ts")
+
+    def __init__(self, receiver = DEFAULT_RECEIVER):
+        self.receiver = receiver
+        self.frames = [None, None]
+        self.times = [None, None]
+        self.position = None
+        self.position_ts = None
+
+    def update(self, body, now):
+        oe = pms.adsb.oe_flag(body)
+        self.frames[oe] = body
+        self.times[oe] = now
+
+        if self.position is not None:
+            candidate = pms.adsb.position_with_ref(body, self.position[0], self.position[1])
+            if self.plausible(candidate, now):
+                return self.accept(candidate, now)
+
+            # lost track (or a corrupt frame); only a fresh pair can be trusted now
+            self.position = None
+            self.position_ts = None
+
+        if self.frames[1 - oe] is None or now - self.times[1 - oe] > PAIR_WINDOW:
+            return None
+
+        try:
+            candidate = pms.adsb.position(self.frames[0], self.frames[1], self.times[0], self.times[1],
+                                          self.receiver[0], self.receiver[1])
+        except RuntimeError:
+            # the pair mixes barometric and GNSS altitude position types
+            return None
+
+        if candidate is None or not self.plausible(candidate, now):
+            return None
+        return self.accept(candidate, now)
+
+    def plausible(self, candidate, now):
+        if distance_nm(self.receiver, candidate) > MAX_RANGE_NM:
+            return False
+        if self.position is None:
+            return True
+
+        elapsed = max(now - self.position_ts, 1)
+        return distance_nm(self.position, candidate) / (elapsed / 3600) <= MAX_SPEED_KT
+
+    def accept(self, candidate, now):
+        self.position = candidate
+        self.position_ts = now
+        return candidate
@@ -10,10 +10,22 @@ class Exchanges:
     async def FlightStateChanges(channel):
         return await channel.declare_exchange("flight_state_changed", aio_pika.ExchangeType.TOPIC, durable=True)
 
+    async def Metrics(channel):
+        return await channel.declare_exchange("metrics", aio_pika.ExchangeType.TOPIC, durable=True)
+
+    async def ModeSShards(channel):
+        return await channel.declare_exchange("mode_s_shards", aio_pika.ExchangeType.DIRECT, durable=True)
+
+    async def Snapshots(channel):
+        return await channel.declare_exchange("snapshots", aio_pika.ExchangeType.FANOUT, durable=True)
+
     async def TraceDispatch(channel):
         return await channel.declare_exchange("trace_dispatch",
                                               aio_pika.ExchangeType.FANOUT,
                                               durable=True)
+    async def TraceEvents(channel):
+        return await channel.declare_exchange("trace_events", aio_pika.ExchangeType.TOPIC, durable=True)
+
     async def TracesForHumans(channel):
         return await channel.declare_exchange("traces_for_humans",
                                               aio_pika.ExchangeType.FANOUT,
@@ -0,0 +1,145 @@
+import aio_pika
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+from collections import defaultdict
+from katc import metrics, utils
+
+log = logging.getLogger(__name__)
+
+# Several replies to one reply queue can travel as a single message: a JSON object of correlation_id -> body
+BATCH_CONTENT_TYPE = "application/x-katc-rpc-batch"
+# message type of a reply saying the handler failed; the body is the error
+ERROR = "error"
+
+class RpcError(Exception):
+    ...
+
+class RpcClient:
+    # Any number of calls share one reply queue. Identical calls already in flight share one request, and
+    # timeouts are timer callbacks rather than a wait_for per call.
+    def __init__(self, exchange, reply_to, timeout = 2):
+        self.exchange = exchange
+        self.reply_to = reply_to
+        self.timeout = timeout
+        self.prefix = utils.random_string_with_prefix("", 8) + "."
+        self.ids = itertools.count()
+        self.calls = dict()
+        self.in_flight = dict()
+        self.latencies = dict()
+        self.deduplicated = metrics.counter("rpc_calls_deduplicated")
+        self.timeouts = metrics.counter("rpc_timeouts")
+
+    def call(self, method_name, args):
+        key = (method_name, args)
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.deduplicated.inc()
+            return future
+
+        loop = asyncio.get_running_loop()
+        call_id = self.prefix + str(next(self.ids))
+        self.in_flight[key] = future = loop.create_future()
+        self.calls[call_id] = (key, time.perf_counter(), loop.call_later(self.timeout, self.on_timeout, call_id))
+
+        publish = asyncio.ensure_future(self.exchange.publish(aio_pika.Message(args.encode(),
+                                                                               reply_to = self.reply_to,
+                                                                               correlation_id = call_id),
+                                                              method_name))
+        publish.add_done_callback(lambda publish: self.on_published(call_id, publish))
+        return future
+
+    def on_published(self, call_id, publish):
+        if not publish.cancelled() and publish.exception() is not None:
+            self.complete(call_id, exception = publish.exception())
+
+    def on_timeout(self, call_id):
+        key = self.calls[call_id][0]
+        self.timeouts.inc()
+        self.complete(call_id, exception = TimeoutError(f"RPC {key[0]}({key[1]}) timed out ({call_id})"))
+
+    def complete(self, call_id, result = None, exception = None):
+        call = self.calls.pop(call_id, None)
+        if call is None:
+            # already timed out, or a duplicate reply
+            return
+
+        key, started, timer = call
+        timer.cancel()
+        future = self.in_flight.pop(key)
+        if future.done():
+            # every caller gave up on it
+            return
+        elif exception is not None:
+            future.set_exception(exception)
+            # nobody may be waiting on it any more
+            future.exception()
+        else:
+            latency = self.latencies.get(key[0])
+            if latency is None:
+                latency = self.latencies[key[0]] = metrics.histogram("rpc_call_seconds", method = key[0])
+            latency.record(time.perf_counter() - started)
+            future.set_result(result)
+
+    async def on_reply(self, message):
+        if message.content_type == BATCH_CONTENT_TYPE:
+            for call_id, body in json.loads(message.body).items():
+                self.complete(call_id, body)
+        elif message.type == ERROR:
+            self.complete(message.correlation_id, exception = RpcError(message.body.decode()))
+        else:
+            self.complete(message.correlation_id, message.body.decode())
+
+class RpcServer:
+    # Replies headed for the same reply queue within a short window go back as one batch message.
+    def __init__(self, exchange, handlers, window = 0.005):
+        self.exchange = exchange
+        self.handlers = handlers
+        self.window = window
+        self.requests = {name: metrics.counter("rpc_requests", method = name) for name in handlers}
+        self.replies = defaultdict(dict)
+        self.flusher = None
+
+    async def on_request(self, message):
+        handler = self.handlers.get(message.routing_key)
+        if handler is None:
+            log.warning(f"No handler for RPC {message.routing_key}")
+            return
+
+        self.requests[message.routing_key].inc()
+        log.debug(f"RPC {message.correlation_id}: {message.routing_key}({message.body.decode()}) -> {message.reply_to}")
+        try:
+            body = await handler(message.body.decode())
+        except Exception as x:
+            # straight back rather than in a batch, so the caller doesn't sit out its timeout
+            log.error(f"RPC {message.routing_key}({message.body.decode()}) failed: {x}")
+            await self.reply(aio_pika.Message(str(x).encode(), correlation_id = message.correlation_id,
+                                              type = ERROR),
+                             message.reply_to)
+            return
+
+        self.replies[message.reply_to][message.correlation_id] = body
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flusher = None
+
+        replies, self.replies = self.replies, defaultdict(dict)
+        for reply_to, bodies in replies.items():
+            if len(bodies) == 1:
+                (call_id, body), = bodies.items()
+                message = aio_pika.Message(body.encode(), correlation_id = call_id)
+            else:
+                message = aio_pika.Message(json.dumps(bodies).encode(), content_type = BATCH_CONTENT_TYPE)
+            await self.reply(message, reply_to)
+
+    async def reply(self, message, reply_to):
+        try:
+            await self.exchange.publish(message, reply_to)
+        except Exception as x:
+            log.error(f"Failed to reply to {reply_to}: {x}")
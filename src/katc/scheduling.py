@@ -0,0 +1,117 @@
+import math
+import time
+
+from katc import shedding, wire
+
+# Which requested trace to start next when there are more requests than trace slots. Aircraft are ranked
+# by what the adsb exchange says about them lately:
+#
+#   an emergency or priority status in TC 28    first, whatever else
+#   a callsign seen                             ahead of those without one
+#   message rate                                busier (nearer, clearer) aircraft ahead of faint ones
+#
+# Priorities keep changing while requests wait, so the backlog is scanned when a slot frees rather than
+# kept in a heap; it holds at most a few hundred aircraft.
+
+EMERGENCY_PRIORITY = 1000
+CALLSIGN_PRIORITY = 10
+# seconds over which the message rate is averaged
+RATE_WINDOW = 10
+
+class Activity:
+    __slots__ = ("count", "updated", "emergency", "callsign")
+
+    def __init__(self, now):
+        self.count = 0.0
+        self.updated = now
+        self.emergency = False
+        self.callsign = False
+
+    def rate(self, now):
+        return self.count * math.exp((self.updated - now) / RATE_WINDOW) / RATE_WINDOW
+
+def emergency(message):
+    # TC 28 subtype 1 carries an emergency/priority status next to the squawk; 0 is none
+    if message.content_type == wire.BINARY_CONTENT_TYPE:
+        raw = message.body[wire.ENVELOPE.size:]
+    else:
+        raw = bytes.fromhex(message.body.decode())
+    return (raw[4] & 0x07) == 1 and (raw[5] >> 5) != 0
+
+class ActivityTracker:
+    def __init__(self, forget_after = 60):
+        self.forget_after = forget_after
+        self.aircraft = dict()
+        self.last_sweep = time.monotonic()
+
+    def on_message(self, message, now = None):
+        icao, tc = shedding.classify(message)
+        if icao is None or icao == wire.NO_ICAO:
+            return
+        if isinstance(icao, int):
+            icao = "%06X" % icao
+
+        now = time.monotonic() if now is None else now
+        activity = self.aircraft.get(icao)
+        if activity is None:
+            activity = self.aircraft[icao] = Activity(now)
+        activity.count = activity.count * math.exp((activity.updated - now) / RATE_WINDOW) + 1
+        activity.updated = now
+        if tc is not None and 1 <= tc <= 4:
+            activity.callsign = True
+        elif tc == 28:
+            activity.emergency = emergency(message)
+
+        if now - self.last_sweep > self.forget_after:
+            self.aircraft = {icao: activity for icao, activity in self.aircraft.items()
+                             if now - activity.updated <= self.forget_after}
+            self.last_sweep = now
+
+    def last_seen(self, icao):
+        activity = self.aircraft.get(icao)
+        return None if activity is None else activity.updated
+
+    def priority(self, icao, now = None):
+        activity = self.aircraft.get(icao)
+        if activity is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        return (EMERGENCY_PRIORITY * activity.emergency
+                + CALLSIGN_PRIORITY * activity.callsign
+                + activity.rate(now))
+
+class Backlog:
+    # requested traces waiting for a slot: ICAO -> when it was requested (time.time())
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.requests = dict()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, icao):
+        return icao in self.requests
+
+    def add(self, icao, requested_at):
+        self.requests.setdefault(icao, requested_at)
+
+    def pop(self):
+        # (icao, requested_at) of the highest priority request, oldest first among equals
+        if len(self.requests) == 0:
+            return None
+        now = time.monotonic()
+        icao = max(self.requests, key = lambda icao: (self.tracker.priority(icao, now), -self.requests[icao]))
+        return icao, self.requests.pop(icao)
+
+    def stale(self, older_than):
+        # requests for aircraft not heard from since `older_than` seconds ago; these are taken out
+        now = time.monotonic()
+        wall = time.time()
+        stale = []
+        for icao, requested_at in self.requests.items():
+            seen = self.tracker.last_seen(icao)
+            if wall - requested_at > older_than and (seen is None or now - seen > older_than):
+                stale.append(icao)
+        for icao in stale:
+            del self.requests[icao]
+        return stale
@@ -0,0 +1,22 @@
+def jump_hash(key, buckets):
+    # Lamping & Veach jump consistent hash: growing the bucket count only moves 1/n of the keys
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+def shard_key(frame):
+    # DF 11/17/18 carry the ICAO in the clear, so every frame from an aircraft lands on one shard.
+    # Everything else only has address/parity, which would need a CRC to untangle.
+    try:
+        df = int(frame[0:2], 16) >> 3
+        if df in (11, 17, 18):
+            return int(frame[2:8], 16)
+        return int(frame[-6:], 16)
+    except ValueError:
+        return 0
+
+def shard_for(frame, shards):
+    return jump_hash(shard_key(frame), shards)
@@ -0,0 +1,101 @@
+import logging
+
+import aio_pika.exceptions
+
+from katc import metrics, wire
+
+log = logging.getLogger(__name__)
+
+# How the ADS-B fan-out degrades under load, rather than letting queues grow without bound:
+#
+#   1. every stage's queue has a length limit; past it the broker drops the oldest message
+#   2. the router gives position and identification frames a higher priority than everything else
+#   3. a consumer that falls behind skips messages a newer one for the same aircraft already supersedes,
+#      and when it falls further behind, handles only position and identification frames
+
+# per-stage queue arguments. The broker refuses to redeclare a durable queue with different arguments, so
+# changing them means a new queue name (flight_state_v2, say) and retire_queue for the old one.
+MAX_PRIORITY = 2
+QUEUE_LIMITS = {"trace_dispatcher_adsb": 20000,
+                "trace_engine": 10000,
+                "trace": 2000,
+                "flight_state": 50000,
+                "spatial_index": 10000,
+                "snapshot": 20000,
+                "trace_redis_shell": 20000,
+                "archiver": 100000}
+
+# shedding levels
+NORMAL = 0
+COALESCING = 1
+ESSENTIAL_ONLY = 2
+
+def queue_arguments(stage, arguments = None):
+    return (arguments or {}) | {"x-max-length": QUEUE_LIMITS[stage],
+                                "x-overflow": "drop-head",
+                                "x-max-priority": MAX_PRIORITY}
+
+async def retire_queue(connection, name):
+    # The old queue is still bound, so left alone it would fill up with nothing reading it. if_unused keeps
+    # it while a previous version still consumes from it; the broker closes the channel to say so.
+    channel = await connection.channel()
+    try:
+        await channel.queue_delete(name, if_unused = True)
+        await channel.close()
+    except aio_pika.exceptions.ChannelPreconditionFailed:
+        log.warning(f"Queue {name} still has consumers; it will be deleted on a later start")
+
+def priority(tc):
+    if tc is None:
+        return 0
+    if 1 <= tc <= 4 or 9 <= tc <= 18 or 20 <= tc <= 22:
+        return 2
+    if tc == 19:
+        return 1
+    return 0
+
+def classify(message):
+    # (icao, typecode) without decoding the frame itself
+    if message.content_type == wire.BINARY_CONTENT_TYPE:
+        _, _, tc, icao, _ = wire.ENVELOPE.unpack_from(message.body)
+        return icao, None if tc == wire.NO_TYPECODE else tc
+    headers = message.headers
+    return headers.get("icao"), headers.get("typecode")
+
+def coalesce_key(message):
+    # velocity and identification only matter as the latest value; positions are kept, since CPR decoding
+    # needs the even/odd pairs
+    icao, tc = classify(message)
+    if tc == 19:
+        return (icao, 19)
+    if tc is not None and 1 <= tc <= 4:
+        return (icao, 1)
+    return None
+
+class Shedder:
+    # Picks a shedding level from how far behind the consumer is (message lag in seconds), with some
+    # hysteresis so it doesn't flap at the threshold.
+    def __init__(self, name, coalesce_after = 1, essential_after = 5, key = coalesce_key):
+        self.thresholds = (coalesce_after, essential_after)
+        self.key = key
+        self.level = NORMAL
+        self.gauge = metrics.gauge("shedding_level", queue = name)
+        self.shed = metrics.counter("messages_shed", queue = name)
+
+    def update(self, lag):
+        level = self.level
+        while level < ESSENTIAL_ONLY and lag >= self.thresholds[level]:
+            level += 1
+        while level > NORMAL and lag < self.thresholds[level - 1] / 2:
+            level -= 1
+        if level != self.level:
+            self.level = level
+            self.gauge.set(level)
+
+    def admit(self, message, superseded):
+        if self.level == NORMAL:
+            return True
+        if superseded or (self.level == ESSENTIAL_ONLY and priority(classify(message)[1]) < 2):
+            self.shed.inc()
+            return False
+        return True
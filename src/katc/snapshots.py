@@ -0,0 +1,114 @@
+import struct
+import time
+
+from katc import events
+
+# The live picture for visualization clients: the latest known value of every trace event field, per
+# aircraft, sent as binary frames at a fixed tick no matter how many messages came in between.
+#
+#   header   magic, version, kind, sequence, timestamp (ns), record count
+#   record   ICAO, field bits, then the fields those bits name, packed as in katc.events
+#
+# A keyframe has every aircraft with every field it knows. A delta only has the aircraft that changed
+# since the previous tick, and of those only the fields that changed; an aircraft that has gone away is a
+# record with just the REMOVED bit. Deltas are numbered, and a keyframe carries the number of the last
+# delta it includes, so a client applies only deltas numbered after its keyframe.
+
+MAGIC = b"KSNP"
+VERSION = 1
+KEYFRAME = 0
+DELTA = 1
+HEADER = struct.Struct(">4sBBIQH")
+RECORD = struct.Struct(">IH")
+REMOVED = 0x8000
+CONTENT_TYPE = "application/x-katc-snapshot"
+
+class AircraftState:
+    __slots__ = ("values", "changed", "last_seen")
+
+    def __init__(self):
+        self.values = [None] * len(events.FIELDS)
+        self.changed = 0
+        self.last_seen = None
+
+class SnapshotTable:
+    def __init__(self, lost_after = 60):
+        self.lost_after = lost_after
+        self.aircraft = dict()
+        # ICAOs with changes since the last delta, and ones that went away
+        self.dirty = set()
+        self.removed = set()
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.aircraft)
+
+    def apply(self, event, now = None):
+        state = self.aircraft.get(event.icao)
+        if state is None:
+            state = self.aircraft[event.icao] = AircraftState()
+            self.removed.discard(event.icao)
+
+        values = state.values
+        for i, value in enumerate(event[3:]):
+            if value is not None and value != values[i]:
+                values[i] = value
+                state.changed |= 1 << i
+        state.last_seen = time.time() if now is None else now
+        if state.changed:
+            self.dirty.add(event.icao)
+
+    def expire(self, now = None):
+        cutoff = (time.time() if now is None else now) - self.lost_after
+        for icao in [icao for icao, state in self.aircraft.items() if state.last_seen < cutoff]:
+            del self.aircraft[icao]
+            self.dirty.discard(icao)
+            self.removed.add(icao)
+
+    def delta(self, timestamp_ns = None):
+        # the next delta frame, or None if nothing changed; clears the changes it carries
+        if len(self.dirty) == 0 and len(self.removed) == 0:
+            return None
+
+        records = []
+        for icao in self.dirty:
+            state = self.aircraft[icao]
+            present, fields = events.encode_fields(state.values, state.changed)
+            records.append(RECORD.pack(int(icao, 16), present) + fields)
+            state.changed = 0
+        for icao in self.removed:
+            records.append(RECORD.pack(int(icao, 16), REMOVED))
+        self.dirty.clear()
+        self.removed.clear()
+
+        self.sequence += 1
+        return frame(DELTA, self.sequence, timestamp_ns, records)
+
+    def keyframe(self, timestamp_ns = None):
+        # everything known right now. Changes not yet sent in a delta are in it too, and the next delta
+        # repeats them, which does no harm.
+        records = []
+        for icao, state in self.aircraft.items():
+            present, fields = events.encode_fields(state.values)
+            records.append(RECORD.pack(int(icao, 16), present) + fields)
+        return frame(KEYFRAME, self.sequence, timestamp_ns, records)
+
+def frame(kind, sequence, timestamp_ns, records):
+    return HEADER.pack(MAGIC, VERSION, kind, sequence, timestamp_ns or time.time_ns(), len(records)) + b"".join(records)
+
+def decode(body):
+    # (kind, sequence, timestamp_ns, {ICAO: field values, or None if removed})
+    magic, version, kind, sequence, timestamp_ns, count = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} snapshot frame")
+
+    aircraft = dict()
+    offset = HEADER.size
+    for _ in range(count):
+        icao, present = RECORD.unpack_from(body, offset)
+        offset += RECORD.size
+        if present & REMOVED:
+            aircraft["%06X" % icao] = None
+            continue
+        aircraft["%06X" % icao], offset = events.decode_fields(body, offset, present)
+    return kind, sequence, timestamp_ns, aircraft
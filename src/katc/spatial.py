@@ -0,0 +1,99 @@
+import heapq
+import math
+
+from katc import positions
+
+class GridIndex:
+    # Latest position per ICAO, bucketed into cells of `cell_size` degrees. Updates touch at most two cells;
+    # queries only visit the cells overlapping their bounding box.
+    def __init__(self, cell_size = 0.5):
+        self.cell_size = cell_size
+        self.entries = dict()
+        self.cells = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def update(self, icao, lat, lon, timestamp):
+        cell = self.cell(lat, lon)
+        previous = self.entries.get(icao)
+        if previous is not None and previous[3] != cell:
+            self.discard_from_cell(icao, previous[3])
+
+        self.entries[icao] = (lat, lon, timestamp, cell)
+        self.cells.setdefault(cell, set()).add(icao)
+
+    def remove(self, icao):
+        entry = self.entries.pop(icao, None)
+        if entry is not None:
+            self.discard_from_cell(icao, entry[3])
+
+    def discard_from_cell(self, icao, cell):
+        members = self.cells[cell]
+        members.discard(icao)
+        if len(members) == 0:
+            del self.cells[cell]
+
+    def evict_older_than(self, timestamp):
+        stale = [icao for icao, entry in self.entries.items() if entry[2] < timestamp]
+        for icao in stale:
+            self.remove(icao)
+        return stale
+
+    def box(self, south, west, north, east):
+        if west > east:
+            # crosses the antimeridian
+            return self.box(south, west, north, 180) + self.box(south, -180, north, east)
+
+        south_row, west_column = self.cell(south, west)
+        north_row, east_column = self.cell(north, east)
+        found = []
+        if (north_row - south_row + 1) * (east_column - west_column + 1) > len(self.cells):
+            # cheaper to walk the occupied cells than the empty ones
+            candidates = (cell for cell in self.cells
+                          if south_row <= cell[0] <= north_row and west_column <= cell[1] <= east_column)
+        else:
+            candidates = ((row, column) for row in range(south_row, north_row + 1)
+                          for column in range(west_column, east_column + 1))
+
+        for cell in candidates:
+            for icao in self.cells.get(cell, ()):
+                lat, lon, timestamp, _ = self.entries[icao]
+                if south <= lat <= north and west <= lon <= east:
+                    found.append((icao, lat, lon, timestamp))
+        return found
+
+    def within(self, lat, lon, radius_nm):
+        # the cap's angular radius; its widest point in longitude is poleward of the center, not at it
+        angle = radius_nm / positions.EARTH_RADIUS_NM
+        dlat = math.degrees(angle)
+        if abs(lat) + dlat >= 90:
+            # takes in a pole, and with it every longitude
+            dlon = 180
+        else:
+            dlon = math.degrees(math.asin(min(math.sin(angle) / math.cos(math.radians(lat)), 1)))
+        if dlon >= 180:
+            west, east = -180, 180
+        else:
+            west = lon - dlon if lon - dlon >= -180 else lon - dlon + 360
+            east = lon + dlon if lon + dlon <= 180 else lon + dlon - 360
+        candidates = self.box(max(lat - dlat, -90), west, min(lat + dlat, 90), east)
+
+        found = []
+        for icao, other_lat, other_lon, timestamp in candidates:
+            distance = positions.distance_nm((lat, lon), (other_lat, other_lon))
+            if distance <= radius_nm:
+                found.append((icao, other_lat, other_lon, timestamp, distance))
+        return sorted(found, key = lambda entry: entry[4])
+
+    def nearest(self, lat, lon, k):
+        # widen the search until it holds k aircraft; anything outside the radius is farther than all of them
+        radius = self.cell_size * 60
+        while True:
+            found = self.within(lat, lon, radius)
+            if len(found) >= k or len(found) == len(self.entries) or radius > 2 * 180 * 60:
+                return heapq.nsmallest(k, found, key = lambda entry: entry[4])
+            radius *= 2
@@ -0,0 +1,54 @@
+import asyncio
+import heapq
+import time
+
+class ExpiryScheduler:
+    # One heap of deadlines for many keys. Pushing a later deadline for a key is just a dict update: its old
+    # heap entry is re-pushed with the current deadline when it comes due, so busy keys cost no heap work.
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self.heap = []
+        self.deadlines = dict()
+        self.wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        current = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        if current is None or deadline < current:
+            heapq.heappush(self.heap, (deadline, key))
+            if self.heap[0][1] == key:
+                self.wakeup.set()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    async def run(self):
+        while True:
+            if len(self.heap) == 0:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except TimeoutError:
+                    ...
+                continue
+
+            deadline, key = heapq.heappop(self.heap)
+            current = self.deadlines.get(key)
+            if current is None or current < deadline:
+                # cancelled, or rescheduled earlier under its own heap entry
+                continue
+            elif current > deadline:
+                heapq.heappush(self.heap, (current, key))
+                continue
+
+            del self.deadlines[key]
+            await self.on_expire(key)
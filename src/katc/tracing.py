@@ -0,0 +1,104 @@
+import logging
+import pyModeS as pms
+
+from katc import events, positions
+
+log = logging.getLogger(__name__)
+
+# seconds without messages before a trace gives up on starting, starts ending, and completes
+START_WINDOW = 30
+ENDING_WINDOW = 45
+COMPLETE_WINDOW = 360
+
+class Cancel(Exception):
+    ...
+
+class TraceSession:
+    __slots__ = ("icao", "callsign", "positions", "started", "last_seen", "total_messages", "ending")
+
+    def __init__(self, icao, now, receiver = positions.DEFAULT_RECEIVER):
+        self.icao = icao
+        self.callsign = None
+        self.positions = positions.PositionSolver(receiver)
+        self.started = now
+        self.last_seen = None
+        self.total_messages = 0
+        self.ending = False
+
+    def on_frame(self, frame, now):
+        icao = frame.icao
+        tc = frame.typecode
+        body = frame.body
+
+        log.debug(f"{icao}: {body}")
+
+        if tc == None:
+            log.warning(f"No TC from {icao}: {body}")
+            return None
+
+        event = None
+        timestamp_ns = frame.timestamp_ns or int(now * 1e9)
+        if 1 <= tc <= 4:
+            if self.callsign == None:
+                try:
+                    self.callsign = pms.adsb.callsign(body).rstrip("_ ")
+                except:
+                    log.warning(f"Ident message without callsign: {body}")
+                    return None
+
+                event = events.TraceEvent(icao, tc, timestamp_ns, callsign = self.callsign)
+        elif 9 <= tc <= 18 or 20 <= tc <= 22:
+            position = self.positions.update(body, now)
+            altitude = pms.adsb.altitude(body)
+            if altitude is not None and tc >= 20:
+                # GNSS height comes in meters
+                altitude = round(altitude * events.METERS_TO_FEET)
+            lat, lon = (None, None) if position is None else position
+            event = events.TraceEvent(icao, tc, timestamp_ns, lat = lat, lon = lon, altitude = altitude)
+        elif tc == 19:
+            velocity = pms.adsb.velocity(body)
+            # None when the frame's velocity field is zero, which says nothing
+            if velocity is not None:
+                speed, heading, vertical_rate = velocity[:3]
+                # events keeps the heading to a hundredth of a degree, so it stays a float
+                event = events.TraceEvent(icao, tc, timestamp_ns,
+                                          speed = None if speed is None else int(speed),
+                                          heading = heading,
+                                          vertical_rate = None if vertical_rate is None else int(vertical_rate))
+        elif tc == 28:
+            event = events.TraceEvent(icao, tc, timestamp_ns, squawk = pms.adsb.emergency_squawk(body))
+        elif tc == 29:
+            target_altitude = pms.adsb.selected_altitude(body)[0]
+            event = events.TraceEvent(icao, tc, timestamp_ns, target_altitude = target_altitude)
+        elif tc == 31:
+            event = events.TraceEvent(icao, tc, timestamp_ns)
+
+        self.last_seen = now
+        self.total_messages += 1
+        if self.ending:
+            self.ending = False
+            log.info(f"Resuming trace of {self.icao}")
+
+        if event is not None and event.callsign is None and self.callsign is not None:
+            event = event._replace(callsign = self.callsign)
+        return event
+
+    def deadline(self):
+        # the next time check() could change anything, assuming no more messages arrive
+        if self.last_seen is None:
+            return self.started + START_WINDOW
+        elif self.ending:
+            return self.last_seen + COMPLETE_WINDOW
+        return self.last_seen + ENDING_WINDOW
+
+    def check(self, now):
+        # raises Cancel once the trace is over; resuming happens as soon as a message arrives
+        if now < self.deadline():
+            return
+        elif self.last_seen is None:
+            raise Cancel("Trace never started")
+        elif self.ending:
+            raise Cancel("Trace complete")
+
+        self.ending = True
+        log.info(f"Trace of {self.icao} ending")
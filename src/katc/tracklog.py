@@ -0,0 +1,119 @@
+import numpy as np
+import os
+import struct
+
+# Append-only columnar track log. The file is a run of self-contained blocks:
+#
+#   header   magic, version, row count, index entry count, min/max timestamp
+#   columns  one contiguous little-endian array per column, rows sorted by (icao, timestamp)
+#   index    one entry per ICAO in the block: first row, row count, min/max timestamp
+#
+# Nothing is padded, so with an odd row count the 4-byte columns leave what follows them (the index, the
+# next block) only 4-byte aligned. numpy views don't need alignment, so a reader can still memory-map the
+# file, hop from header to header and hand out slices of the column arrays without copying.
+
+MAGIC = b"KTRK"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIdd")
+COLUMNS = [("timestamp", "<f8"),
+           ("lat", "<f8"),
+           ("lon", "<f8"),
+           ("icao", "<u4"),
+           ("altitude", "<f4"),
+           ("speed", "<f4"),
+           ("heading", "<f4")]
+ROW_SIZE = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+INDEX = np.dtype([("icao", "<u4"), ("start", "<u4"), ("count", "<u4"), ("pad", "<u4"),
+                  ("min_ts", "<f8"), ("max_ts", "<f8")])
+
+class TrackWriter:
+    def __init__(self, path, block_rows = 4096):
+        self.path = path
+        self.block_rows = block_rows
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, timestamp, icao, lat, lon, altitude, speed, heading):
+        # unknown values go in as NaN
+        self.rows.append((timestamp, lat, lon, int(icao, 16), altitude, speed, heading))
+        return len(self.rows) >= self.block_rows
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+
+        rows, self.rows = self.rows, []
+        table = np.array(rows, dtype=[(name, dtype) for name, dtype in COLUMNS])
+        table = table[np.lexsort((table["timestamp"], table["icao"]))]
+
+        icaos, starts, counts = np.unique(table["icao"], return_index=True, return_counts=True)
+        index = np.zeros(len(icaos), dtype=INDEX)
+        index["icao"] = icaos
+        index["start"] = starts
+        index["count"] = counts
+        index["min_ts"] = table["timestamp"][starts]
+        index["max_ts"] = table["timestamp"][starts + counts - 1]
+
+        header = HEADER.pack(MAGIC, VERSION, 0, len(table), len(index),
+                             table["timestamp"].min(), table["timestamp"].max())
+        with open(self.path, "ab") as f:
+            f.write(header)
+            for name, dtype in COLUMNS:
+                f.write(np.ascontiguousarray(table[name]).tobytes())
+            f.write(index.tobytes())
+
+class TrackLog:
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > 0 else np.zeros(0, np.uint8)
+
+    def blocks(self):
+        offset = 0
+        while offset + HEADER.size <= len(self.data):
+            magic, version, _, rows, entries, min_ts, max_ts = HEADER.unpack_from(self.data, offset)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{self.path}: bad block header at {offset}")
+
+            size = HEADER.size + rows * ROW_SIZE + entries * INDEX.itemsize
+            if offset + size > len(self.data):
+                # a block still being written
+                return
+
+            columns = dict()
+            position = offset + HEADER.size
+            for name, dtype in COLUMNS:
+                dtype = np.dtype(dtype)
+                columns[name] = self.data[position:position + rows * dtype.itemsize].view(dtype)
+                position += rows * dtype.itemsize
+
+            index = self.data[position:position + entries * INDEX.itemsize].view(INDEX)
+            yield min_ts, max_ts, columns, index
+            offset += size
+
+    def track(self, icao, start = None, end = None):
+        # one dict of column views per block that holds rows for this aircraft in [start, end]
+        icao = int(icao, 16)
+        for min_ts, max_ts, columns, index in self.blocks():
+            if (start is not None and max_ts < start) or (end is not None and min_ts > end):
+                continue
+
+            i = np.searchsorted(index["icao"], icao)
+            if i == len(index) or index["icao"][i] != icao:
+                continue
+
+            first = int(index["start"][i])
+            last = first + int(index["count"][i])
+            timestamps = columns["timestamp"][first:last]
+            if start is not None:
+                first += int(np.searchsorted(timestamps, start, side="left"))
+            if end is not None:
+                last = first + int(np.searchsorted(columns["timestamp"][first:last], end, side="right"))
+            if first < last:
+                yield {name: column[first:last] for name, column in columns.items()}
+
+def concatenate(slices):
+    slices = list(slices)
+    return {name: np.concatenate([s[name] for s in slices]) if slices else np.zeros(0, dtype)
+            for name, dtype in COLUMNS}
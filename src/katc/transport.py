@@ -0,0 +1,52 @@
+import aio_pika
+import asyncio
+import base64
+import json
+import urllib.request
+
+from urllib.parse import quote, unquote, urlparse
+
+from katc import inprocess
+
+# Services take a broker URL. amqp:// and amqps:// go to RabbitMQ; memory://NAME is an in-process broker
+# shared by every connection in this process that uses the same NAME. Both hand back objects with the
+# same connection/channel/exchange/queue interface, so registrations.Exchanges works on either.
+
+MEMORY_SCHEME = "memory"
+
+brokers = dict()
+
+def broker(name = ""):
+    if name not in brokers:
+        brokers[name] = inprocess.Broker()
+    return brokers[name]
+
+def in_process(url):
+    return urlparse(url).scheme == MEMORY_SCHEME
+
+async def connect(url):
+    if in_process(url):
+        return await broker(urlparse(url).netloc).connect()
+    return await aio_pika.connect_robust(url)
+
+async def bindings(url, exchange, management_url = None):
+    # (queue, routing key) for everything bound to an exchange. AMQP itself can't list bindings, so for
+    # RabbitMQ this goes through the management plugin's HTTP API.
+    if in_process(url):
+        exchange = broker(urlparse(url).netloc).exchanges[exchange]
+        return [(queue.name, routing_key) for queue, routing_key, _ in exchange.bindings]
+    if management_url is None:
+        raise ValueError("Reading RabbitMQ bindings needs the management API URL")
+
+    vhost = unquote(urlparse(url).path[1:]) or "/"
+    return await asyncio.to_thread(management_bindings, management_url, vhost, exchange)
+
+def management_bindings(management_url, vhost, exchange):
+    parsed = urlparse(management_url)
+    request = urllib.request.Request(f"{parsed.scheme}://{parsed.hostname}:{parsed.port or 15672}"
+                                     f"/api/exchanges/{quote(vhost, safe='')}/{quote(exchange, safe='')}/bindings/source")
+    credentials = f"{unquote(parsed.username or 'guest')}:{unquote(parsed.password or 'guest')}"
+    request.add_header("Authorization", f"Basic {base64.b64encode(credentials.encode()).decode()}")
+    with urllib.request.urlopen(request, timeout = 10) as response:
+        return [(binding["destination"], binding["routing_key"]) for binding in json.load(response)
+                if binding["destination_type"] == "queue"]
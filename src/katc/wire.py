@@ -0,0 +1,82 @@
+import aio_pika
+import struct
+import time
+
+from collections import namedtuple
+
+# Routed Mode S frames travel either as hex text with an icao/typecode/downlink headers table (the
+# original format), or as a packed envelope followed by the raw 7/14-byte frame. The AMQP content_type
+# says which one a message is, so consumers that understand both can run next to either kind of router.
+BINARY_CONTENT_TYPE = "application/x-katc-modes"
+VERSION = 1
+ENVELOPE = struct.Struct(">BBBIQ")
+NO_TYPECODE = 0xFF
+NO_ICAO = 0xFFFFFFFF
+# the send time of a text message, in ns. The AMQP timestamp property only holds whole seconds, so it is
+# just the fallback for messages from before this header.
+TIMESTAMP_HEADER = "ts_ns"
+# what a Beast receiver adds to a frame: its 12 MHz MLAT counter and signal level. Only frames that came
+# from one carry these headers.
+MLAT_HEADER = "mlat"
+SIGNAL_HEADER = "signal"
+
+Frame = namedtuple("Frame", ["downlink", "typecode", "icao", "timestamp_ns", "body", "mlat", "signal"],
+                   defaults = (None, None))
+
+def beast_headers(mlat, signal):
+    return {} if mlat is None else {MLAT_HEADER: mlat, SIGNAL_HEADER: signal}
+
+def text_message(body, downlink, typecode, icao, timestamp_ns = None, mlat = None, signal = None):
+    headers = {"icao": icao,
+               "typecode": typecode,
+               "downlink": downlink} | beast_headers(mlat, signal)
+    if timestamp_ns is not None:
+        headers[TIMESTAMP_HEADER] = timestamp_ns
+    return aio_pika.Message(body,
+                            timestamp = None if timestamp_ns is None else timestamp_ns / 1e9,
+                            headers = headers)
+
+def binary_message(raw, downlink, typecode, icao, timestamp_ns, mlat = None, signal = None):
+    envelope = ENVELOPE.pack(VERSION,
+                             downlink,
+                             NO_TYPECODE if typecode is None else typecode,
+                             NO_ICAO if icao is None else int(icao, 16),
+                             timestamp_ns)
+    return aio_pika.Message(envelope + raw,
+                            content_type = BINARY_CONTENT_TYPE,
+                            headers = beast_headers(mlat, signal) or None)
+
+def decode(message):
+    if message.content_type != BINARY_CONTENT_TYPE:
+        headers = message.headers
+        return Frame(headers.get("downlink"), headers["typecode"], headers["icao"], sent_ns(message),
+                     message.body.decode(), headers.get(MLAT_HEADER), headers.get(SIGNAL_HEADER))
+
+    version, downlink, typecode, icao, timestamp_ns = ENVELOPE.unpack_from(message.body)
+    if version != VERSION:
+        raise ValueError(f"Unknown envelope version {version}")
+
+    headers = message.headers or {}
+    return Frame(downlink,
+                 None if typecode == NO_TYPECODE else typecode,
+                 None if icao == NO_ICAO else "%06X" % icao,
+                 timestamp_ns,
+                 message.body[ENVELOPE.size:].hex().upper(),
+                 headers.get(MLAT_HEADER),
+                 headers.get(SIGNAL_HEADER))
+
+def sent_ns(message):
+    # when the message was sent, or None if it doesn't say
+    if message.content_type == BINARY_CONTENT_TYPE:
+        return ENVELOPE.unpack_from(message.body)[4]
+
+    sent = (message.headers or {}).get(TIMESTAMP_HEADER)
+    if sent is not None:
+        return sent
+    elif message.timestamp is not None:
+        return int(message.timestamp.timestamp() * 1e9)
+    return None
+
+def timestamp_ns(message):
+    sent = sent_ns(message)
+    return time.time_ns() if sent is None else sent
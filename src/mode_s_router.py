@@ -3,15 +3,16 @@ import aio_pika
 import asyncio
 import argparse
 import os
-import pyModeS as pms
 import daemon
 import sys
 import logging
 import logging.handlers
+import multiprocessing
+import time
 
 from pidlockfile import PIDLockFile
 from setproctitle import setproctitle
-from katc import registrations
+from katc import registrations, batching, decode, filtering, metrics, sharding, shedding, transport, wire
 
 log = logging.getLogger("mode_s_router")
 log.setLevel(logging.INFO)
@@ -23,12 +24,31 @@ log.addHandler(logging.StreamHandler())
 mode_s_exchange = None
 adsb_exchange = None
 flyby_exchange = None
+binary_wire = False
+downlink_watcher = None
+
+DECODED = metrics.counter("frames_decoded")
+UNDECODABLE = metrics.counter("frames_undecodable")
+DECODE_TIME = metrics.histogram("decode_seconds")
+PUBLISH_TIME = metrics.histogram("route_publish_seconds")
 
 async def main(args):
+    if args.workers > 1 and transport.in_process(args.rabbit):
+        raise ValueError("-w/--workers needs RabbitMQ; worker processes can't share an in-process broker")
+    elif args.workers > 1:
+        await shard_main(args)
+    else:
+        await router_main(args, "mode_s_router", "mode_s", "raw")
+
+async def router_main(args, queue_name, source_exchange, routing_key):
     global mode_s_exchange
     global adsb_exchange
+    global binary_wire
+    global downlink_watcher
 
-    rabbit = await aio_pika.connect_robust(args.rabbit)
+    binary_wire = args.wire == "binary"
+
+    rabbit = await transport.connect(args.rabbit)
 
     channel = await rabbit.channel()
     mode_s_exchange = await channel.declare_exchange("mode_s_by_downlink",
@@ -42,52 +62,128 @@ async def main(args):
 
     await drop_queue.bind(mode_s_exchange, "*")
 
-    queue = await channel.declare_queue("mode_s_router",
+    queue = await channel.declare_queue(queue_name,
                                         durable = True)
 
-    await queue.bind("mode_s", "raw")
+    await queue.bind(source_exchange, routing_key)
+    background = [metrics.export(args, channel, queue_name)]
+    if args.learn_downlinks:
+        # skip publishing the DFs nobody has bound to mode_s_by_downlink
+        downlink_watcher = filtering.DownlinkWatcher(args.rabbit, args.management_url)
+        background.append(downlink_watcher.run())
 
-    async with queue.iterator() as queue_iter:
-        log.info(f"Bound to queue {queue.name}")
+    async def consume():
+        async with queue.iterator() as queue_iter:
+            log.info(f"Bound to queue {queue.name}")
 
-        async for message in queue_iter:
-            async with message.process():
-                await route(message)
+            async for message in queue_iter:
+                async with message.process():
+                    await route(message)
 
-async def route(message):
-    data = message.body.decode()
-    try:
-        df = pms.df(data)
-    except:
-        log.error(f"Failed to decode: {data}")
-        return
+    await asyncio.gather(consume(), *background)
 
-    try:
-        icao = pms.icao(data)
-    except:
-        log.error(f"No ICAO on {df}: {data}")
-        return
+async def shard_main(args):
+    workers = [multiprocessing.Process(target = run_worker, args = (args, shard), daemon = True)
+               for shard in range(args.workers)]
+    for worker in workers:
+        worker.start()
 
-    tc = pms.adsb.typecode(data)
-    if tc == None and 17 <= df <= 18:
-        log.error(f"No typecode ({df}): {data}")
-        return
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+    shards_exchange = await registrations.Exchanges.ModeSShards(channel)
 
-    routed_message = aio_pika.Message(message.body,
-                                      headers = {"icao": icao,
-                                                 "typecode": tc,
-                                                 "downlink": df})
+    queue = await channel.declare_queue("mode_s_router",
+                                        durable = True)
+    await queue.bind("mode_s", "raw")
 
-    await mode_s_exchange.publish(routed_message, routing_key = str(df))
-    if df == 17 or df == 18:
-        await adsb_exchange.publish(routed_message, f"icao.{icao}.typecode.{tc}")
+    async def consume():
+        async with queue.iterator() as queue_iter:
+            log.info(f"Sharding {queue.name} across {args.workers} workers")
 
-if __name__ == "__main__":
+            async for message in queue_iter:
+                async with message.process():
+                    await shard(message, shards_exchange, args.workers)
+
+    try:
+        await asyncio.gather(consume(), metrics.export(args, channel, "mode_s_router"))
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+async def shard(message, shards_exchange, shards):
+    buckets = dict()
+    beast = (message.headers or {}).get(batching.BATCH_HEADER) == batching.BEAST_FORMAT
+    if beast:
+        # keep the receive times and signal levels with the frames
+        for timestamp_ns, mlat, signal, raw in batching.beast_records(message):
+            buckets.setdefault(sharding.shard_for(raw.hex().upper().encode(), shards), []).append(
+                batching.beast_record(timestamp_ns, mlat, signal, raw))
+    else:
+        for frame in batching.unpack(message):
+            buckets.setdefault(sharding.shard_for(frame, shards), []).append(frame)
+
+    batch_format = batching.BEAST_FORMAT if beast else batching.NEWLINE_FORMAT
+    await asyncio.gather(*(shards_exchange.publish(batching.pack(frames, wire.timestamp_ns(message), batch_format),
+                                                   routing_key = str(shard))
+                           for shard, frames in buckets.items()))
+
+def run_worker(args, shard):
+    # each worker exports its own numbers, on the ports after the router's
+    args = argparse.Namespace(**vars(args))
+    if args.metrics_port is not None:
+        args.metrics_port += shard + 1
+    setproctitle(f"yetanother1090monitor: mode_s_router [{shard}]")
+    asyncio.run(router_main(args, f"mode_s_router_{shard}", "mode_s_shards", str(shard)))
+
+async def route(message):
+    frames = batching.unpack(message)
+    started = time.perf_counter()
+    decoded = decode.decode_frames(frames)
+    DECODE_TIME.record(time.perf_counter() - started)
+    batch_received = wire.timestamp_ns(message)
+    details = batching.receive_details(message)
+
+    for i, frame in enumerate(frames):
+        if not decoded.valid[i]:
+            UNDECODABLE.inc()
+            log.error(f"Failed to decode: {frame.decode(errors = 'replace')}")
+            continue
+
+        DECODED.inc()
+        df = int(decoded.df[i])
+        icao = decoded.icao_at(i)
+        tc = decoded.typecode_at(i)
+        received, mlat, signal = (batch_received, None, None) if details is None else details[i]
+
+        if binary_wire:
+            routed_message = wire.binary_message(decoded.raw_at(i), df, tc, icao, received, mlat, signal)
+        else:
+            routed_message = wire.text_message(frame, df, tc, icao, received, mlat, signal)
+
+        started = time.perf_counter()
+        if downlink_watcher is None or downlink_watcher.downlinks is None or df in downlink_watcher.downlinks:
+            await mode_s_exchange.publish(routed_message, routing_key = str(df))
+        if df == 17 or df == 18:
+            # so a backed-up queue hands out positions and identification ahead of everything else
+            routed_message.priority = shedding.priority(tc)
+            await adsb_exchange.publish(routed_message, f"icao.{icao}.typecode.{tc}")
+        PUBLISH_TIME.record(time.perf_counter() - started)
+
+def arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--daemon", action="store_true")
     parser.add_argument("-p", "--pidfile")
     parser.add_argument("-r", "--rabbit", required=True)
-    args = parser.parse_args()
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--wire", choices=["text", "binary"], default="text")
+    parser.add_argument("--learn-downlinks", action="store_true",
+                        help="only publish DFs bound on mode_s_by_downlink")
+    parser.add_argument("--management-url", help="RabbitMQ management API, for --learn-downlinks")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = arguments().parse_args()
 
     if args.daemon:
         if args.pidfile is None or len(args.pidfile) == 0:
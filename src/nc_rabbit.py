@@ -6,12 +6,14 @@ import aio_pika.abc
 import asyncio
 import time
 import os
+import random
 import daemon
 import logging
 import logging.handlers
 
 from pidlockfile import PIDLockFile
 from setproctitle import setproctitle
+from katc import batching, beast, dedup, filtering, metrics, transport
 
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -20,31 +22,145 @@ syslog.ident = "nc_rabbit.py: "
 log.addHandler(syslog)
 log.addHandler(logging.StreamHandler())
 
+# seconds between reconnect attempts, doubling from MIN to MAX while a receiver stays down
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
 async def dump1090_loop(args) -> None:
     conn_string = args.rabbit
 
-    rabbit: aio_pika.RobustConnection = await aio_pika.connect_robust(conn_string)
+    rabbit = await transport.connect(conn_string)
     channel: aio_pika.abc.AbstractChannel = await rabbit.channel()
     exchange = await channel.declare_exchange("mode_s", type = aio_pika.ExchangeType.FANOUT)
 
-    reader, writer = await asyncio.open_connection(args.target_ip, 30002)
-    log.info(f"Connected to {args.target_ip}")
+    deduplicator = None
+    if len(args.target_ip) > 1 or args.dedup:
+        # one receiver has no duplicates to drop, only frames that legitimately repeat
+        deduplicator = dedup.Deduplicator(args.dedup_window / 1000)
 
-    async for line in reader:
-        now = time.time_ns()
-        line = line.rstrip()[1:-1]
-                
-        await exchange.publish(aio_pika.Message(body = line,
-                                                timestamp = time.time()),
-                                                routing_key = 'raw')
+    frame_filter = None
+    background = [metrics.export(args, channel, "nc_rabbit")]
+    if args.filter or args.known_icao_only or args.downlinks is not None or args.learn_downlinks:
+        frame_filter = filtering.FrameFilter(args.downlinks, args.known_icao_only)
+        if args.learn_downlinks:
+            watcher = filtering.DownlinkWatcher(args.rabbit, args.management_url)
+            watcher.listeners.append(frame_filter)
+            background.append(watcher.run())
 
-if __name__ == "__main__":
+    await asyncio.gather(*(receive(args, exchange, target, deduplicator, frame_filter) for target in args.target_ip),
+                         *background)
+
+def parse_target(text):
+    # HOST, HOST:PORT, [IPV6] or [IPV6]:PORT; a bare IPv6 address is all host
+    if text.startswith("["):
+        host, _, port = text[1:].partition("]")
+        if port and not port.startswith(":"):
+            raise argparse.ArgumentTypeError(f"not a receiver: {text}")
+        port = port[1:]
+    elif text.count(":") == 1:
+        host, _, port = text.rpartition(":")
+    else:
+        host, port = text, ""
+    try:
+        return host, int(port) if port else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a receiver: {text}")
+
+async def receive(args, exchange, target, deduplicator, frame_filter):
+    host, port = target
+    port = port or args.port or (30005 if args.format == "beast" else 30002)
+    source = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+    # only tag frames with their receiver when there's more than one to tell apart
+    batch_format = batching.BEAST_FORMAT if args.format == "beast" else batching.NEWLINE_FORMAT
+    batcher = batching.Batcher(exchange, args.batch_size, args.batch_window / 1000, args.max_in_flight, batch_format,
+                               source if len(args.target_ip) > 1 else None)
+    received = metrics.counter("frames_received", source = source)
+    duplicates = metrics.counter("frames_duplicate", source = source)
+
+    delay = MIN_BACKOFF
+    try:
+        while True:
+            connected = time.monotonic()
+            try:
+                if args.format == "beast":
+                    await beast_loop(host, port, batcher, deduplicator, frame_filter, received, duplicates)
+                else:
+                    await avr_loop(host, port, batcher, deduplicator, frame_filter, received, duplicates)
+                log.warning(f"{source} closed the connection")
+            except OSError as x:
+                log.warning(f"Lost {source}: {x}")
+            await batcher.flush()
+
+            if time.monotonic() - connected > MAX_BACKOFF:
+                # it was up for a while, so this is a fresh outage
+                delay = MIN_BACKOFF
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, MAX_BACKOFF)
+    finally:
+        await batcher.close()
+
+async def avr_loop(host, port, batcher, deduplicator, frame_filter, received, duplicates):
+    reader, writer = await asyncio.open_connection(host, port)
+    log.info(f"Connected to {host}:{port}")
+
+    try:
+        async for line in reader:
+            line = line.rstrip()[1:-1]
+            received.inc()
+            if deduplicator is not None and deduplicator.seen(line):
+                duplicates.inc()
+                continue
+            if frame_filter is not None and not frame_filter.keep_hex(line):
+                continue
+            await batcher.add(line)
+    finally:
+        writer.close()
+
+async def beast_loop(host, port, batcher, deduplicator, frame_filter, received, duplicates):
+    async def on_frame(timestamp_ns, mlat, signal, payload):
+        received.inc()
+        # the payload is a view into the receive buffer, so this copy is what outlives the next read
+        raw = bytes(payload)
+        if deduplicator is not None and deduplicator.seen(raw):
+            duplicates.inc()
+            return
+        if frame_filter is not None and not frame_filter.keep(raw):
+            return
+        await batcher.add(batching.beast_record(timestamp_ns, mlat, signal, raw))
+
+    log.info(f"Reading Beast frames from {host}:{port}")
+    await beast.read_frames(host, port, on_frame)
+
+def arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--daemon", action="store_true")
     parser.add_argument("-p", "--pidfile")
     parser.add_argument("-r", "--rabbit", required=True)
-    parser.add_argument("-t", "--target-ip", required=True)
-    args = parser.parse_args()
+    parser.add_argument("-t", "--target-ip", required=True, action="append", type=parse_target,
+                        help="receiver as HOST[:PORT] or [IPV6][:PORT]; repeat for more than one")
+    parser.add_argument("-f", "--format", choices=["avr", "beast"], default="avr",
+                        help="dump1090's AVR text (port 30002) or Beast binary (port 30005) output")
+    parser.add_argument("--port", type=int, help="defaults to dump1090's port for --format")
+    parser.add_argument("-b", "--batch-size", type=int, default=1)
+    parser.add_argument("-w", "--batch-window", type=int, default=50, help="milliseconds")
+    parser.add_argument("-m", "--max-in-flight", type=int, default=64)
+    parser.add_argument("--dedup-window", type=float, default=500,
+                        help="milliseconds within which the same frame from another receiver is dropped")
+    parser.add_argument("--dedup", action="store_true",
+                        help="drop repeated frames even from a single receiver; on by default with several")
+    parser.add_argument("--filter", action="store_true",
+                        help="drop malformed frames and DF 11/17/18 with bad CRC; implied by the options below")
+    parser.add_argument("--known-icao-only", action="store_true",
+                        help="also drop address/parity frames from aircraft not seen in a DF 11/17/18 lately")
+    parser.add_argument("--downlinks", type=filtering.parse_downlinks, help="only publish these DFs, e.g. 4,5,17,18")
+    parser.add_argument("--learn-downlinks", action="store_true",
+                        help="only publish DFs bound on mode_s_by_downlink, plus 17 and 18")
+    parser.add_argument("--management-url", help="RabbitMQ management API, for --learn-downlinks")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    args = arguments().parse_args()
 
     if args.daemon:
         if args.pidfile is None or len(args.pidfile) == 0:
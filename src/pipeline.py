@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import shlex
+import sys
+import daemon
+import logging
+
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import metrics, registrations, transport
+
+import archiver
+import flight_state
+import mode_s_router
+import nc_rabbit
+import snapshot
+import spatial_index
+import trace_dispatcher
+import trace_engine
+
+# Runs several services as tasks in one process. With the default memory:// broker, messages go from one
+# service to the next without touching the network or being serialized.
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+log.handlers = []
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+logging.getLogger("mode_s_router").propagate = False
+
+# service -> (module, how to start it once its args are parsed)
+SERVICES = {"archiver": (archiver, lambda args: archiver.main()),
+            "nc_rabbit": (nc_rabbit, lambda args: nc_rabbit.dump1090_loop(args)),
+            "mode_s_router": (mode_s_router, lambda args: mode_s_router.main(args)),
+            "trace_dispatcher": (trace_dispatcher, lambda args: trace_dispatcher.main()),
+            "trace_engine": (trace_engine, lambda args: trace_engine.main()),
+            "flight_state": (flight_state, lambda args: flight_state.main()),
+            "snapshot": (snapshot, lambda args: snapshot.main()),
+            "spatial_index": (spatial_index, lambda args: spatial_index.main())}
+
+async def declare_exchanges():
+    # services bind to some exchanges by name before the service that publishes to them has started
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+    await channel.declare_exchange("mode_s", type = aio_pika.ExchangeType.FANOUT)
+    for declare in (registrations.Exchanges.ADSB,
+                    registrations.Exchanges.RPC,
+                    registrations.Exchanges.FlightStateChanges,
+                    registrations.Exchanges.Metrics,
+                    registrations.Exchanges.ModeSShards,
+                    registrations.Exchanges.Snapshots,
+                    registrations.Exchanges.TraceDispatch,
+                    registrations.Exchanges.TraceEvents,
+                    registrations.Exchanges.TracesForHumans):
+        await declare(channel)
+    return rabbit
+
+def service_arguments(name):
+    argv = ["-r", args.rabbit]
+    if name == "nc_rabbit":
+        for target in args.target_ip:
+            argv += ["-t", target]
+    if name in ("trace_dispatcher", "trace_engine"):
+        argv += ["-s", args.redis]
+    argv += shlex.split(args.options.get(name, ""))
+
+    module, _ = SERVICES[name]
+    return module.arguments().parse_args(argv)
+
+async def main():
+    rabbit = await declare_exchanges()
+
+    services = []
+    for name in args.services:
+        module, start = SERVICES[name]
+        module.args = service_arguments(name)
+        services.append(asyncio.create_task(start(module.args), name = name))
+        log.info(f"Started {name}")
+
+    # every service shares this process's metrics, so they're exported once for all of them
+    exporter = asyncio.create_task(metrics.export(args, await rabbit.channel(), "pipeline"))
+
+    try:
+        done, _ = await asyncio.wait(services, return_when = asyncio.FIRST_COMPLETED)
+        for service in done:
+            if service.exception() is not None:
+                log.error(f"{service.get_name()} stopped: {service.exception()}")
+            else:
+                log.error(f"{service.get_name()} stopped")
+    finally:
+        exporter.cancel()
+        for service in services:
+            service.cancel()
+        await asyncio.gather(exporter, *services, return_exceptions = True)
+        await rabbit.close()
+
+def parse_options(text):
+    name, _, options = text.partition("=")
+    if name not in SERVICES:
+        raise argparse.ArgumentTypeError(f"unknown service {name}")
+    return (name, options)
+
+if __name__ == "__main__":
+    global args
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
+    parser.add_argument("-r", "--rabbit", default="memory://pipeline")
+    parser.add_argument("-t", "--target-ip", action="append", help="dump1090 HOST[:PORT] for nc_rabbit; repeatable")
+    parser.add_argument("-s", "--redis", help="for trace_dispatcher and trace_engine")
+    parser.add_argument("--services", type=lambda text: text.split(","),
+                        default=["nc_rabbit", "mode_s_router", "trace_dispatcher", "trace_engine"])
+    parser.add_argument("-o", "--option", type=parse_options, action="append", default=[], dest="options",
+                        help="extra arguments for one service, as SERVICE=ARGS (flight_state='-t tracks.ktrk')")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    args.options = dict(args.options)
+
+    unknown = [name for name in args.services if name not in SERVICES]
+    if len(unknown) > 0:
+        parser.error(f"unknown services: {', '.join(unknown)}")
+    if "nc_rabbit" in args.services and args.target_ip is None:
+        parser.error("-t/--target-ip is required to run nc_rabbit")
+    if ("trace_dispatcher" in args.services or "trace_engine" in args.services) and args.redis is None:
+        parser.error("-s/--redis is required to run trace_dispatcher or trace_engine")
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
+
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: pipeline.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
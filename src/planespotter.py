@@ -2,12 +2,13 @@
 
 import aio_pika
 import asyncio
+import json
 import logging
 import pyModeS as pms
 
-from src import utils
+from katc import callsigns, consumer, rpc, utils, wire
 
-callsigns = dict()
+callsign_cache = callsigns.CallsignCache(max_size = 50000)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -16,11 +17,7 @@ console.setLevel(logging.INFO)
 console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
 logger.addHandler(console)
 
-rpc_exc = None
-
 async def main():
-    global rpc_exc
-
     broker = await utils.connect_to_rabbit()
     channel = await broker.channel()
 
@@ -32,42 +29,36 @@ async def main():
     rpc_exc = await channel.declare_exchange("rpc", aio_pika.ExchangeType.DIRECT, durable = True)
     rpc_queue = await channel.declare_queue("get-callsign")
     await rpc_queue.bind(rpc_exc)
+    await rpc_queue.bind(rpc_exc, "get-callsigns")
+
+    rpc_server = rpc.RpcServer(rpc_exc, {"get-callsign": get_callsign,
+                                         "get-callsigns": get_callsigns})
 
-    await asyncio.gather(consume(rpc_queue, on_rpc, True),
-                         consume(adsb_queue, on_message))
+    await asyncio.gather(consumer.consume(rpc_queue, rpc_server.on_request, no_ack = True),
+                         consumer.consume(adsb_queue, on_message, stage = "planespotter"))
 
-async def consume(queue, on_message, no_ack = False):
-    async with queue.iterator(no_ack = no_ack) as q:
-        async for message in q:
-            if no_ack:
-                await on_message(message)
-            else:
-                async with message.process():
-                    await on_message(message)
+async def get_callsign(icao):
+    return callsign_cache.get(icao) or callsigns.UNKNOWN
 
-async def on_rpc(message):
-    logger.debug(f"RPC {message.correlation_id}: {message.routing_key}({message.body.decode()}) -> {message.reply_to}")
-    if message.routing_key == "get-callsign":
-        icao = message.body.decode()
-        if icao in callsigns:
-            await rpc_exc.publish(aio_pika.Message(callsigns[icao].encode(),
-                                                   correlation_id = message.correlation_id),
-                                  message.reply_to)
+async def get_callsigns(icaos):
+    return json.dumps({icao: callsign_cache.get(icao) or callsigns.UNKNOWN
+                       for icao in json.loads(icaos)})
 
 async def on_message(message):
-    tc = message.headers["typecode"]
-    icao = message.headers["icao"]
-    data = message.body.decode()
+    frame = wire.decode(message)
+    tc = frame.typecode
+    icao = frame.icao
+    data = frame.body
     try:
         callsign = pms.adsb.callsign(data).rstrip("_")
     except:
         logger.warn(f"No callsign: {data}")
         return
     
-    if icao in callsigns:
+    if callsign_cache.get(icao):
         return
 
-    callsigns[icao] = callsign
+    callsign_cache.put(icao, callsign)
     logger.info(f"{icao} -> {callsign}")
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import time
+import logging
+
+from katc import batching, capture, transport
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+log.addHandler(console)
+
+async def main():
+    connection = await transport.connect(args.rabbit)
+    channel = await connection.channel()
+    exchange = await channel.declare_exchange("mode_s", type = aio_pika.ExchangeType.FANOUT)
+    if transport.in_process(args.rabbit):
+        # nobody else shares this broker, so give the frames somewhere to land
+        sink = await channel.declare_queue("", exclusive = True, arguments = {"x-max-length": 1})
+        await sink.bind(exchange, "raw")
+
+    batcher = batching.Batcher(exchange, args.batch_size, args.batch_window / 1000, args.max_in_flight)
+    frames = 0
+
+    async def add(frame):
+        nonlocal frames
+        frames += 1
+        await batcher.add(frame)
+
+    log.info(f"Replaying {args.input} at {'full speed' if args.speed == 0 else f'{args.speed}x'}")
+    start = time.perf_counter()
+    try:
+        for _ in range(args.loops):
+            await capture.replay(capture.read_capture(args.input), add, args.speed)
+        await batcher.close()
+    finally:
+        elapsed = time.perf_counter() - start
+        log.info(f"Replayed {frames} frames in {elapsed:.2f}s ({int(frames / max(elapsed, 1e-9))} msg/s)")
+        await connection.close()
+
+if __name__ == "__main__":
+    global args
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True)
+    parser.add_argument("-r", "--rabbit", required=True,
+                        help="broker the pipeline reads mode_s from; memory:// only measures publishing")
+    parser.add_argument("-s", "--speed", type=float, default=1, help="multiple of real time; 0 for no pacing")
+    parser.add_argument("-n", "--loops", type=int, default=1)
+    parser.add_argument("-b", "--batch-size", type=int, default=1)
+    parser.add_argument("-w", "--batch-window", type=int, default=50, help="milliseconds")
+    parser.add_argument("-m", "--max-in-flight", type=int, default=64)
+    args = parser.parse_args()
+
+    asyncio.run(main())
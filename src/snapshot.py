@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import time
+import sys
+import daemon
+import logging
+import logging.handlers
+
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import consumer, events, metrics, registrations, shedding, snapshots, transport, utils
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+
+# Conflates trace events into a snapshot feed (see katc.snapshots) for visualization clients, so what a
+# client receives grows with the number of aircraft rather than the message rate. A client:
+#
+#   1. binds a queue (best with a small x-max-length) to the snapshots exchange
+#   2. binds the same queue to the rpc exchange under its own name
+#   3. publishes to rpc with routing key snapshot-keyframe and reply_to set to its queue
+#
+# and gets a keyframe followed by a delta every tick, skipping deltas numbered at or below the keyframe.
+
+table = None
+snapshot_xch = None
+rpc_xch = None
+
+FRAMES = {kind: metrics.counter("snapshot_frames", kind = kind) for kind in ("keyframe", "delta")}
+BYTES = {kind: metrics.counter("snapshot_bytes", kind = kind) for kind in ("keyframe", "delta")}
+AIRCRAFT = metrics.gauge("snapshot_aircraft")
+
+async def main():
+    global table
+    global snapshot_xch
+    global rpc_xch
+
+    table = snapshots.SnapshotTable(args.lost_after)
+
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+    rpc_channel = await rabbit.channel()
+
+    snapshot_xch = await registrations.Exchanges.Snapshots(channel)
+    events_xch = await registrations.Exchanges.TraceEvents(channel)
+    events_queue = await channel.declare_queue(utils.random_string_with_prefix("snapshot_"),
+                                               durable=False,
+                                               exclusive=True,
+                                               arguments=shedding.queue_arguments("snapshot"))
+    await events_queue.bind(events_xch, "all.#")
+
+    rpc_xch = await registrations.Exchanges.RPC(rpc_channel)
+    rpc_queue = await rpc_channel.declare_queue("snapshot-keyframe")
+    await rpc_queue.bind(rpc_xch, "snapshot-keyframe")
+
+    log.info(f"Publishing snapshots at {args.rate} Hz")
+
+    try:
+        await asyncio.gather(consumer.consume(events_queue, on_event, no_ack = True, stage = "snapshot"),
+                             consumer.consume(rpc_queue, on_keyframe_request, no_ack = True),
+                             tick(),
+                             metrics.export(args, channel, "snapshot"))
+    except asyncio.exceptions.CancelledError:
+        ...
+    finally:
+        await rabbit.close()
+
+async def on_event(message):
+    table.apply(events.decode(message.body))
+
+async def tick():
+    interval = 1 / args.rate
+    next_tick = time.monotonic()
+    last_expiry = next_tick
+    last_keyframe = next_tick
+    while True:
+        next_tick += interval
+        await asyncio.sleep(max(0, next_tick - time.monotonic()))
+
+        now = time.monotonic()
+        if now - last_expiry >= 1:
+            table.expire()
+            AIRCRAFT.set(len(table))
+            last_expiry = now
+
+        frame = table.delta()
+        if frame is not None:
+            await publish(snapshot_xch, frame, "", "delta")
+
+        # now and then a keyframe for everyone, so a client that lost deltas catches up without asking
+        if args.keyframe_interval > 0 and now - last_keyframe >= args.keyframe_interval:
+            await publish(snapshot_xch, table.keyframe(), "", "keyframe")
+            last_keyframe = now
+
+        if time.monotonic() > next_tick + interval:
+            # fell behind; skip ticks rather than bunch them up
+            next_tick = time.monotonic()
+
+async def on_keyframe_request(message):
+    if message.reply_to is None:
+        log.warning("Keyframe request without reply_to")
+        return
+    await publish(rpc_xch, table.keyframe(), message.reply_to, "keyframe", message.correlation_id)
+
+async def publish(exchange, frame, routing_key, kind, correlation_id = None):
+    FRAMES[kind].inc()
+    BYTES[kind].inc(len(frame))
+    await exchange.publish(aio_pika.Message(frame,
+                                            content_type = snapshots.CONTENT_TYPE,
+                                            correlation_id = correlation_id,
+                                            type = kind),
+                           routing_key)
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
+    parser.add_argument("-r", "--rabbit", required=True)
+    parser.add_argument("--rate", type=float, default=2, help="deltas per second")
+    parser.add_argument("--keyframe-interval", type=float, default=30,
+                        help="seconds between keyframes on the feed; 0 for only on request")
+    parser.add_argument("--lost-after", type=float, default=60, help="seconds without events before an aircraft is removed")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
+
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: snapshot.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
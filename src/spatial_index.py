@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import json
+import time
+import sys
+import daemon
+import logging
+import logging.handlers
+
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import consumer, metrics, positions, registrations, rpc, shedding, spatial, transport, utils, wire
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+
+POSITION_TYPECODES = list(range(9, 19)) + list(range(20, 23))
+
+index = spatial.GridIndex()
+solvers = dict()
+
+async def main():
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+    rpc_channel = await rabbit.channel()
+
+    adsb_xch = await registrations.Exchanges.ADSB(channel)
+    adsb_queue = await channel.declare_queue(utils.random_string_with_prefix("spatial_index_"),
+                                             durable=False,
+                                             exclusive=True,
+                                             arguments=shedding.queue_arguments("spatial_index"))
+    for tc in POSITION_TYPECODES:
+        await adsb_queue.bind(adsb_xch, f"icao.*.typecode.{tc}")
+
+    rpc_xch = await registrations.Exchanges.RPC(rpc_channel)
+    rpc_queue = await rpc_channel.declare_queue("spatial-index")
+    rpc_server = rpc.RpcServer(rpc_xch, {"aircraft-within": aircraft_within,
+                                         "aircraft-in-box": aircraft_in_box,
+                                         "aircraft-nearest": aircraft_nearest})
+    for method_name in rpc_server.handlers:
+        await rpc_queue.bind(rpc_xch, method_name)
+
+    try:
+        await asyncio.gather(consumer.consume(adsb_queue, on_position, no_ack = True, stage = "spatial_index"),
+                             consumer.consume(rpc_queue, rpc_server.on_request, no_ack = True),
+                             evict_stale(),
+                             metrics.export(args, channel, "spatial_index"))
+    except asyncio.exceptions.CancelledError:
+        ...
+    finally:
+        await rabbit.close()
+
+async def on_position(message):
+    frame = wire.decode(message)
+    now = time.time() if frame.timestamp_ns is None else frame.timestamp_ns / 1e9
+
+    solver = solvers.get(frame.icao)
+    if solver is None:
+        solvers[frame.icao] = solver = positions.PositionSolver(args.receiver)
+
+    position = solver.update(frame.body, now)
+    if position is not None:
+        index.update(frame.icao, position[0], position[1], now)
+
+async def evict_stale():
+    while True:
+        await asyncio.sleep(10)
+        cutoff = time.time() - args.stale
+        for icao in index.evict_older_than(cutoff):
+            solvers.pop(icao, None)
+        # aircraft that never got a fix
+        for icao in [icao for icao, solver in solvers.items() if max(t or 0 for t in solver.times) < cutoff]:
+            del solvers[icao]
+
+def render(entries):
+    now = time.time()
+    return json.dumps([{"icao": entry[0], "lat": entry[1], "lon": entry[2], "age": now - entry[3]}
+                       | ({"distance_nm": entry[4]} if len(entry) > 4 else {})
+                       for entry in entries])
+
+async def aircraft_within(request):
+    request = json.loads(request)
+    return render(index.within(request["lat"], request["lon"], request["radius_nm"]))
+
+async def aircraft_in_box(request):
+    request = json.loads(request)
+    return render(index.box(request["south"], request["west"], request["north"], request["east"]))
+
+async def aircraft_nearest(request):
+    request = json.loads(request)
+    return render(index.nearest(request["lat"], request["lon"], request.get("k", 1)))
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
+    parser.add_argument("-r", "--rabbit", required=True)
+    parser.add_argument("-l", "--receiver", type=positions.parse_location, default=positions.DEFAULT_RECEIVER,
+                        help="receiver location as LAT,LON")
+    parser.add_argument("--stale", type=float, default=60, help="seconds before an aircraft is dropped")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
+
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: spatial_index.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
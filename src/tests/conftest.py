@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the services import katc as a top-level package, run from src/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+import os
+import pyModeS as pms
+import pytest
+
+from katc import decode
+
+# Every frame in the corpus is decoded in one batch and compared field by field with pyModeS, which is
+# what decode has to match. The corpus is grouped under # comments: captured frames, then generated ones
+# for each typecode and the edge cases (bad CRC, zero velocity fields, GNSS height, parity replies).
+CORPUS = os.path.join(os.path.dirname(__file__), "data", "decode_corpus.txt")
+
+def corpus():
+    with open(CORPUS) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+@pytest.fixture(scope = "module")
+def decoded():
+    frames = corpus()
+    return frames, decode.decode_frames([frame.encode() for frame in frames])
+
+def expected_altitude(frame, tc):
+    if tc is None or not (5 <= tc <= 18 or 20 <= tc <= 22):
+        return None
+    return pms.adsb.altitude(frame)
+
+def expected_velocity(frame, tc):
+    if tc != 19:
+        return None, None, None
+    velocity = pms.adsb.velocity(frame)
+    return (None, None, None) if velocity is None else tuple(velocity[:3])
+
+def test_corpus_covers_the_edge_cases(decoded):
+    frames, batch = decoded
+    tcs = [batch.typecode_at(i) for i in range(len(frames))]
+    assert any(pms.crc(frame) != 0 and pms.df(frame) == 17 for frame in frames)
+    assert any(tc == 19 and pms.adsb.velocity(frame) is None for frame, tc in zip(frames, tcs))
+    assert any(tc is not None and 20 <= tc <= 22 for tc in tcs)
+
+def test_matches_pymodes(decoded):
+    frames, batch = decoded
+    for i, frame in enumerate(frames):
+        df = pms.df(frame)
+        assert batch.valid[i], frame
+        assert batch.df[i] == df, frame
+        assert batch.crc[i] == pms.crc(frame), frame
+        assert batch.icao_at(i) == pms.icao(frame), frame
+
+        tc = pms.adsb.typecode(frame) if df in (17, 18) else None
+        assert batch.typecode_at(i) == tc, frame
+        assert batch.altitude_at(i) == expected_altitude(frame, tc), frame
+
+        speed, heading, vertical_rate = batch.velocity_at(i)
+        want_speed, want_heading, want_vertical_rate = expected_velocity(frame, tc)
+        assert speed == want_speed, frame
+        assert heading == want_heading, frame
+        assert vertical_rate == want_vertical_rate, frame
+
+        if tc is not None and 1 <= tc <= 4:
+            assert batch.callsign_at(i) == pms.adsb.callsign(frame), frame
+
+def test_rejects_malformed_frames():
+    batch = decode.decode_frames([b"8D4840D6202CC371C32CE05760", b"8D4840D6202CC371C32CE057609Z"])
+    assert not batch.valid.any()
+    assert batch.icao_at(0) is None and batch.typecode_at(1) is None
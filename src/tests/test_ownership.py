@@ -0,0 +1,151 @@
+import asyncio
+import shutil
+import socket
+import subprocess
+import time
+import pytest
+
+from redis import asyncio as aioredis
+
+from katc import ownership
+
+# The ownership scripts run against a throwaway redis-server when there is one on the PATH, otherwise
+# against fakeredis, which runs the same Lua.
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope = "module")
+def redis_server():
+    if shutil.which("redis-server") is None:
+        yield None
+        return
+
+    port = free_port()
+    server = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                              stdout = subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield f"redis://127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+@pytest.fixture
+def connect(redis_server):
+    # a connection per event loop, since each test runs its own
+    if redis_server is not None:
+        async def connect():
+            redis = aioredis.Redis.from_url(redis_server)
+            await redis.flushall()
+            return redis
+        return connect
+
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    async def connect():
+        return fakeredis.FakeAsyncRedis(server = server)
+    return connect
+
+async def request(redis, *icaos):
+    return [icao.decode() for icao in
+            await redis.register_script(ownership.REQUEST_TRACES)(args = [time.time(), 300, *icaos])]
+
+def test_register_acquire_release(connect):
+    async def run():
+        redis = await connect()
+        worker = ownership.Worker(redis, 10)
+        other = ownership.Worker(redis, 10)
+        await worker.heartbeat()
+
+        assert await request(redis, "4CA7B4") == ["4CA7B4"]
+        # already requested, and not yet started
+        assert await request(redis, "4CA7B4") == []
+        assert await worker.next_request() == "4CA7B4"
+        assert await worker.acquire("4CA7B4")
+        assert await redis.get("trace_4CA7B4") == worker.id.encode()
+        # a live worker's lease stays put
+        await other.heartbeat()
+        assert not await other.acquire("4CA7B4")
+
+        await worker.release("4CA7B4")
+        assert await redis.get("trace_4CA7B4") is None
+        assert await redis.smembers(f"trace_owned_{worker.id}") == set()
+        assert await other.acquire("4CA7B4")
+    asyncio.run(run())
+
+def test_steal_reap_and_lost(connect):
+    async def run():
+        redis = await connect()
+        lost = []
+        async def on_lost(icao):
+            lost.append(icao)
+
+        dying = ownership.Worker(redis, 10, on_lost = on_lost, timeout = 0.3)
+        await dying.heartbeat()
+        assert await dying.acquire("4CA7B4")
+        await request(redis, "400001", "400002")
+        assert await redis.llen(dying.queue) == 2
+
+        survivor = ownership.Worker(redis, 10, timeout = 10)
+        await survivor.heartbeat()
+        await asyncio.sleep(0.5)
+
+        # the dead worker's lease can be taken before it is reaped
+        assert await survivor.acquire("4CA7B4")
+        await survivor.heartbeat()
+        assert await redis.zscore("trace_workers", dying.id) is None
+        assert sorted(await survivor.more_requests(10)) == ["400001", "400002"]
+        assert await redis.get("trace_4CA7B4") == survivor.id.encode()
+
+        # it comes back, finds it was reaped, and gives up what it thought it had
+        await dying.heartbeat()
+        assert lost == ["4CA7B4"]
+        assert dying.owned == set()
+        assert await redis.get("trace_4CA7B4") == survivor.id.encode()
+    asyncio.run(run())
+
+def test_lost_before_reap(connect):
+    async def run():
+        redis = await connect()
+        lost = []
+        async def on_lost(icao):
+            lost.append(icao)
+
+        stalled = ownership.Worker(redis, 10, on_lost = on_lost, timeout = 0.3)
+        await stalled.heartbeat()
+        assert await stalled.acquire("4CA7B4")
+        assert await stalled.acquire("4CA7B5")
+        other = ownership.Worker(redis, 10, timeout = 10)
+        await other.heartbeat()
+        await asyncio.sleep(0.5)
+        assert await other.acquire("4CA7B4")
+
+        # heard from again before anyone reaped it: it keeps what nobody took
+        await stalled.heartbeat()
+        assert lost == ["4CA7B4"]
+        assert stalled.owned == {"4CA7B5"}
+        assert await redis.get("trace_4CA7B5") == stalled.id.encode()
+    asyncio.run(run())
+
+def test_requests_spread_by_capacity(connect):
+    async def run():
+        redis = await connect()
+        workers = [ownership.Worker(redis, capacity) for capacity in (10, 10, 20)]
+        for worker in workers:
+            await worker.heartbeat()
+
+        assert len(await request(redis, *(f"{i:06X}" for i in range(40)))) == 40
+        assert [await redis.llen(worker.queue) for worker in workers] == [10, 10, 20]
+
+        # leaving hands its queue to the others, in proportion to what they have room for
+        await workers[2].leave()
+        assert [await redis.llen(worker.queue) for worker in workers[:2]] == [20, 20]
+    asyncio.run(run())
@@ -0,0 +1,56 @@
+import random
+import pytest
+
+from katc import positions, spatial
+
+# The grid only narrows down where to look, so every query has to give what checking every aircraft would.
+# Centers are drawn toward the places a bounding box gets wrong: high latitudes, the poles, the antimeridian.
+CENTERS = [(0, 0), (52.3, 4.8), (70, 20), (78.2, 15.6), (85, -170), (89.5, 0), (-89, 45), (-60, 179.9),
+           (64.1, -179.8), (-33.9, 151.2)]
+RADII = [5, 50, 250, 1000, 3000]
+
+def brute_force(entries, lat, lon, radius_nm):
+    found = []
+    for icao, (other_lat, other_lon) in entries.items():
+        distance = positions.distance_nm((lat, lon), (other_lat, other_lon))
+        if distance <= radius_nm:
+            found.append((icao, distance))
+    return sorted(found, key = lambda entry: entry[1])
+
+@pytest.fixture(scope = "module")
+def index():
+    rng = random.Random(13)
+    entries = dict()
+    for i in range(4000):
+        if i % 2 == 0:
+            # around the centers, so small radii still find something
+            lat, lon = rng.choice(CENTERS)
+            lat = max(-90, min(90, lat + rng.uniform(-8, 8)))
+            lon = (lon + rng.uniform(-40, 40) + 180) % 360 - 180
+        else:
+            lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        entries["%06X" % i] = (lat, lon)
+
+    grid = spatial.GridIndex()
+    for icao, (lat, lon) in entries.items():
+        grid.update(icao, lat, lon, 0)
+    return grid, entries
+
+@pytest.mark.parametrize("center", CENTERS)
+@pytest.mark.parametrize("radius_nm", RADII)
+def test_within_matches_brute_force(index, center, radius_nm):
+    grid, entries = index
+    lat, lon = center
+    found = grid.within(lat, lon, radius_nm)
+    expected = brute_force(entries, lat, lon, radius_nm)
+    assert {entry[0] for entry in found} == {icao for icao, _ in expected}
+    assert [entry[4] for entry in found] == pytest.approx([distance for _, distance in expected])
+
+@pytest.mark.parametrize("center", CENTERS)
+@pytest.mark.parametrize("k", [1, 10, 100])
+def test_nearest_matches_brute_force(index, center, k):
+    grid, entries = index
+    lat, lon = center
+    found = grid.nearest(lat, lon, k)
+    expected = brute_force(entries, lat, lon, 2 * 180 * 60)[:k]
+    assert [entry[4] for entry in found] == pytest.approx([distance for _, distance in expected])
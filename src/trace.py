@@ -7,24 +7,20 @@ import sys
 import daemon
 import logging
 import logging.handlers
-import pyModeS as pms
 
-from katc import utils, registrations
+from katc import consumer, events, metrics, positions, utils, registrations, shedding, timers, tracing, transport, wire
 from setproctitle import setproctitle
 
-last_position = (41.4072, -81.8573)
-last_position_message_ts = None
-last_position_message = ""
-last_seen = None
-total_messages = 0
-ending = False
 log = None
 args = None
-callsign = None
+session = None
+expiry = None
+events_xch = None
 forward_xch = None
+delta = None
 
-class Cancel(Exception):
-    ...
+TRACED = metrics.counter("frames_traced")
+END_TO_END = metrics.histogram("end_to_end_seconds", service = "trace")
 
 def configure_logs():
     global log
@@ -37,35 +33,47 @@ def configure_logs():
     log.addHandler(console)
 
 async def main():
+    global events_xch
     global forward_xch
+    global session
+    global expiry
+    global delta
 
     configure_logs()
+    delta = events.delta_filter(args)
+    session = tracing.TraceSession(args.icao, time.time(), args.receiver)
+    expiry = timers.ExpiryScheduler(on_session_expiry)
+    expiry.schedule(args.icao, session.deadline())
 
-    rabbit = await aio_pika.connect_robust(args.rabbit)
+    rabbit = await transport.connect(args.rabbit)
     channel = await rabbit.channel()
 
     try:
         trace_queue = await channel.declare_queue(utils.random_string_with_prefix(f"trace_{args.icao}_"),
                                                         durable=False,
                                                         auto_delete=True,
-                                                        arguments={"x-expires": 5 * 60 * 1000})
+                                                        arguments=shedding.queue_arguments("trace", {"x-expires": 5 * 60 * 1000}))
 
-        forward_xch = await registrations.Exchanges.TracesForHumans(channel)
+        events_xch = await registrations.Exchanges.TraceEvents(channel)
+        if args.text:
+            forward_xch = await registrations.Exchanges.TracesForHumans(channel)
         trace_xch = await registrations.Exchanges.ADSB(channel)
         await trace_queue.bind(trace_xch, f"icao.{args.icao}.#")
 
         log.info(f"Tracing {args.icao} using {trace_queue.name}")
 
-        await asyncio.gather(consume(trace_queue, on_message),
-                             session_watcher())
-    except Cancel as x:
+        await asyncio.gather(consumer.consume(trace_queue, on_message, shedder = shedding.Shedder("trace"),
+                                              stage = "trace"),
+                             expiry.run(),
+                             metrics.export(args, channel, f"trace.{args.icao}"))
+    except tracing.Cancel as x:
         log.info(x)
     except Exception as x:
         log.error(x)
     except asyncio.exceptions.CancelledError:
         ...
     finally:
-        log.info(f"Ended after {total_messages} messages")
+        log.info(f"Ended after {session.total_messages} messages")
 
         try:
             await trace_queue.delete()
@@ -73,105 +81,27 @@ async def main():
             ...
         await rabbit.close()
 
-async def consume(queue, on_message):
-    async with queue.iterator() as q:
-        async for message in q:
-            async with message.process():
-                await on_message(message)
-
 async def on_message(message):
-    global last_position
-    global last_position_message
-    global last_position_message_ts
-    global last_seen
-    global total_messages
-    global callsign
-
-    icao = message.headers["icao"]
-    tc = message.headers["typecode"]
-    body = message.body.decode()
-
-    now = time.time()
-    log.debug(f"{icao}: {body}")
-
-    if tc == None:
-        log.warning(f"No TC from {icao}: {body}")
-        return
-
-    meaning = ""
-    if 1 <= tc <= 4 and callsign == None:
-        try:
-            callsign = pms.adsb.callsign(body).rstrip("_ ")
-        except:
-            log.warning(f"Ident message without callsign: {body}")
-            return
-
-        meaning = f"{icao} is now {callsign}"
-
-    if 9 <= tc <= 18 or 20 <= tc <= 22:
-        if last_position_message == "":
-            last_position = pms.adsb.position_with_ref(body, last_position[0], last_position[1])
-            last_position_message = body
-            last_position_message_ts = now
-        elif pms.adsb.oe_flag(last_position_message) != pms.adsb.oe_flag(body):
-            last_position = pms.adsb.position(last_position_message, body, last_position_message_ts, now)
-            last_position_message = body
-            last_position_message_ts = now
-
-        altitude = pms.adsb.altitude(body)
-        if tc <= 18:
-            meaning = f"position {last_position}, at {altitude} ft"
-        else:
-            meaning = f"position {last_position}, at {altitude} m"
-    elif tc == 19:
-        velocity = pms.adsb.velocity(body)
-        speed = int(velocity[0])
-        heading = int(velocity[1])
-        meaning = f"speed {speed} kt/s heading {heading}"
-    elif tc == 28:
-        squawk = pms.adsb.emergency_squawk(body)
-        meaning = f"squawk {squawk}"
-    elif tc == 29:
-        target_altitude = pms.adsb.selected_altitude(body)[0]
-        meaning = f"target altitude {target_altitude} ft"
-    elif tc == 31:
-        meaning = "operational status here"
-    if meaning != "":
-        meaning = f"{icao}/{callsign} sent {tc}: {body} - {meaning}"
-        await forward_xch.publish(aio_pika.Message(meaning.encode(),
-                                                   headers={"icao": icao,
-                                                            "typecode": tc}),
-                                  icao)
-
-    last_seen = time.time()
-    total_messages += 1
-
-async def session_watcher():
-    global ending
-
-    dead_count = 0
-    while True:
-        await asyncio.sleep(5)
-        if last_seen is None:
-            if dead_count < 6:
-                dead_count += 1
-                continue
-            else:
-                raise Cancel("Trace never started")
-
-        if ending:
-            if time.time() - last_seen > 360:
-                raise Cancel("Trace complete")
-            elif time.time() - last_seen < 45:
-                ending = False
-                log.info("Resuming trace")
-                continue
-
-        if time.time() - last_seen < 45:
-            continue
-        elif not ending:
-            ending = True
-            log.info("Trace ending")
+    frame = wire.decode(message)
+    TRACED.inc()
+    event = session.on_frame(frame, time.time())
+    expiry.schedule(session.icao, session.deadline())
+    if event is not None:
+        event_message = events.message(event)
+        await events_xch.publish(event_message, f"all.{event.icao}")
+        if delta.passes(event):
+            await events_xch.publish(event_message, f"delta.{event.icao}")
+        if forward_xch is not None:
+            await forward_xch.publish(aio_pika.Message(events.render(event, frame.body).encode(),
+                                                       headers={"icao": frame.icao,
+                                                                "typecode": frame.typecode}),
+                                      frame.icao)
+        if frame.timestamp_ns is not None:
+            END_TO_END.record(time.time() - frame.timestamp_ns / 1e9)
+
+async def on_session_expiry(icao):
+    session.check(time.time())
+    expiry.schedule(icao, session.deadline())
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -179,6 +109,10 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--rabbit", required=True)
     parser.add_argument("-d", "--daemon", action="store_true")
     parser.add_argument("-x", "--exclusive", action="store_true")
+    parser.add_argument("-l", "--receiver", type=positions.parse_location, default=positions.DEFAULT_RECEIVER,
+                        help="receiver location as LAT,LON")
+    events.add_arguments(parser)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     if args.daemon:
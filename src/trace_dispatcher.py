@@ -6,7 +6,6 @@ import logging.handlers
 import asyncio
 import argparse
 import daemon
-import uuid
 import time
 import subprocess
 import threading
@@ -14,7 +13,7 @@ import sys
 
 from pidlockfile import PIDLockFile
 from setproctitle import setproctitle
-from katc import utils, registrations
+from katc import consumer, metrics, ownership, utils, registrations, rpc, shedding, transport, wire
 from aio_pika.exceptions import DeliveryError
 from redis import asyncio as aioredis
 
@@ -26,98 +25,140 @@ console.setLevel(logging.DEBUG)
 log.addHandler(console)
 
 rpc_xch = None
-rpcs = dict()
-rpc_id = None
+rpc_client = None
 trace_xch = None
 channel = None
+request_traces_script = None
+
+# ICAO -> monotonic time until which we trust that a trace is already requested or running
+seen = dict()
+pending = set()
+
+REQUESTED = metrics.counter("traces_requested")
+REDIS_TIME = metrics.histogram("redis_seconds", service = "trace_dispatcher")
+REDIS_FAILURES = metrics.counter("redis_failures", service = "trace_dispatcher")
 
 async def main():
     global rpc_xch
-    global rpcs
-    global rpc_id
+    global rpc_client
     global adsb_xch
     global trace_xch
     global channel
     global redis
+    global request_traces_script
 
     redis = aioredis.Redis.from_url(args.redis)
+    request_traces_script = redis.register_script(ownership.REQUEST_TRACES)
 
-    rabbit = await aio_pika.connect_robust(args.rabbit)
+    rabbit = await transport.connect(args.rabbit)
     channel = await rabbit.channel()
     adsb_channel = await rabbit.channel()
 
     rpc_xch = await registrations.Exchanges.RPC(channel)
     rpc_queue = await channel.declare_queue(utils.random_string_with_prefix("trace_dispatcher_rpc_"), exclusive = True)
-    rpc_id = rpc_queue.name
     await rpc_queue.bind(rpc_xch)
+    rpc_client = rpc.RpcClient(rpc_xch, rpc_queue.name)
 
     trace_xch = await registrations.Exchanges.TraceDispatch(adsb_channel)
 
     adsb_xch = await registrations.Exchanges.ADSB(adsb_channel)
-    adsb_queue = await adsb_channel.declare_queue("trace_dispatcher_adsb", durable=True)
+    adsb_queue = await adsb_channel.declare_queue("trace_dispatcher_adsb_v2", durable=True,
+                                                arguments=shedding.queue_arguments("trace_dispatcher_adsb"))
     await adsb_queue.bind(adsb_xch, "#")
+    await shedding.retire_queue(rabbit, "trace_dispatcher_adsb")
 
     try:
-        await asyncio.gather(consume(rpc_queue, on_rpc_message, no_ack = True),
-                             consume(adsb_queue, on_adsb_message))
+        await asyncio.gather(consumer.consume(rpc_queue, rpc_client.on_reply, no_ack = True,
+                                              stage = "trace_dispatcher_rpc"),
+                             consumer.consume(adsb_queue, on_adsb_message, prefetch = args.prefetch,
+                                              stage = "trace_dispatcher_adsb"),
+                             request_traces(),
+                             watch_trace_keys(),
+                             metrics.export(args, channel, "trace_dispatcher"))
     except asyncio.exceptions.CancelledError:
         pass
     finally:
         await rabbit.close()
 
-async def consume(queue, on_message, no_ack = False):
-    async with queue.iterator(no_ack = no_ack) as q:
-        async for message in q:
-            if no_ack:
-                await on_message(message)
-            else:
-                async with message.process():
-                    await on_message(message)
-
-async def on_rpc_message(message):
-    if message.correlation_id in rpcs:
-        # the completing future will delete its entry. or maybe it shouldn't.
-        future = rpcs[message.correlation_id]
-        future.set_result(message.body.decode())
-
 async def on_adsb_message(message):
-    icao = message.headers["icao"]
-    if await redis.exists(f"trace_requested_{icao}", f"trace_{icao}") > 0:
+    icao = wire.decode(message).icao
+    if seen.get(icao, 0) > time.monotonic():
         return
 
-    request = await redis.set(f"trace_requested_{icao}", "1", nx=True)
-    if not request:
-        log.info(f"Another process requested {icao} first, ignoring: {request}")
+    pending.add(icao)
+
+async def request_traces():
+    last_sweep = time.monotonic()
+    while True:
+        await asyncio.sleep(args.flush_interval / 1000)
+        if len(pending) == 0:
+            continue
+
+        icaos = list(pending)
+        pending.clear()
+        started = time.perf_counter()
+        try:
+            requested = await request_traces_script(args = [time.time(), args.request_ttl] + icaos)
+            REDIS_TIME.record(time.perf_counter() - started)
+        except Exception as x:
+            REDIS_FAILURES.inc()
+            # nothing was marked as seen, so the next message from each of these retries
+            log.error(f"Failed to request traces for {len(icaos)} aircraft: {x}")
+            continue
+
+        now = time.monotonic()
+        for icao in icaos:
+            seen[icao] = now + args.seen_ttl
+        REQUESTED.inc(len(requested))
+        for icao in requested:
+            log.info(f"Requested {icao.decode()}")
+
+        if now - last_sweep > args.seen_ttl:
+            for icao in [icao for icao, expires in seen.items() if expires <= now]:
+                del seen[icao]
+            last_sweep = now
+
+async def watch_trace_keys():
+    # forget an aircraft as soon as its trace key goes away, so a returning aircraft is requested again
+    # without waiting out the seen TTL
+    try:
+        flags = (await redis.config_get("notify-keyspace-events"))["notify-keyspace-events"]
+        wanted = "E" if "A" in flags else "Egx"
+        missing = "".join(flag for flag in wanted if flag not in flags)
+        if missing != "":
+            await redis.config_set("notify-keyspace-events", flags + missing)
+    except Exception as x:
+        log.warning(f"Can't enable keyspace notifications, relying on TTL: {x}")
         return
 
-    await redis.lpush("trace_requests", icao)
-    log.info(f"Requested {icao}")
-
-async def call_rpc(method_name, args):
-    call_id = str(uuid.uuid4())
-
-    await rpc_xch.publish(aio_pika.Message(args.encode(),
-                                           reply_to = rpc_id,
-                                           correlation_id = call_id))
-    rpcs[call_id] = future = asyncio.get_event_loop().create_future()
-
-    try:
-        result = await asyncio.wait_for(future, 2)
-        del rpcs[call_id]
-        return future.result()
-    except TimeoutError:
-        del rpcs[call_id]
-        raise TimeoutError(f"Failed RPC {method_name}({args}): timed out ({call_id})")
+    pubsub = redis.pubsub()
+    await pubsub.psubscribe("__keyevent@*__:del", "__keyevent@*__:expired")
+    async for event in pubsub.listen():
+        if event["type"] != "pmessage":
+            continue
 
-if __name__ == "__main__":
-    global args
+        key = event["data"].decode()
+        if key.startswith("trace_") and not key.startswith("trace_requested_"):
+            seen.pop(key[len("trace_"):], None)
 
+def arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--daemon", action="store_true")
     parser.add_argument("-p", "--pidfile")
     parser.add_argument("-r", "--rabbit", required=True)
     parser.add_argument("-s", "--redis", required=True)
-    args = parser.parse_args()
+    parser.add_argument("--prefetch", type=int, default=1000)
+    parser.add_argument("--seen-ttl", type=float, default=60, help="seconds")
+    parser.add_argument("--flush-interval", type=float, default=5, help="milliseconds")
+    parser.add_argument("--request-ttl", type=int, default=300,
+                        help="seconds before a request no worker started may be made again")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
 
     if args.daemon:
         if args.pidfile is None or len(args.pidfile) == 0:
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import aio_pika
+import argparse
+import asyncio
+import time
+import sys
+import daemon
+import logging
+import logging.handlers
+
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import consumer, events, metrics, ownership, positions, utils, registrations, shedding, timers, tracing, transport, wire
+from redis import asyncio as aioredis
+
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+
+sessions = dict()
+expiry = None
+capacity = None
+trace_queue = None
+adsb_xch = None
+events_xch = None
+forward_xch = None
+delta = None
+redis = None
+worker = None
+
+TRACED = metrics.counter("frames_traced")
+REDIS_TIME = metrics.histogram("redis_seconds", service = "trace_engine")
+# from the moment nc_rabbit read the frame off dump1090 to the moment its meaning is published
+END_TO_END = metrics.histogram("end_to_end_seconds", service = "trace_engine")
+
+async def main():
+    global capacity
+    global expiry
+    global trace_queue
+    global adsb_xch
+    global events_xch
+    global forward_xch
+    global delta
+    global redis
+    global worker
+
+    capacity = asyncio.Semaphore(args.max_sessions)
+    expiry = timers.ExpiryScheduler(on_session_expiry)
+    redis = aioredis.Redis.from_url(args.redis)
+    worker = ownership.Worker(redis, args.max_sessions, on_lost = on_lost, lease = args.lease,
+                              timeout = args.heartbeat_timeout)
+    delta = events.delta_filter(args)
+
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+
+    events_xch = await registrations.Exchanges.TraceEvents(channel)
+    if args.text:
+        forward_xch = await registrations.Exchanges.TracesForHumans(channel)
+    adsb_xch = await registrations.Exchanges.ADSB(channel)
+    trace_queue = await channel.declare_queue(utils.random_string_with_prefix("trace_engine_"),
+                                              durable=False,
+                                              exclusive=True,
+                                              arguments=shedding.queue_arguments("trace_engine"))
+
+    log.info(f"Tracing up to {args.max_sessions} aircraft using {trace_queue.name}")
+    # registered before the first request, so that heartbeat can't mistake this worker for a reaped one
+    await worker.heartbeat()
+
+    try:
+        await asyncio.gather(consumer.consume(trace_queue, on_message,
+                                              prefetch = args.prefetch,
+                                              concurrency = args.concurrency,
+                                              key = consumer.by_icao,
+                                              shedder = shedding.Shedder("trace_engine"),
+                                              stage = "trace_engine"),
+                             worker.run(),
+                             accept_requests(),
+                             expiry.run(),
+                             metrics.export(args, channel, "trace_engine"))
+    except asyncio.exceptions.CancelledError:
+        ...
+    finally:
+        # the exclusive queue and its bindings go away with the connection
+        await worker.leave()
+        await rabbit.close()
+
+async def accept_requests():
+    while True:
+        await capacity.acquire()
+        icao = await worker.next_request()
+
+        started = time.perf_counter()
+        if icao in sessions or not await worker.acquire(icao):
+            log.info(f"Another trace of {icao} started, cancelling")
+            capacity.release()
+            continue
+
+        REDIS_TIME.record(time.perf_counter() - started)
+        sessions[icao] = session = tracing.TraceSession(icao, time.time(), args.receiver)
+        expiry.schedule(icao, session.deadline())
+        await trace_queue.bind(adsb_xch, f"icao.{icao}.#")
+        log.info(f"Tracing {icao} ({len(sessions)} active)")
+
+async def end_session(icao, reason):
+    session = sessions.pop(icao)
+    expiry.cancel(icao)
+    delta.forget(icao)
+    capacity.release()
+    log.info(f"{reason}: {icao} ended after {session.total_messages} messages")
+
+    try:
+        await trace_queue.unbind(adsb_xch, f"icao.{icao}.#")
+    finally:
+        await worker.release(icao)
+
+async def on_lost(icao):
+    if icao in sessions:
+        await end_session(icao, "Taken over by another worker")
+
+async def on_message(message):
+    frame = wire.decode(message)
+    session = sessions.get(frame.icao)
+    if session is None:
+        # still in flight when the session ended
+        return
+
+    TRACED.inc()
+    event = session.on_frame(frame, time.time())
+    expiry.schedule(frame.icao, session.deadline())
+    if event is not None:
+        await publish(event, frame)
+        if frame.timestamp_ns is not None:
+            END_TO_END.record(time.time() - frame.timestamp_ns / 1e9)
+
+async def publish(event, frame):
+    event_message = events.message(event)
+    await events_xch.publish(event_message, f"all.{event.icao}")
+    if delta.passes(event):
+        await events_xch.publish(event_message, f"delta.{event.icao}")
+    if forward_xch is not None:
+        await forward_xch.publish(aio_pika.Message(events.render(event, frame.body).encode(),
+                                                   headers={"icao": frame.icao,
+                                                            "typecode": frame.typecode}),
+                                  frame.icao)
+
+async def on_session_expiry(icao):
+    session = sessions[icao]
+    try:
+        session.check(time.time())
+    except tracing.Cancel as x:
+        await end_session(icao, x)
+        return
+
+    expiry.schedule(icao, session.deadline())
+
+def arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
+    parser.add_argument("-r", "--rabbit", required=True)
+    parser.add_argument("-s", "--redis", required=True)
+    parser.add_argument("-n", "--max-sessions", type=int, default=5000)
+    parser.add_argument("--lease", type=float, default=30, help="seconds an aircraft stays owned without a heartbeat")
+    parser.add_argument("--heartbeat-timeout", type=float, default=6,
+                        help="seconds without a heartbeat before a worker is taken for dead; heartbeats are every 2")
+    parser.add_argument("--prefetch", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("-l", "--receiver", type=positions.parse_location, default=positions.DEFAULT_RECEIVER,
+                        help="receiver location as LAT,LON")
+    events.add_arguments(parser)
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
+
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: trace_engine.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
@@ -2,38 +2,222 @@
 
 import asyncio
 import argparse
+import os
+import shlex
 import sys
+import time
 import daemon
-import aio_pika
-import subprocess
+import logging
+import logging.handlers
 
-from katc import registrations
+from pidlockfile import PIDLockFile
+from setproctitle import setproctitle
+from katc import consumer, metrics, ownership, registrations, scheduling, shedding, transport, utils
 from redis import asyncio as aioredis
 
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+console = logging.StreamHandler()
+console.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+console.setLevel(logging.DEBUG)
+log.addHandler(console)
+
+# Runs a trace.py per requested aircraft, up to --max-traces at once. Requests assigned to this worker (see
+# katc.ownership) are taken into a local backlog and started by priority (see katc.scheduling) as slots
+# free up; each running trace holds its aircraft's lease for as long as the process lives.
+
+TRACE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trace.py")
+
+redis = None
+worker = None
+tracker = None
+backlog = None
+running = dict()
+# set when a slot or a request may have become available, and when the backlog has room again
+wakeup = asyncio.Event()
+room = asyncio.Event()
+
+STARTED = metrics.counter("traces_started")
+STALE = metrics.counter("trace_requests_stale")
+RUNNING = metrics.gauge("traces_running")
+WAITING = metrics.gauge("trace_backlog")
+# from the dispatcher's request to the trace starting
+QUEUE_TIME = metrics.histogram("trace_queue_seconds")
+
 async def main():
+    global redis
+    global worker
+    global tracker
+    global backlog
+
+    if transport.in_process(args.rabbit):
+        raise ValueError("Traces run in their own processes, so they need a real broker")
+
     redis = aioredis.Redis.from_url(args.redis)
+    tracker = scheduling.ActivityTracker(forget_after = args.stale)
+    backlog = scheduling.Backlog(tracker)
+    worker = ownership.Worker(redis, args.max_traces, on_lost = on_lost, lease = args.lease,
+                              timeout = args.heartbeat_timeout, waiting = lambda: len(backlog))
+
+    rabbit = await transport.connect(args.rabbit)
+    channel = await rabbit.channel()
+    adsb_xch = await registrations.Exchanges.ADSB(channel)
+    adsb_queue = await channel.declare_queue(utils.random_string_with_prefix("trace_redis_shell_"),
+                                             durable=False,
+                                             exclusive=True,
+                                             arguments=shedding.queue_arguments("trace_redis_shell"))
+    await adsb_queue.bind(adsb_xch, "#")
 
+    log.info(f"Running up to {args.max_traces} traces")
+    # registered before the first request, so that heartbeat can't mistake this worker for a reaped one
+    await worker.heartbeat()
+
+    try:
+        await asyncio.gather(consumer.consume(adsb_queue, on_adsb, no_ack = True, stage = "trace_redis_shell"),
+                             worker.run(),
+                             fetch_requests(),
+                             start_traces(),
+                             drop_stale_requests(),
+                             metrics.export(args, channel, "trace_redis_shell"))
+    except asyncio.exceptions.CancelledError:
+        ...
+    finally:
+        for task in list(running.values()):
+            task.cancel()
+        await asyncio.gather(*running.values(), return_exceptions = True)
+
+        # hand what never started to the other workers, along with what is still queued for this one
+        if len(backlog) > 0:
+            await redis.rpush(worker.queue, *backlog.requests)
+        await worker.leave()
+        await rabbit.close()
+
+async def on_adsb(message):
+    tracker.on_message(message)
+
+async def fetch_requests():
     while True:
-        icao = await redis.brpop("trace_requests")
-        icao = icao[1].decode()
-        trace_args = [sys.executable, "./trace.py", "-i", icao, "-r", args.rabbit]
-        print(f"Starting trace for {icao}")
-        if not await redis.set(f"trace_{icao}", "1", 3600, nx=True):
-           print(f"Another trace started, cancelling")
-           continue
+        if len(backlog) >= args.backlog:
+            room.clear()
+            await room.wait()
+            continue
 
+        # block for one request, then take whatever else is already waiting, up to the backlog limit
+        icaos = [await worker.next_request()]
+        if len(backlog) + 1 < args.backlog:
+            icaos += await worker.more_requests(args.backlog - len(backlog) - 1)
+
+        now = time.time()
+        requested = await redis.mget([f"trace_requested_{icao}" for icao in icaos])
+        for icao, requested_at in zip(icaos, requested):
+            backlog.add(icao, request_time(requested_at, now))
+        WAITING.set(len(backlog))
+        wakeup.set()
+
+def request_time(value, default):
+    # older dispatchers only store "1"
+    try:
+        requested_at = float(value)
+    except (TypeError, ValueError):
+        return default
+    return requested_at if requested_at > 1 else default
+
+async def start_traces():
+    while True:
+        if len(running) >= args.max_traces or len(backlog) == 0:
+            wakeup.clear()
+            await wakeup.wait()
+            continue
+
+        icao, requested_at = backlog.pop()
+        WAITING.set(len(backlog))
+        room.set()
+        if icao in running:
+            continue
+
+        if not await worker.acquire(icao):
+            log.info(f"Another trace of {icao} started, cancelling")
+            continue
+
+        QUEUE_TIME.record(time.time() - requested_at)
+        STARTED.inc()
+        running[icao] = asyncio.create_task(run_trace(icao))
+        RUNNING.set(len(running))
+
+async def run_trace(icao):
+    process = None
+    try:
+        process = await asyncio.create_subprocess_exec(sys.executable, TRACE_SCRIPT, "-i", icao, "-r", args.rabbit,
+                                                       *args.trace_options)
+        log.info(f"Tracing {icao} ({len(running)} running, {len(backlog)} waiting)")
+        await process.wait()
+        log.info(f"Trace of {icao} ended with {process.returncode}")
+    except Exception as x:
+        log.error(f"Failed to trace {icao}: {x}")
+    finally:
+        if process is not None and process.returncode is None:
+            process.terminate()
+            await process.wait()
         try:
-            await redis.delete(f"trace_requested_{icao}")
-            subprocess.run(trace_args)
-        finally:
-            await redis.delete(f"trace_{icao}")
+            await worker.release(icao)
+        except Exception as x:
+            log.error(f"Failed to release trace_{icao}, it expires in {args.lease}s: {x}")
 
-if __name__ == "__main__":
-    global args
+        running.pop(icao, None)
+        RUNNING.set(len(running))
+        wakeup.set()
 
+async def on_lost(icao):
+    task = running.get(icao)
+    if task is not None:
+        log.warning(f"{icao} was taken over by another worker, stopping its trace")
+        task.cancel()
+
+async def drop_stale_requests():
+    # an aircraft that left while waiting isn't worth a slot; forgetting its request lets the dispatcher
+    # ask again if it comes back
+    while True:
+        await asyncio.sleep(args.stale / 4)
+        stale = backlog.stale(args.stale)
+        if len(stale) == 0:
+            continue
+
+        await redis.delete(*(f"trace_requested_{icao}" for icao in stale))
+        STALE.inc(len(stale))
+        WAITING.set(len(backlog))
+        room.set()
+        log.info(f"Dropped {len(stale)} requests for aircraft no longer heard")
+
+def arguments():
     parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--daemon", action="store_true")
+    parser.add_argument("-p", "--pidfile")
     parser.add_argument("-r", "--rabbit", required=True)
     parser.add_argument("-s", "--redis", required=True)
-    args = parser.parse_args()
+    parser.add_argument("-n", "--max-traces", type=int, default=50)
+    parser.add_argument("--backlog", type=int, default=1000, help="requests held locally while waiting for a slot")
+    parser.add_argument("--lease", type=float, default=30, help="seconds an aircraft stays owned without a heartbeat")
+    parser.add_argument("--heartbeat-timeout", type=float, default=6,
+                        help="seconds without a heartbeat before a worker is taken for dead; heartbeats are every 2")
+    parser.add_argument("--stale", type=float, default=120,
+                        help="seconds an aircraft may go unheard before its waiting request is dropped")
+    parser.add_argument("-o", "--trace-options", type=shlex.split, default=[],
+                        help="extra arguments for every trace.py, e.g. '--text --delta-interval 1'")
+    metrics.add_arguments(parser)
+    return parser
+
+if __name__ == "__main__":
+    global args
+
+    args = arguments().parse_args()
+
+    if args.daemon:
+        if args.pidfile is None or len(args.pidfile) == 0:
+            log.error("-p/--pidfile is required when --daemon is present")
+            sys.exit(1)
 
-    asyncio.run(main())
+        with daemon.DaemonContext(pidfile=PIDLockFile(args.pidfile, timeout=2.0)):
+            setproctitle("katc: trace_redis_shell.py")
+            asyncio.run(main())
+    else:
+        asyncio.run(main())
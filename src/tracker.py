@@ -1,21 +1,19 @@
 #!/usr/bin/env python
 
 import asyncio
+import json
 import pyModeS as pms
 import aio_pika
-import uuid
-import concurrent.futures
 
-from src import utils
+from katc import callsigns, consumer, rpc, utils, wire
 
-callsign_map = dict()
-rpcs = dict()
-rpc_exc = None
-rpc_id = None
+callsign_cache = callsigns.CallsignCache()
+callsign_resolver = None
+rpc_client = None
 
 async def main():
-    global rpc_exc
-    global rpc_id
+    global rpc_client
+    global callsign_resolver
 
     broker = await utils.connect_to_rabbit()
     channel = await broker.channel()
@@ -27,72 +25,45 @@ async def main():
     await queue.bind(exc, "#")
 
     rpc_queue = await channel.declare_queue("", exclusive = True)
-    rpc_id = rpc_queue.name
     await rpc_queue.bind(rpc_exc)
+    rpc_client = rpc.RpcClient(rpc_exc, rpc_queue.name)
 
-    await asyncio.gather(consume(queue, on_adsb),
-                         consume(rpc_queue, on_rpc, no_ack = True))
+    callsign_resolver = callsigns.BulkResolver(callsign_cache, get_callsigns)
 
-async def consume(queue, on_message, no_ack = False):
-    async with queue.iterator(no_ack = no_ack) as q:
-        async for message in q:
-            if no_ack:
-                await on_message(message)
-            else:
-                async with message.process():
-                    await on_message(message)
+    await asyncio.gather(consumer.consume(queue, on_adsb, concurrency = 8, key = consumer.by_icao),
+                         consumer.consume(rpc_queue, rpc_client.on_reply, no_ack = True, stage = "tracker_rpc"))
 
-async def call_rpc(method_name, args):
-    call_id = str(uuid.uuid4())
-
-    await rpc_exc.publish(aio_pika.Message(args.encode(),
-                                           reply_to = rpc_id,
-                                           correlation_id = call_id),
-                          method_name)
-
-    rpcs[call_id] = future = asyncio.get_event_loop().create_future()
+async def get_callsigns(icaos):
     try:
-        result = await asyncio.wait_for(future, 2)
-        del rpcs[call_id]
-        return future.result()
-    except TimeoutError:
-        del rpcs[call_id]
-        raise TimeoutError(f"RPC {method_name}({args}) timed out ({call_id})")
-
-async def on_rpc(message):
-    if message.correlation_id in rpcs:
-        future = rpcs[message.correlation_id]
-        future.set_result(message.body.decode())
+        return json.loads(await rpc_client.call("get-callsigns", json.dumps(icaos)))
+    except (TimeoutError, rpc.RpcError):
+        return dict()
 
 async def on_adsb(message):
-    body = message.body.decode()
-    icao = message.headers["icao"]
-    tc = message.headers["typecode"]
+    frame = wire.decode(message)
+    body = frame.body
+    icao = frame.icao
+    tc = frame.typecode
     if tc == None:
         print(f"No TC from {icao}: {body}")
         return
 
-    if icao not in callsign_map:
-        try:
-            callsign = await call_rpc("get-callsign", icao)
-            if callsign != "":
-                callsign_map[icao] = callsign
-        except TimeoutError:
-            pass
+    callsign = callsign_cache.get(icao)
+    if callsign is None:
+        # answered in the background; this message goes out as "unknown"
+        callsign_resolver.resolve(icao)
 
     meaning = ""
-    if 1 <= tc <= 4 and icao not in callsign_map:
+    if 1 <= tc <= 4 and not callsign:
         try:
             callsign = pms.adsb.callsign(body).rstrip("_ ")
         except:
             print(f"Ident message without callsign: {body}")
             return
 
-        callsign_map[icao] = callsign
+        callsign_cache.put(icao, callsign)
         meaning = f"{icao} is now {callsign}"
-    elif icao in callsign_map:
-        callsign = callsign_map[icao]
-    else:
+    elif not callsign:
         callsign = "unknown"
 
     if 5 <= tc <= 18 or 20 <= tc <= 22: